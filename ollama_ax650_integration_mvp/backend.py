@@ -5,13 +5,28 @@ This service acts as a compatibility layer between Ollama and the manufacturer's
 optimized C++ inference server (main_api_ax650).
 
 Architecture:
-  Ollama -> [Proxy (This Service)] -> [C++ Server (main_api_ax650)] -> NPU
+  Ollama -> [Proxy (This Service)] -> [C++ Server pool (main_api_ax650)] -> NPU(s)
 
 Responsibilities:
-  1. Manage C++ server lifecycle (start/stop/restart).
-  2. Translate Ollama requests to C++ server API calls.
-  3. Implement stateless-to-stateful logic (Reset -> Generate).
-  4. Handle model loading and configuration.
+  1. Manage C++ server lifecycle (start/stop/restart), one process per
+     AX650 device or configured slot, each on its own port.
+  2. Translate Ollama requests to C++ server API calls, routing each request
+     to the least-loaded healthy runtime.
+  3. Implement stateless-to-stateful logic (Reset -> Generate), skipping the
+     reset when a request only extends the conversation already resident in
+     the runtime (session affinity).
+  4. Handle model loading and residency: honor keep_alive and the device
+     memory budget, and pre-spawn/warm a model's runtimes before switching
+     traffic to it.
+  5. Supervise the runtimes: drain their output into our log, detect crashes
+     and restart them with backoff, retrying requests they were serving.
+  6. Probe runtimes in the background so /health answers from memory.
+  7. Optionally answer repeated deterministic requests from a response cache,
+     and coalesce identical ones that are already in flight.
+  8. Export Prometheus metrics on /metrics.
+  9. Optionally capture request metadata for timed replay (AX650_CAPTURE_FILE).
+  10. Run the tokenizer service the real runtime depends on
+      (tokenizer_service.py), started and stopped with the runtimes.
 """
 import os
 import sys
@@ -22,7 +37,21 @@ import requests
 import signal
 import re
 import shutil
-from flask import Flask, request, jsonify
+import threading
+import collections
+import socket
+import json
+import uuid
+import urllib.parse
+from flask import Flask, Response, request, jsonify
+from model_residency import ModelRegistry, parse_keep_alive, normalize_name, DEFAULT_MODEL_NAME
+from response_cache import ResponseCache, cache_key, is_deterministic
+from single_flight import Flight, FlightTable
+from metrics_registry import REGISTRY, CONTENT_TYPE, Counter, Gauge, Histogram, RATE_BUCKETS
+import tracing
+import telemetry
+from layer_stats import LayerStats
+from request_capture import RequestCapture
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("AX650Proxy")
@@ -31,260 +60,1625 @@ APP = Flask(__name__)
 
 # Configuration
 RUNTIME_HOST = "127.0.0.1"
-RUNTIME_PORT = 8000
-RUNTIME_URL = f"http://{RUNTIME_HOST}:{RUNTIME_PORT}"
+RUNTIME_PORT = 8000  # First runtime port; later runtimes take the next free one
 PROXY_PORT = int(os.environ.get("AX650_PORT", 5002))
+# Number of runtime processes. Defaults to one per detected device (real
+# binary) or a single mock. Set >1 to run several mocks standing in for cards.
+RUNTIME_SLOTS = int(os.environ.get("AX650_RUNTIME_SLOTS", 0))
+# Explicit comma-separated runtime device ids (0-based), overrides detection.
+RUNTIME_DEVICES = os.environ.get("AX650_DEVICES", "")
+# Command-line flag the real binary uses to pick its HTTP port. The stock
+# main_api binary always listens on 8000, so only one real runtime can run
+# unless a build with a port option is configured here (e.g. "--port").
+RUNTIME_PORT_FLAG = os.environ.get("AX650_RUNTIME_PORT_FLAG", "")
+# AX650_USE_MOCK=1 runs mock_main_api.py even where the real binary is
+# present (tests, development on the Pi)
+USE_MOCK = os.environ.get("AX650_USE_MOCK", "0") != "0"
+# Seconds to wait for a runtime to answer after launch. Several runtimes
+# loading at once contend for CPU and PCIe, so allow more than a lone start.
+RUNTIME_START_TIMEOUT = float(os.environ.get("AX650_RUNTIME_START_TIMEOUT", 30))
+
+# Tokenizer service the real runtime encodes and decodes through
+# (--url_tokenizer_model). AX650_TOKENIZER: "auto" runs tokenizer_service.py
+# alongside the real runtime, "1" alongside any runtime, "0" never (an
+# external service must answer at AX650_TOKENIZER_URL).
+TOKENIZER_MODE = os.environ.get("AX650_TOKENIZER", "auto")
+TOKENIZER_PORT = int(os.environ.get("AX650_TOKENIZER_PORT", 12345))
+TOKENIZER_URL = os.environ.get("AX650_TOKENIZER_URL", f"http://127.0.0.1:{TOKENIZER_PORT}")
+# Tokenizer directory; defaults to the model directory if it has one, else
+# the reference project's qwen3_tokenizer next to it
+TOKENIZER_PATH = os.environ.get("AX650_TOKENIZER_PATH")
+# Importing transformers alone takes several seconds on a Pi
+TOKENIZER_START_TIMEOUT = float(os.environ.get("AX650_TOKENIZER_START_TIMEOUT", 60))
 
-# Subprocess state
-RUNTIME_PROCESS = None
 CURRENT_MODEL_PATH = os.environ.get("AX650_MODEL_PATH")
 
-def start_runtime(model_path=None):
-    """Start the C++ inference server (or mock) as a subprocess."""
-    global RUNTIME_PROCESS, CURRENT_MODEL_PATH
-    
-    if RUNTIME_PROCESS:
-        stop_runtime()
-        
-    if model_path:
-        CURRENT_MODEL_PATH = model_path
-        
+# Model residency
+# Default keep_alive for requests that don't send one. Ollama itself uses 5m;
+# a dedicated NPU box keeps its model loaded ("-1") unless told otherwise.
+DEFAULT_KEEP_ALIVE = parse_keep_alive(os.environ.get("AX650_KEEP_ALIVE", "-1"))
+# Device (CMM) memory available to models on each card; 0 = unlimited.
+MEMORY_BUDGET_MB = int(os.environ.get("AX650_MEMORY_BUDGET_MB", 7040))
+MODELS = ModelRegistry(budget_bytes=MEMORY_BUDGET_MB * 1024 * 1024)
+if os.environ.get("AX650_MODELS"):
+    MODELS.load_file(os.environ["AX650_MODELS"])
+MODELS.register(DEFAULT_MODEL_NAME, CURRENT_MODEL_PATH)
+# Serializes loads/unloads; requests for a resident model never take it.
+RESIDENCY_LOCK = threading.Lock()
+SWITCH_STATS = {"loads": 0, "hot": 0, "cold": 0, "unloads": 0, "downtime_s": 0.0, "last": None}
+
+# Session affinity
+# The runtime keeps its own KV context between /api/generate calls and only
+# discards it on /api/reset. We remember which conversation is resident so a
+# request that merely appends a user turn can skip the reset and prefill.
+SESSION_AFFINITY = os.environ.get("AX650_SESSION_AFFINITY", "1") != "0"
+SESSION_STATS = {"requests": 0, "resets": 0, "prefill_tokens_avoided": 0}
+
+# Supervisor
+SUPERVISOR_INTERVAL = 0.5  # seconds between liveness checks
+RESTART_BACKOFF_INITIAL = 1.0
+RESTART_BACKOFF_MAX = 30.0
+# A runtime that stays up this long is considered stable again and its
+# restart backoff starts over.
+RESTART_STABLE_AFTER = 60.0
+# How many times a request is re-run on another runtime after the one
+# serving it crashed.
+REQUEST_RETRIES = int(os.environ.get("AX650_REQUEST_RETRIES", 1))
+
+# The runtime answers 400 "llm is running" for a moment after a reset or a
+# generation; such requests are retried with backoff for up to this long.
+RUNTIME_BUSY_RETRY = float(os.environ.get("AX650_RUNTIME_BUSY_RETRY", 5))
+
+# A runtime busy with a generation that produces no output for this long is
+# wedged: the request fails with 504 and the process is killed and
+# restarted. Allow for the first token of a long prompt.
+RUNTIME_STALL_TIMEOUT = float(os.environ.get("AX650_RUNTIME_STALL_TIMEOUT", 60))
+# Upper bound on one generation, output or not (504 after that)
+GENERATION_TIMEOUT = float(os.environ.get("AX650_GENERATION_TIMEOUT", 600))
+# How runtimes without an "error" field in /api/generate_provider report a
+# failed generation: as the reply text
+RUNTIME_ERROR_PREFIXES = ("Error: ", "Error during generation:")
+
+# Health probing
+PROBE_INTERVAL = float(os.environ.get("AX650_PROBE_INTERVAL", 1.0))
+PROBE_TIMEOUT = 0.5
+# Startup: wake on the runtime's "listening" banner, else re-check the port
+READY_POLL_INTERVAL = 0.1
+READY_PATTERNS = ("Server running on port", "Running on http", "Server running at")
+
+# Response cache (opt-in): top_k=1 requests are reproducible, so identical
+# ones can skip the NPU entirely.
+RESPONSE_CACHE = None
+if os.environ.get("AX650_RESPONSE_CACHE", "0") != "0":
+    RESPONSE_CACHE = ResponseCache(
+        os.environ.get("AX650_RESPONSE_CACHE_DIR",
+                       os.path.expanduser("~/.cache/ax650_proxy/responses")),
+        memory_bytes=int(os.environ.get("AX650_RESPONSE_CACHE_MB", 64)) * 1024 * 1024,
+        disk_bytes=int(os.environ.get("AX650_RESPONSE_CACHE_DISK_MB", 512)) * 1024 * 1024)
+
+# Single-flight: identical deterministic requests that arrive while one is
+# running or queued share its generation instead of repeating it.
+COALESCE = os.environ.get("AX650_COALESCE", "1") != "0"
+FLIGHTS = FlightTable()
+
+# Tracing: proxy spans (queue, reset, HTTP hops) go to the same kind of ring
+# buffer as the engine's; /trace merges both with NPU samples.
+TRACE_LEVEL = tracing.parse_level(os.environ.get("AX650_TRACE"))
+
+# Device telemetry (NPU/CPU %, temperature, CMM memory) sampled in the
+# background and kept as a bounded history; served at /telemetry
+TELEMETRY_INTERVAL = float(os.environ.get("AX650_TELEMETRY_INTERVAL", 0.5))
+TELEMETRY = telemetry.TelemetryCollector(TELEMETRY_INTERVAL,
+                                         capacity=int(os.environ.get("AX650_TELEMETRY_SAMPLES", 20000)))
+
+# Opt-in request capture (AX650_CAPTURE_FILE): one JSON line of metadata per
+# finished request, replayable with performance_evaluation/replay_capture.py
+CAPTURE = RequestCapture.from_env()
+
+# Prometheus metrics (/metrics). Engine-side histograms (per-layer NPU time,
+# sampling) are on each runtime's own /metrics.
+REQUESTS = Counter("ax650_proxy_requests_total", "Generation requests by outcome", ("outcome",))
+ERRORS = Counter("ax650_proxy_errors_total", "Failed generation requests by HTTP status", ("status",))
+CANCELLATIONS = Counter("ax650_proxy_cancellations_total", "Streaming clients that disconnected early")
+TOKENS = Counter("ax650_proxy_tokens_total", "Tokens processed by the runtimes", ("phase",))
+TTFT = Histogram("ax650_proxy_ttft_seconds", "Request arrival to first output chunk")
+TOKEN_SECONDS = Histogram("ax650_proxy_token_seconds", "Gap between consecutive output chunks")
+QUEUE_WAIT = Histogram("ax650_proxy_queue_wait_seconds", "Time waiting for a runtime to become free")
+PREFILL_RATE = Histogram("ax650_proxy_prefill_tokens_per_second", "Prompt tokens per second of prompt eval",
+                         buckets=RATE_BUCKETS)
+QUEUE_DEPTH = Gauge("ax650_proxy_queue_depth", "Requests waiting for a runtime")
+Gauge("ax650_proxy_inflight", "Requests reserved on a runtime").set_function(
+    lambda: sum(rt.inflight for rt in RUNTIMES))
+Gauge("ax650_proxy_runtimes_healthy", "Healthy runtime processes").set_function(
+    lambda: sum(1 for rt in RUNTIMES if rt.healthy))
+Gauge("ax650_proxy_response_cache_bytes", "Bytes held by the response cache (memory + disk)").set_function(
+    lambda: RESPONSE_CACHE.total_bytes() if RESPONSE_CACHE is not None else 0)
+
+
+class GenerationError(Exception):
+    """A generation failed in a way the client should see."""
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+class RuntimeCrashed(Exception):
+    """The runtime serving a request died or was restarted underneath it."""
+
+
+class RuntimeInstance:
+    """One C++ server (or mock) process serving a model on a device and port."""
+
+    def __init__(self, slot, device_id, port, model):
+        self.slot = slot
+        self.device_id = device_id
+        self.port = port
+        self.model = model
+        self.label = f"{model.name}/{slot}"
+        self.url = f"http://{RUNTIME_HOST}:{port}"
+        self.process = None
+        self.healthy = False
+        # The runtime serves one generation at a time; serialize reset/generate/poll.
+        self.lock = threading.Lock()
+        # Requests routed here that have not finished yet (running + waiting).
+        self.inflight = 0
+        self.served = 0
+        # {"system": str, "turns": [messages]} or None if unknown
+        self.session = None
+
+        # Supervision state
+        self.wanted = True          # False once stopped on purpose
+        self.epoch = 0              # bumped on every (re)launch
+        self.started_at = None
+        self.down_since = None
+        self.restarting = False
+        self.next_restart = 0.0
+        self.backoff = RESTART_BACKOFF_INITIAL
+        self.restarts = 0
+        self.crashes = 0
+        self.stalls = 0             # killed for making no progress
+        self.downtime = 0.0
+        self.output_tail = collections.deque(maxlen=50)
+        # Set while a request is generating here (liveness by output staleness)
+        self.generating_since = None
+
+        # Cached probe results (see _probe_instance)
+        self.status_api = None      # True/False once we know if /api/status exists
+        self.busy = False
+        self.last_token_at = None
+        self.probed_at = None
+
+    def alive(self, epoch=None):
+        """True if the process is running (and is the same launch as `epoch`)."""
+        proc = self.process
+        if proc is None or proc.poll() is not None:
+            return False
+        return epoch is None or epoch == self.epoch
+
+    def describe(self):
+        now = time.time()
+        downtime = self.downtime + (now - self.down_since if self.down_since else 0.0)
+        return {
+            "slot": self.slot,
+            "model": self.model.name,
+            "device": self.device_id,
+            "url": self.url,
+            "alive": self.alive(),
+            "healthy": self.healthy,
+            "pid": self.process.pid if self.process else None,
+            "inflight": self.inflight,
+            "served": self.served,
+            "resident_turns": len(self.session["turns"]) if self.session else 0,
+            "busy": self.busy or self.inflight > 0,
+            "last_token_at": self.last_token_at,
+            "probe_age_s": round(now - self.probed_at, 3) if self.probed_at else None,
+            "uptime_s": round(now - self.started_at, 3) if self.started_at and not self.down_since else 0.0,
+            "crashes": self.crashes,
+            "stalls": self.stalls,
+            "restarts": self.restarts,
+            "downtime_s": round(downtime, 3),
+            "down_since": self.down_since
+        }
+
+
+# Runtime pool state
+RUNTIMES = []
+POOL_LOCK = threading.Lock()
+
+
+def detect_runtime_devices():
+    """Detect the runtime device ids of all attached AX650 cards.
+
+    `axcl-smi` reports human-friendly device ids (1-based). The C++ runtime
+    expects 0-based device ids. This helper runs `axcl-smi` (if available),
+    parses every `Device ID` line and returns the (reported_id - 1) values.
+    Falls back to ["0"] on any error.
+    """
+    axcl_bin = shutil.which("axcl-smi")
+    if not axcl_bin:
+        logger.warning("axcl-smi not found; defaulting to device 0")
+        return ["0"]
+
+    try:
+        out = subprocess.check_output([axcl_bin, "info", "--cmm"], stderr=subprocess.STDOUT, text=True, timeout=5)
+        # look for lines like: "Device ID           : 1 (0x1)"
+        reported = [int(m) for m in re.findall(r"Device ID\s*:\s*(\d+)", out)]
+        if reported:
+            runtime_ids = sorted({str(max(0, r - 1)) for r in reported}, key=int)
+            logger.info(f"Detected AXCL reported devices {reported}; using runtime devices {runtime_ids}")
+            return runtime_ids
+    except Exception as e:
+        logger.warning(f"Failed to run axcl-smi to detect device: {e}; defaulting to 0")
+
+    return ["0"]
+
+
+def _real_binary():
+    """Return the path of the real runtime binary, or None to use the mock."""
+    if USE_MOCK:
+        return None
     cwd = os.path.dirname(os.path.abspath(__file__))
     # Use the AXCL binary for M.2 card (Raspberry Pi 5 + AX650/LLM8850)
     real_binary = os.path.join(cwd, "main_api_axcl_aarch64")
-    mock_script = os.path.join(cwd, "mock_main_api.py")
-    
-    cmd = []
-    env = os.environ.copy()
-    if CURRENT_MODEL_PATH:
-        env["AX650_MODEL_PATH"] = CURRENT_MODEL_PATH
-    
     # Check for real binary (and ensure it's not the LFS pointer)
-    use_real = False
     if os.path.exists(real_binary) and os.access(real_binary, os.X_OK):
         # Check size to avoid LFS pointer (pointer is ~130 bytes)
         if os.path.getsize(real_binary) > 2000:
-            use_real = True
-            
-    if use_real:
-        logger.info(f"Launching REAL runtime: {real_binary}")
-        
-        # Path to model files (assuming they're in the reference_projects location)
-        model_base = os.path.join(
-            os.path.dirname(os.path.dirname(cwd)),
-            "ax650_raspberry_pi_services",
-            "reference_projects_and_documentation",
-            "Qwen3-4B",
-            "qwen3-4b-ax650"
-        )
+            return real_binary
+    return None
 
-        def detect_runtime_device():
-            """Detect an appropriate runtime device id.
 
-            `axcl-smi` reports human-friendly device ids (1-based). The C++ runtime
-            expects 0-based device ids. This helper runs `axcl-smi` (if available),
-            parses the first `Device ID` line and returns (reported_id - 1).
-            Falls back to 0 on any error.
-            """
-            axcl_bin = shutil.which("axcl-smi")
-            if not axcl_bin:
-                logger.warning("axcl-smi not found; defaulting to device 0")
-                return "0"
+def _plan_slots(use_real):
+    """Work out the device id of every runtime a model gets."""
+    if RUNTIME_DEVICES:
+        devices = [d.strip() for d in RUNTIME_DEVICES.split(",") if d.strip()]
+    elif use_real:
+        devices = detect_runtime_devices()
+    else:
+        devices = ["0"]
 
-            try:
-                out = subprocess.check_output([axcl_bin, "info", "--cmm"], stderr=subprocess.STDOUT, text=True, timeout=5)
-                # look for lines like: "Device ID           : 1 (0x1)"
-                m = re.search(r"Device ID\s*:\s*(\d+)", out)
-                if m:
-                    reported = int(m.group(1))
-                    runtime_id = max(0, reported - 1)
-                    logger.info(f"Detected AXCL reported device {reported}; using runtime device {runtime_id}")
-                    return str(runtime_id)
-            except Exception as e:
-                logger.warning(f"Failed to run axcl-smi to detect device: {e}; defaulting to 0")
-
-            return "0"
-        
-        # Construct command with all required arguments
-        device_id = detect_runtime_device()
+    count = RUNTIME_SLOTS or len(devices)
+    if use_real and count > 1 and not RUNTIME_PORT_FLAG:
+        logger.warning("Real runtime listens on a fixed port; set AX650_RUNTIME_PORT_FLAG to run "
+                       f"{count} runtimes. Using a single runtime on device {devices[0]}")
+        count = 1
+
+    # Slots beyond the number of devices share cards round-robin
+    return [devices[i % len(devices)] for i in range(count)]
+
+
+def _free_ports(count):
+    """Pick `count` runtime ports not used by any runtime in the pool."""
+    with POOL_LOCK:
+        used = {rt.port for rt in RUNTIMES}
+    ports = []
+    port = RUNTIME_PORT
+    while len(ports) < count:
+        if port not in used:
+            ports.append(port)
+        port += 1
+    return ports
+
+
+def _colocation_possible():
+    """Can runtimes for two models run side by side (separate ports)?"""
+    return _real_binary() is None or bool(RUNTIME_PORT_FLAG)
+
+
+def _model_base(model_path):
+    """Directory of the model files (defaults to the reference_projects location)."""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    return model_path or os.path.join(
+        os.path.dirname(os.path.dirname(cwd)),
+        "ax650_raspberry_pi_services",
+        "reference_projects_and_documentation",
+        "Qwen3-4B",
+        "qwen3-4b-ax650"
+    )
 
+
+def _runtime_command(rt, real_binary, cwd):
+    """Build the launch command for one runtime instance."""
+    if real_binary:
+        model_base = _model_base(rt.model.path)
+
+        # Construct command with all required arguments
         cmd = [
             real_binary,
             "--system_prompt", "You are Qwen, created by Alibaba Cloud. You are a helpful assistant.",
             "--template_filename_axmodel", f"{model_base}/qwen3_p128_l%d_together.axmodel",
             "--axmodel_num", "36",
-            "--url_tokenizer_model", "http://127.0.0.1:12345",
+            "--url_tokenizer_model", TOKENIZER_URL,
             "--filename_post_axmodel", f"{model_base}/qwen3_post.axmodel",
             "--filename_tokens_embed", f"{model_base}/model.embed_tokens.weight.bfloat16.bin",
             "--tokens_embed_num", "151936",
             "--tokens_embed_size", "2560",
             "--use_mmap_load_embed", "1",
-            "--devices", device_id
+            "--devices", rt.device_id
         ]
+        if RUNTIME_PORT_FLAG:
+            cmd += [RUNTIME_PORT_FLAG, str(rt.port)]
+        return cmd
+
+    mock_script = os.path.join(cwd, "mock_main_api.py")
+    return [sys.executable, mock_script]
+
+
+def _launch_instance(rt):
+    """Start one runtime process and wait until it answers HTTP."""
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    real_binary = _real_binary()
+    cmd = _runtime_command(rt, real_binary, cwd)
+
+    env = os.environ.copy()
+    env.pop("AX650_MODEL_PATH", None)
+    if rt.model.path:
+        env["AX650_MODEL_PATH"] = rt.model.path
+    # The mock reads its listen port and device from the environment
+    env["AX650_PORT"] = str(rt.port)
+    env["AX650_DEVICE_ID"] = rt.device_id
+    # Let the mock's banner and logs reach the pump as they are written
+    env["PYTHONUNBUFFERED"] = "1"
+
+    if (real_binary and TOKENIZER_MODE == "auto") or TOKENIZER_MODE == "1":
+        # Every encode and decode of the runtime goes through this service
+        if not start_tokenizer(rt.model.path):
+            logger.error(f"Not launching runtime {rt.label}: tokenizer service unavailable at {TOKENIZER_URL}")
+            return False
+
+    if real_binary:
+        logger.info(f"Launching REAL runtime {rt.label} on device {rt.device_id}: {real_binary}")
     else:
-        logger.info(f"Launching MOCK runtime: {mock_script}")
-        cmd = [sys.executable, mock_script]
-        
+        logger.info(f"Launching MOCK runtime {rt.label} on port {rt.port}: {cmd[-1]}")
+
     try:
         # Start process
-        RUNTIME_PROCESS = subprocess.Popen(
-            cmd, 
-            cwd=cwd, 
+        rt.process = subprocess.Popen(
+            cmd,
+            cwd=cwd,
             env=env,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE
         )
-        
-        # Wait for health check
-        logger.info("Waiting for runtime to initialize...")
-        for i in range(20):
-            if RUNTIME_PROCESS.poll() is not None:
-                # Process exited early
-                out, err = RUNTIME_PROCESS.communicate()
-                logger.error(f"Runtime exited early with code {RUNTIME_PROCESS.returncode}")
-                logger.error(f"Stdout: {out.decode()}")
-                logger.error(f"Stderr: {err.decode()}")
+
+        rt.epoch += 1
+        rt.started_at = time.time()
+        # Drain both pipes continuously; a chatty runtime would otherwise
+        # block once the pipe buffer fills. The pumps also signal `ready`
+        # when the runtime prints its listening banner (or exits).
+        ready = threading.Event()
+        for stream, level in ((rt.process.stdout, logging.INFO), (rt.process.stderr, logging.WARNING)):
+            threading.Thread(target=_pump_output, args=(rt, stream, level, ready), daemon=True).start()
+
+        # Wait for the runtime to accept connections
+        logger.info(f"Waiting for runtime {rt.label} to initialize...")
+        deadline = time.time() + RUNTIME_START_TIMEOUT
+        while time.time() < deadline:
+            ready.wait(min(READY_POLL_INTERVAL, max(0.0, deadline - time.time())))
+            ready.clear()
+            if rt.process.poll() is not None:
+                # Process exited early (its output has already been logged)
+                logger.error(f"Runtime {rt.label} exited early with code {rt.process.returncode}")
+                rt.process = None
                 return False
-                
-            try:
-                # Try to connect to /api/stop (GET) as a ping
-                requests.get(f"{RUNTIME_URL}/api/stop", timeout=0.5)
-                logger.info("Runtime is up and responding!")
-                
-                # Start background thread to log runtime output?
-                # For now, let's just leave it.
+
+            if _port_open(rt):
+                _probe_instance(rt)
+                logger.info(f"Runtime {rt.label} is up after {time.time() - rt.started_at:.2f}s")
+                rt.healthy = True
                 return True
-            except requests.exceptions.RequestException:
-                time.sleep(0.5)
-                
-        logger.error("Runtime failed to start (timeout)")
-        stop_runtime()
+
+        logger.error(f"Runtime {rt.label} failed to start (timeout)")
+        _kill_process(rt)
         return False
-        
+
     except Exception as e:
-        logger.error(f"Failed to launch runtime: {e}")
+        logger.error(f"Failed to launch runtime {rt.label}: {e}")
         return False
 
-def stop_runtime():
-    """Stop the C++ inference server."""
-    global RUNTIME_PROCESS
-    if RUNTIME_PROCESS:
-        logger.info("Stopping runtime...")
-        RUNTIME_PROCESS.terminate()
+
+def _pump_output(rt, stream, level, ready):
+    """Forward a runtime's stdout/stderr into the proxy log, line by line."""
+    runtime_logger = logging.getLogger(f"AX650Runtime.{rt.label}")
+    try:
+        for raw in iter(stream.readline, b""):
+            line = raw.decode(errors="replace").rstrip()
+            if line:
+                rt.output_tail.append(line)
+                runtime_logger.log(level, line)
+                if not ready.is_set() and any(p in line for p in READY_PATTERNS):
+                    ready.set()
+    except (ValueError, OSError):
+        # Pipe closed while the process was being torn down
+        pass
+    finally:
+        stream.close()
+        ready.set()
+
+
+def _port_open(rt):
+    """Cheap, side-effect-free liveness check: does the port accept TCP?"""
+    try:
+        with socket.create_connection((RUNTIME_HOST, rt.port), timeout=PROBE_TIMEOUT):
+            return True
+    except OSError:
+        return False
+
+
+class TokenizerProcess:
+    """The tokenizer_service.py process shared by all runtimes."""
+
+    def __init__(self):
+        self.label = "tokenizer"
+        self.url = TOKENIZER_URL
+        self.process = None
+        self.model_path = None
+        self.wanted = False
+        self.external = False       # something else already serves TOKENIZER_URL
+        self.started_at = None
+        self.restarts = 0
+        self.crashes = 0
+        self.lock = threading.Lock()
+        self.output_tail = collections.deque(maxlen=50)
+
+    def describe(self):
+        return {
+            "url": self.url,
+            "mode": TOKENIZER_MODE,
+            "managed": self.process is not None,
+            "external": self.external,
+            "pid": self.process.pid if self.process else None,
+            "alive": self.process is not None and self.process.poll() is None,
+            "tokenizer_path": self.model_path,
+            "uptime_s": round(time.time() - self.started_at, 3) if self.process and self.started_at else 0.0,
+            "crashes": self.crashes,
+            "restarts": self.restarts
+        }
+
+
+TOKENIZER = TokenizerProcess()
+
+
+def _tokenizer_address():
+    parsed = urllib.parse.urlparse(TOKENIZER_URL)
+    return parsed.hostname or "127.0.0.1", parsed.port or 80
+
+
+def _tokenizer_listening():
+    try:
+        with socket.create_connection(_tokenizer_address(), timeout=PROBE_TIMEOUT):
+            return True
+    except OSError:
+        return False
+
+
+def _tokenizer_path(model_path):
+    """Tokenizer directory for a model (see TOKENIZER_PATH)."""
+    if TOKENIZER_PATH:
+        return TOKENIZER_PATH
+    model_base = _model_base(model_path)
+    if any(os.path.exists(os.path.join(model_base, f)) for f in ("tokenizer.json", "tokenizer_config.json")):
+        return model_base
+    return os.path.join(os.path.dirname(os.path.normpath(model_base)), "qwen3_tokenizer")
+
+
+def start_tokenizer(model_path=None):
+    """Make sure a tokenizer service answers at TOKENIZER_URL, starting ours if needed.
+
+    Returns True once it accepts connections. A service that is already
+    listening (e.g. started by start_tokenizer.sh) is used as is.
+    """
+    with TOKENIZER.lock:
+        TOKENIZER.wanted = True
+        if TOKENIZER.process is not None and TOKENIZER.process.poll() is None:
+            return True
+        if _tokenizer_listening():
+            if not TOKENIZER.external:
+                logger.info(f"Using the tokenizer service already running at {TOKENIZER_URL}")
+            TOKENIZER.external = True
+            return True
+        TOKENIZER.external = False
+
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        if model_path is not None or TOKENIZER.model_path is None:
+            TOKENIZER.model_path = _tokenizer_path(model_path or CURRENT_MODEL_PATH)
+        host, port = _tokenizer_address()
+        cmd = [sys.executable, os.path.join(cwd, "tokenizer_service.py"), "--model-path", TOKENIZER.model_path,
+               "--host", host, "--port", str(port)]
+        logger.info(f"Starting tokenizer service on {TOKENIZER_URL}: {TOKENIZER.model_path}")
         try:
-            RUNTIME_PROCESS.wait(timeout=5)
+            TOKENIZER.process = subprocess.Popen(cmd, cwd=cwd, env=dict(os.environ, PYTHONUNBUFFERED="1"),
+                                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            logger.error(f"Failed to start tokenizer service: {e}")
+            return False
+        if TOKENIZER.started_at is not None:
+            TOKENIZER.restarts += 1
+        TOKENIZER.started_at = time.time()
+        ready = threading.Event()
+        for stream, level in ((TOKENIZER.process.stdout, logging.INFO), (TOKENIZER.process.stderr, logging.WARNING)):
+            threading.Thread(target=_pump_output, args=(TOKENIZER, stream, level, ready), daemon=True).start()
+
+        deadline = time.time() + TOKENIZER_START_TIMEOUT
+        while time.time() < deadline:
+            ready.wait(min(READY_POLL_INTERVAL, max(0.0, deadline - time.time())))
+            ready.clear()
+            if TOKENIZER.process.poll() is not None:
+                logger.error(f"Tokenizer service exited early with code {TOKENIZER.process.returncode}")
+                TOKENIZER.process = None
+                return False
+            if _tokenizer_listening():
+                logger.info(f"Tokenizer service is up after {time.time() - TOKENIZER.started_at:.2f}s")
+                return True
+        logger.error("Tokenizer service failed to start (timeout)")
+        _stop_tokenizer_process()
+        return False
+
+
+def _stop_tokenizer_process():
+    proc, TOKENIZER.process = TOKENIZER.process, None
+    if proc is not None:
+        logger.info("Stopping tokenizer service...")
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def stop_tokenizer():
+    """Stop the tokenizer service if we started it."""
+    with TOKENIZER.lock:
+        TOKENIZER.wanted = False
+        _stop_tokenizer_process()
+
+
+def _probe_instance(rt):
+    """Refresh the cached liveness/readiness/busy state of one runtime.
+
+    Uses the mock's side-effect-free /api/status when available. The C++
+    server has no such route (404), so for it we fall back to a TCP connect
+    and our own bookkeeping for busy/last-token. Never calls /api/stop.
+    """
+    now = time.time()
+    if not rt.alive():
+        rt.healthy = False
+        rt.busy = False
+        rt.probed_at = now
+        return
+
+    ready = False
+    busy = rt.inflight > 0
+    if rt.status_api is not False:
+        try:
+            resp = requests.get(f"{rt.url}/api/status", timeout=PROBE_TIMEOUT)
+            if resp.status_code == 404:
+                rt.status_api = False
+                ready = True
+            elif resp.ok:
+                rt.status_api = True
+                status = resp.json()
+                ready = status.get("ready", True)
+                busy = status.get("busy", busy)
+                if status.get("last_token_at"):
+                    rt.last_token_at = max(rt.last_token_at or 0.0, status["last_token_at"])
+        except requests.RequestException:
+            ready = False
+    else:
+        ready = _port_open(rt)
+
+    rt.busy = busy
+    rt.probed_at = now
+    if not rt.restarting:
+        rt.healthy = ready
+
+
+def _probe_loop():
+    """Background prober keeping the cached health of every runtime fresh."""
+    while True:
+        with POOL_LOCK:
+            pool = list(RUNTIMES)
+        for rt in pool:
+            if rt.wanted and not rt.restarting:
+                _probe_instance(rt)
+        time.sleep(PROBE_INTERVAL)
+
+
+def _terminate_instance(rt):
+    """Stop one runtime process on purpose (the supervisor leaves it down)."""
+    rt.wanted = False
+    rt.healthy = False
+    rt.session = None
+    _kill_process(rt)
+
+
+def _kill_process(rt):
+    """Terminate a runtime's process, escalating to SIGKILL."""
+    if rt.process:
+        logger.info(f"Stopping runtime {rt.label}...")
+        rt.process.terminate()
+        try:
+            rt.process.wait(timeout=5)
         except subprocess.TimeoutExpired:
-            logger.warning("Runtime did not exit gracefully, killing...")
-            RUNTIME_PROCESS.kill()
-        RUNTIME_PROCESS = None
+            logger.warning(f"Runtime {rt.label} did not exit gracefully, killing...")
+            rt.process.kill()
+        rt.process = None
+
+
+def _mark_down(rt, reason):
+    """Record that a runtime stopped serving and schedule its restart."""
+    now = time.time()
+    rt.healthy = False
+    rt.session = None
+    rt.process = None
+    if rt.down_since is None:
+        rt.down_since = now
+    # Back off harder if it died soon after its last start
+    if rt.started_at and now - rt.started_at >= RESTART_STABLE_AFTER:
+        rt.backoff = RESTART_BACKOFF_INITIAL
+    rt.next_restart = now + rt.backoff
+    logger.error(f"Runtime {rt.label} down ({reason}); restarting in {rt.backoff:.1f}s")
+    rt.backoff = min(rt.backoff * 2, RESTART_BACKOFF_MAX)
+
+
+def _stalled_for(rt, now):
+    """Seconds a busy runtime has gone without output (0 if it is not busy).
+
+    Busy means a request is generating on it, or (mock) its /api/status
+    still reports a generation the proxy has given up on.
+    """
+    if rt.generating_since is None and not (rt.status_api and rt.busy):
+        return 0.0
+    return now - max(rt.generating_since or 0.0, rt.last_token_at or 0.0)
+
+
+def _mark_wedged(rt, reason):
+    """Kill a runtime that stopped making progress; the supervisor restarts it."""
+    if rt.process is None:
+        return
+    rt.stalls += 1
+    logger.error(f"Runtime {rt.label} is wedged ({reason}); killing it")
+    _kill_process(rt)
+    _mark_down(rt, f"wedged: {reason}")
+
+
+def _restart_instance(rt):
+    """Relaunch a crashed runtime (runs on its own thread)."""
+    try:
+        ok = _launch_instance(rt)
+        if not rt.wanted:
+            # Stopped (e.g. /load) while we were relaunching
+            _terminate_instance(rt)
+            return
+        if ok:
+            rt.restarts += 1
+            rt.downtime += time.time() - rt.down_since
+            logger.info(f"Runtime {rt.label} restarted after {time.time() - rt.down_since:.1f}s down "
+                        f"(restart #{rt.restarts})")
+            rt.down_since = None
+        else:
+            _mark_down(rt, "restart failed")
+    finally:
+        rt.restarting = False
+
+
+def _supervise():
+    """Liveness loop: detect dead runtimes and restart them with backoff."""
+    while True:
+        time.sleep(SUPERVISOR_INTERVAL)
+        with POOL_LOCK:
+            pool = list(RUNTIMES)
+        now = time.time()
+        for rt in pool:
+            if not rt.wanted or rt.restarting:
+                continue
+            proc = rt.process
+            if proc is not None and proc.poll() is not None:
+                rt.crashes += 1
+                tail = " | ".join(list(rt.output_tail)[-5:])
+                _mark_down(rt, f"exit code {proc.returncode}; last output: {tail}")
+            elif proc is not None and _stalled_for(rt, now) > RUNTIME_STALL_TIMEOUT:
+                # A hung runtime keeps its process and port; only its output stops
+                _mark_wedged(rt, f"busy with no output for {_stalled_for(rt, now):.0f}s")
+            elif proc is None and now >= rt.next_restart:
+                rt.restarting = True
+                threading.Thread(target=_restart_instance, args=(rt,), daemon=True).start()
+
+        if TOKENIZER.wanted and TOKENIZER.process is not None and TOKENIZER.process.poll() is not None:
+            TOKENIZER.crashes += 1
+            logger.error(f"Tokenizer service exited with code {TOKENIZER.process.returncode}; last output: "
+                         f"{' | '.join(list(TOKENIZER.output_tail)[-5:])}")
+            TOKENIZER.process = None
+            threading.Thread(target=start_tokenizer, daemon=True).start()
+
+        # keep_alive expiry: unload idle models whose time is up
+        for model in MODELS.resident():
+            if model.expired(now) and not model.unloading and not any(rt.inflight for rt in pool if rt.model is model):
+                model.unloading = True
+                threading.Thread(target=unload_model, args=(model, "keep_alive expired"), daemon=True).start()
+
+
+SUPERVISOR_THREAD = None
+PROBE_THREAD = None
+
+def _ensure_supervisor():
+    global SUPERVISOR_THREAD, PROBE_THREAD
+    if SUPERVISOR_THREAD is None:
+        SUPERVISOR_THREAD = threading.Thread(target=_supervise, name="runtime-supervisor", daemon=True)
+        SUPERVISOR_THREAD.start()
+    if PROBE_THREAD is None:
+        PROBE_THREAD = threading.Thread(target=_probe_loop, name="runtime-prober", daemon=True)
+        PROBE_THREAD.start()
+
+
+def _warm_instance(rt):
+    """Prime a fresh runtime before it takes traffic.
+
+    A reset pulls the tokenizer and KV setup through once, and leaves an
+    empty conversation resident that the first request can continue.
+    """
+    try:
+        requests.post(f"{rt.url}/api/reset", json={"system_prompt": ""}, timeout=30)
+        rt.session = {"system": "", "turns": []}
+    except requests.RequestException as e:
+        logger.warning(f"Warm-up of runtime {rt.label} failed: {e}")
+
+
+def _spawn_model(model):
+    """Launch and warm runtimes for `model` without routing traffic to them.
+
+    Returns the instances that came up (possibly empty).
+    """
+    devices = _plan_slots(_real_binary() is not None)
+    ports = _free_ports(len(devices))
+    pool = [RuntimeInstance(i, device, port, model) for i, (device, port) in enumerate(zip(devices, ports))]
+
+    # Launch slots in parallel; model load dominates startup time
+    def launch(rt):
+        if _launch_instance(rt):
+            _warm_instance(rt)
+    threads = [threading.Thread(target=launch, args=(rt,)) for rt in pool]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return pool
+
+
+def _stop_instances(instances):
+    with POOL_LOCK:
+        for rt in instances:
+            if rt in RUNTIMES:
+                RUNTIMES.remove(rt)
+    for rt in instances:
+        _terminate_instance(rt)
+
+
+def unload_model(model, reason="requested"):
+    """Stop every runtime serving `model`."""
+    with RESIDENCY_LOCK:
+        try:
+            # A request may have renewed the keep_alive while we waited
+            if not model.resident or (reason == "keep_alive expired" and not model.expired()):
+                return
+            with POOL_LOCK:
+                instances = [rt for rt in RUNTIMES if rt.model is model]
+            logger.info(f"Unloading {model.name} ({reason})")
+            _stop_instances(instances)
+            model.resident = False
+            model.expires_at = None
+            SWITCH_STATS["unloads"] += 1
+            with POOL_LOCK:
+                idle = not RUNTIMES
+            if idle:
+                # Nothing left to tokenize for
+                stop_tokenizer()
+        finally:
+            model.unloading = False
+
+
+def ensure_resident(model):
+    """Make sure `model` has runtimes in the pool, loading it if needed.
+
+    When the model fits next to what is resident (memory budget, and the
+    runtimes can use separate ports) its runtimes are pre-spawned and warmed
+    while the current ones keep serving, so there is no service gap. If
+    idle models must make room first, they are stopped before the load and
+    the gap is recorded as downtime.
+    """
+    with RESIDENCY_LOCK:
+        if model.resident:
+            return True
+
+        with POOL_LOCK:
+            busy = {rt.model.name for rt in RUNTIMES if rt.inflight}
+        evict = MODELS.plan_evictions(model, busy)
+        if evict is None:
+            logger.error(f"{model.name} ({model.size_bytes / 2**20:.0f} MiB) does not fit the "
+                         f"{MEMORY_BUDGET_MB} MiB budget while other models are busy")
+            return False
+        if not _colocation_possible():
+            # Fixed-port runtime: nothing else can stay up during the load
+            evict = MODELS.resident()
+        hot = not evict
+
+        t0 = time.time()
+        gap_start = None
+        if evict:
+            gap_start = time.time()
+            for other in evict:
+                with POOL_LOCK:
+                    instances = [rt for rt in RUNTIMES if rt.model is other]
+                logger.info(f"Evicting {other.name} to make room for {model.name}")
+                _stop_instances(instances)
+                other.resident = False
+                SWITCH_STATS["unloads"] += 1
+
+        logger.info(f"Loading {model.name} ({'pre-spawned' if hot else 'cold'})")
+        pool = _spawn_model(model)
+        up = [rt for rt in pool if rt.healthy]
+        # Slots that failed to come up are left to the supervisor to retry
+        for rt in pool:
+            if not rt.healthy:
+                _mark_down(rt, "initial launch failed")
+
+        with POOL_LOCK:
+            RUNTIMES.extend(pool)
+        _ensure_supervisor()
+
+        load_s = time.time() - t0
+        downtime = (time.time() - gap_start) if gap_start is not None else 0.0
+        model.resident = True
+        model.loaded_at = time.time()
+        model.touch(DEFAULT_KEEP_ALIVE)
+        SWITCH_STATS["loads"] += 1
+        SWITCH_STATS["hot" if hot else "cold"] += 1
+        SWITCH_STATS["downtime_s"] += downtime
+        SWITCH_STATS["last"] = {
+            "model": model.name,
+            "mode": "hot" if hot else "cold",
+            "evicted": [m.name for m in evict],
+            "load_s": round(load_s, 3),
+            "downtime_s": round(downtime, 3),
+            "runtimes_up": len(up),
+            "at": model.loaded_at
+        }
+        logger.info(f"{model.name} ready: {len(up)}/{len(pool)} runtimes in {load_s:.2f}s "
+                    f"(downtime {downtime:.2f}s)")
+        return bool(up)
+
+
+def start_runtime(model_path=None):
+    """Start the runtime pool (C++ servers or mocks) for the default model.
+
+    Returns True if at least one runtime came up.
+    """
+    global CURRENT_MODEL_PATH
+
+    if model_path:
+        CURRENT_MODEL_PATH = model_path
+    model = MODELS.register(DEFAULT_MODEL_NAME, CURRENT_MODEL_PATH)
+    return ensure_resident(model)
+
+
+def stop_runtime():
+    """Stop all C++ inference servers."""
+    with POOL_LOCK:
+        pool = list(RUNTIMES)
+    _stop_instances(pool)
+    for model in MODELS.resident():
+        model.resident = False
+    stop_tokenizer()
+
+
+def _request_messages(data):
+    """Normalize a /generate payload into a list of chat messages.
+
+    Chat callers pass `messages`; plain completions are treated as a single
+    user turn so they never match a previous conversation by accident.
+    """
+    messages = data.get("messages")
+    if messages:
+        return [{"role": m.get("role", "user"), "content": m.get("content", "")} for m in messages]
+    return [{"role": "user", "content": data.get("prompt", "")}]
+
+def _render_messages(messages):
+    """Flatten messages into a single prompt (same format as the Ollama proxy)."""
+    if len(messages) == 1 and messages[0]["role"] == "user":
+        return messages[0]["content"]
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+def _estimate_tokens(text):
+    """Rough token estimate (~4 chars/token for Qwen BPE on English text)."""
+    return (len(text) + 3) // 4
+
+def _split_system(messages):
+    """Return (system_prompt, turns) for a message list."""
+    if messages and messages[0]["role"] == "system":
+        return messages[0]["content"], messages[1:]
+    return "", messages
+
+def _continues(resident, system_prompt, turns):
+    """True if `turns` append exactly one user turn to the resident session."""
+    if not SESSION_AFFINITY or resident is None or resident["system"] != system_prompt:
+        return False
+    n = len(resident["turns"])
+    suffix = turns[n:]
+    # Only a single appended user turn can go through the stateful path;
+    # anything else (edited history, injected assistant turns) diverges.
+    return turns[:n] == resident["turns"] and len(suffix) == 1 and suffix[0]["role"] == "user"
+
+def _plan_turn(rt, messages):
+    """Decide whether the request can continue the conversation resident in `rt`.
+
+    Returns (needs_reset, system_prompt, prompt, turns) where `prompt` is the
+    text to send to /api/generate and `turns` is the full non-system history.
+    """
+    system_prompt, turns = _split_system(messages)
+    if _continues(rt.session, system_prompt, turns):
+        return False, system_prompt, turns[-1]["content"], turns
+    return True, system_prompt, _render_messages(turns), turns
+
+
+def acquire_runtime(model, messages):
+    """Pick the least-loaded healthy runtime of `model` and reserve it.
+
+    Among equally loaded runtimes, one already holding the conversation is
+    preferred so it can skip the reset. Returns None if none is healthy.
+    """
+    system_prompt, turns = _split_system(messages)
+    with POOL_LOCK:
+        candidates = [rt for rt in RUNTIMES if rt.model is model and rt.healthy and rt.alive()]
+        if not candidates:
+            return None
+        rt = min(candidates, key=lambda r: (r.inflight,
+                                            not _continues(r.session, system_prompt, turns),
+                                            r.served))
+        rt.inflight += 1
+        return rt
+
+def release_runtime(rt):
+    with POOL_LOCK:
+        rt.inflight -= 1
+        rt.served += 1
+
+
+def _sampling_params(data):
+    """Sampling parameters of a /generate payload, with the runtime defaults."""
+    return {
+        "max_tokens": data.get("max_tokens", 128),
+        "temperature": data.get("temperature", 0.8),
+        "top_p": data.get("top_p", 0.9),
+        "top_k": data.get("top_k", 40),
+        "seed": data.get("seed")
+    }
 
 @APP.route("/generate", methods=["POST"])
 def proxy_generate():
-    """Handle generation request from Ollama adapter."""
+    """Handle generation request from Ollama adapter.
+
+    With `"stream": true` the text comes back as NDJSON chunks while the
+    runtime produces it; otherwise as a single {"text": ...} object.
+    """
     data = request.get_json(force=True)
-    prompt = data.get("prompt", "")
-    
-    # 1. Reset Runtime State (Stateless behavior)
+    arrival, t_arrival = time.time(), time.perf_counter()
+    flight, leader = open_flight(data)
+    if data.get("stream"):
+        if leader:
+            threading.Thread(target=fly, args=(flight, data), daemon=True).start()
+        return Response(_ndjson(flight, leader, data, arrival, t_arrival), mimetype="application/x-ndjson")
+    if leader:
+        fly(flight, data)
+    try:
+        result = _flight_result(flight, leader)
+    except GenerationError as e:
+        _capture(data, arrival, t_arrival, error=e)
+        return jsonify({"error": str(e)}), e.status
+    _capture(data, arrival, t_arrival, result=result)
+    return jsonify(result)
+
+def _flight_result(flight, leader):
+    """The flight's outcome for one subscriber; counts it in the metrics."""
+    try:
+        result = flight.wait()
+    except GenerationError as e:
+        REQUESTS.labels("error").inc()
+        ERRORS.labels(e.status).inc()
+        raise
+    if result.get("cached"):
+        REQUESTS.labels("cached").inc()
+    elif not leader:
+        REQUESTS.labels("coalesced").inc()
+        result = dict(result, coalesced=True)
+    else:
+        REQUESTS.labels("ok").inc()
+    return result
+
+def _ndjson(flight, leader, data, arrival, t_arrival):
+    t_first = None
     try:
-        # We send empty system prompt to clear context
-        requests.post(f"{RUNTIME_URL}/api/reset", json={"system_prompt": ""}, timeout=5)
+        for chunk in flight.stream():
+            if t_first is None:
+                t_first = time.perf_counter()
+            yield json.dumps({"response": chunk, "done": False}) + "\n"
+        result = _flight_result(flight, leader)
+        _capture(data, arrival, t_arrival, result=result, t_first=t_first)
+        yield json.dumps(dict(result, done=True)) + "\n"
+    except GenerationError as e:
+        _capture(data, arrival, t_arrival, error=e, t_first=t_first)
+        yield json.dumps({"error": str(e), "status": e.status, "done": True}) + "\n"
+    except GeneratorExit:
+        # The client went away; the generation itself runs to completion
+        CANCELLATIONS.inc()
+        _capture(data, arrival, t_arrival, t_first=t_first, outcome="cancelled")
+        raise
+
+def _capture(data, arrival, t_arrival, result=None, error=None, t_first=None, outcome=None):
+    """Append a finished /generate request to the capture file, if enabled."""
+    if CAPTURE is None:
+        return
+    result = result or {}
+    metrics = result.get("metrics") or {}
+    params = _sampling_params(data)
+    if outcome is None:
+        outcome = ("error" if error is not None else "cached" if result.get("cached")
+                   else "coalesced" if result.get("coalesced") else "ok")
+    eval_count = metrics.get("eval_count")
+    try:
+        CAPTURE.record(
+            _request_messages(data), arrival=arrival, endpoint="/generate",
+            request_id=result.get("request_id") or data.get("request_id"),
+            model=data.get("model"), stream=bool(data.get("stream")), chat=bool(data.get("messages")),
+            params=params, keep_alive=data.get("keep_alive"), outcome=outcome,
+            status=error.status if error is not None else 499 if outcome == "cancelled" else 200,
+            duration_s=round(time.perf_counter() - t_arrival, 6),
+            ttft_s=round(t_first - t_arrival, 6) if t_first is not None else None,
+            prompt_tokens=metrics.get("prompt_eval_count"), eval_tokens=eval_count,
+            stop_reason=None if eval_count is None else ("length" if eval_count >= params["max_tokens"] else "stop"))
     except Exception as e:
-        logger.error(f"Failed to reset runtime: {e}")
-        return jsonify({"error": f"Failed to reset runtime: {e}"}), 500
-        
-    # 2. Start Generation
+        logger.warning(f"Request capture failed: {e}")
+
+def open_flight(data):
+    """Find or start the Flight that will serve this request.
+
+    Returns (flight, leader); a leader must run the flight with fly().
+    Deterministic requests attach to an identical one already in flight;
+    cache hits come back as flights that have already finished.
+
+    Only requests without earlier assistant turns qualify: a conversation
+    either continues the runtime's resident context or is reset and sent
+    flattened, depending on routing, and the two can answer differently.
+    """
+    model = MODELS.get(data.get("model"))
+    params = _sampling_params(data)
+    messages = _request_messages(data)
+    if not is_deterministic(params) or any(m.get("role") == "assistant" for m in messages):
+        return Flight(), True
+    key = cache_key(model.name, model.path, messages, params)
+
+    if RESPONSE_CACHE is not None and data.get("cache", True):
+        cached = RESPONSE_CACHE.get(key)
+        if cached is not None:
+            model.touch(parse_keep_alive(data.get("keep_alive"), DEFAULT_KEEP_ALIVE))
+            flight = Flight(key)
+            flight.publish(cached["text"])
+            # Nothing ran, so only the token counts carry over
+            flight.finish({"text": cached["text"], "cached": True,
+                           "metrics": _metrics(cached.get("metrics", {}), cached=True)})
+            return flight, False
+
+    if not COALESCE:
+        return Flight(key), True
+    flight, leader = FLIGHTS.join(key)
+    if not leader:
+        logger.info(f"Coalescing request into in-flight generation ({flight.subscribers} subscribers)")
+    return flight, leader
+
+def fly(flight, data):
+    """Run a leader's generation and hand the outcome to every subscriber."""
     try:
-        # Forward parameters
-        # Map Ollama/Adapter params to C++ server params if needed
-        # Adapter sends: prompt, max_tokens
-        # C++ expects: prompt, max_tokens, temperature, top-p, top-k
-        payload = {
-            "prompt": prompt,
-            "max_tokens": data.get("max_tokens", 128),
-            "temperature": data.get("temperature", 0.8),
-            "top-p": data.get("top_p", 0.9),
-            "top-k": data.get("top_k", 40)
-        }
-        requests.post(f"{RUNTIME_URL}/api/generate", json=payload, timeout=5)
+        flight.finish(run_generation(data, flight))
+    except GenerationError as e:
+        flight.finish(error=e)
     except Exception as e:
-        logger.error(f"Failed to start generation: {e}")
-        return jsonify({"error": f"Failed to start generation: {e}"}), 500
-        
+        # Subscribers must never be left waiting on a flight that died
+        logger.exception("Generation failed")
+        flight.finish(error=GenerationError(f"Internal error: {e}"))
+    finally:
+        FLIGHTS.land(flight)
+
+def run_generation(data, flight):
+    """Serve one /generate payload, publishing chunks to `flight`.
+
+    Returns {"text", "metrics", "request_id"} or raises GenerationError.
+    """
+    t_start = time.perf_counter()
+    load_s = 0.0
+    request_id = data.get("request_id") or str(uuid.uuid4())
+    spans = tracing.parse_level(data.get("trace"), TRACE_LEVEL) >= tracing.SUMMARY
+    messages = _request_messages(data)
+    model = MODELS.get(data.get("model"))
+    keep_alive = parse_keep_alive(data.get("keep_alive"), DEFAULT_KEEP_ALIVE)
+    params = _sampling_params(data)
+
+    last_error = None
+    for attempt in range(1 + REQUEST_RETRIES):
+        # Cold-load the model if it isn't resident (or was unloaded meanwhile)
+        if not model.resident:
+            t_load0 = time.perf_counter()
+            loaded = ensure_resident(model)
+            t_load1 = time.perf_counter()
+            load_s += t_load1 - t_load0
+            if spans:
+                tracing.SPANS.add("load", request_id, t_load0, t_load1, cat="proxy", args={"model": model.name})
+            if not loaded:
+                raise GenerationError(f"Failed to load model {model.name}", 503)
+        model.touch(keep_alive)
+        rt = acquire_runtime(model, messages)
+        if rt is None:
+            break
+        try:
+            t_queued = time.perf_counter()
+            QUEUE_DEPTH.inc()
+            try:
+                rt.lock.acquire()
+            finally:
+                QUEUE_DEPTH.dec()
+            try:
+                t_dequeued = time.perf_counter()
+                QUEUE_WAIT.observe(t_dequeued - t_queued)
+                if spans:
+                    tracing.SPANS.add("queue", request_id, t_queued, t_dequeued, cat="proxy",
+                                      args={"runtime": rt.label})
+                rt.generating_since = time.time()
+                result = _generate_on(rt, params, messages, flight, request_id, data.get("trace"))
+            finally:
+                rt.generating_since = None
+                rt.lock.release()
+            metrics = result["metrics"]
+            metrics["total_duration"] = int((time.perf_counter() - t_start) * 1e9)
+            metrics["load_duration"] = metrics.get("load_duration", 0) + int(load_s * 1e9)
+            _observe_generation(result, t_start)
+            if spans:
+                tracing.SPANS.add("request", request_id, t_start, time.perf_counter(), cat="proxy",
+                                  args={"model": model.name, "runtime": rt.label})
+            # Only complete generations are reproducible
+            if (flight.key is not None and result["completed"]
+                    and RESPONSE_CACHE is not None and data.get("cache", True)):
+                RESPONSE_CACHE.put(flight.key, {"text": result["text"], "model": model.name,
+                                                "metrics": metrics, "created_at": time.time()})
+            return {"text": result["text"], "metrics": metrics, "request_id": request_id}
+        except RuntimeCrashed as e:
+            last_error = e
+            logger.warning(f"Runtime {rt.label} crashed during request (attempt {attempt + 1}): {e}")
+            # Re-run the whole request on whichever runtime is healthy now,
+            # unless part of the text was already streamed to a client.
+            if not flight.rewind():
+                raise GenerationError(f"Runtime crashed mid-stream: {e}", 502)
+        finally:
+            release_runtime(rt)
+            # keep_alive counts from the end of the request, as in Ollama
+            model.touch(keep_alive)
+
+    if last_error is not None:
+        raise GenerationError(f"Runtime crashed during generation: {last_error}", 502)
+    raise GenerationError("No healthy runtime available", 503)
+
+def _response_error(resp):
+    try:
+        return str(resp.json().get("error") or resp.text)
+    except ValueError:
+        return resp.text[:200] or f"HTTP {resp.status_code}"
+
+
+def _runtime_post(rt, epoch, path, payload, what):
+    """POST to a reserved runtime, retrying while it reports "llm is running".
+
+    Raises RuntimeCrashed if the runtime died, GenerationError if it failed
+    or refused. Either way rt.session is cleared: the runtime's context is
+    no longer known.
+    """
+    deadline = time.time() + RUNTIME_BUSY_RETRY
+    delay = 0.05
+    while True:
+        try:
+            resp = requests.post(f"{rt.url}{path}", json=payload, timeout=5)
+        except Exception as e:
+            rt.session = None
+            if not rt.alive(epoch):
+                raise RuntimeCrashed(f"{rt.label} died during {path}: {e}")
+            logger.error(f"Failed to {what} on {rt.label}: {e}")
+            raise GenerationError(f"Failed to {what}: {e}")
+        if resp.ok:
+            return resp
+        rt.session = None
+        error = _response_error(resp)
+        busy = "running" in error
+        if busy and time.time() + delay < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            continue
+        logger.error(f"Runtime {rt.label} refused to {what}: HTTP {resp.status_code} {error}")
+        raise GenerationError(f"Failed to {what}: {error}", 503 if busy else 502)
+
+
+def _generate_on(rt, params, messages, flight, request_id, trace=None):
+    """Run one generation on a reserved runtime (caller holds rt.lock).
+
+    Chunks are published to `flight` as they arrive. Returns {"text",
+    "completed", "metrics", "first_chunk_at"}. Raises RuntimeCrashed if the
+    runtime dies (or is restarted) meanwhile, GenerationError for other
+    failures.
+    """
+    # Fail fast if it died while this request was queued behind the lock
+    epoch = rt.epoch
+    if not rt.alive(epoch):
+        raise RuntimeCrashed(f"{rt.label} is not running")
+
+    needs_reset, system_prompt, prompt, turns = _plan_turn(rt, messages)
+    t_start = time.perf_counter()
+    level = tracing.parse_level(trace, TRACE_LEVEL)
+    add_span = tracing.SPANS.add if level >= tracing.SUMMARY else None
+    with POOL_LOCK:
+        SESSION_STATS["requests"] += 1
+
+    # 1. Reset Runtime State only when the conversation diverged
+    if needs_reset:
+        rt.session = None
+        _runtime_post(rt, epoch, "/api/reset", {"system_prompt": system_prompt}, "reset runtime")
+        if add_span:
+            add_span("reset", request_id, t_start, time.perf_counter(), cat="proxy")
+        with POOL_LOCK:
+            SESSION_STATS["resets"] += 1
+    else:
+        avoided = _estimate_tokens(_render_messages(rt.session["turns"]))
+        with POOL_LOCK:
+            SESSION_STATS["prefill_tokens_avoided"] += avoided
+        logger.info(f"Continuing resident session on {rt.label} ({len(turns) - 1} turns, ~{avoided} prefill tokens skipped)")
+
+    # 2. Start Generation
+    # Forward parameters
+    # Map Ollama/Adapter params to C++ server params if needed
+    # Adapter sends: prompt, max_tokens
+    # C++ expects: prompt, max_tokens, temperature, top-p, top-k
+    payload = {
+        "prompt": prompt,
+        "max_tokens": params["max_tokens"],
+        "temperature": params["temperature"],
+        "top-p": params["top_p"],
+        "top-k": params["top_k"]
+    }
+    if params["seed"] is not None:
+        payload["seed"] = params["seed"]
+    if trace is not None:
+        # Engine trace level (off/summary/step/tensors); the mock honours it
+        payload["trace"] = trace
+    payload["request_id"] = request_id
+    t_post0 = time.perf_counter()
+    _runtime_post(rt, epoch, "/api/generate", payload, "start generation")
+    if add_span:
+        add_span("start", request_id, t_post0, time.perf_counter(), cat="proxy")
+
     # 3. Poll for results (Streaming -> Accumulation)
     # Ollama adapter currently expects full text response.
     # We poll the provider until done.
     full_text = ""
-    start_time = time.time()
-    
+    start_time = last_output = time.time()
+    completed = False
+    t_first = t_last = None
+    n_chunks = 0
+    runtime_metrics = None
+
     while True:
+        if not rt.alive(epoch):
+            rt.session = None
+            raise RuntimeCrashed(f"{rt.label} died mid-generation")
         try:
-            resp = requests.get(f"{RUNTIME_URL}/api/generate_provider", timeout=5)
+            t_poll0 = time.perf_counter()
+            resp = requests.get(f"{rt.url}/api/generate_provider", timeout=5)
+            if level >= tracing.STEP:
+                add_span("poll", request_id, t_poll0, time.perf_counter(), cat="proxy")
             if resp.status_code != 200:
-                logger.error(f"Provider returned status {resp.status_code}")
-                break
-                
+                rt.session = None
+                logger.error(f"Provider on {rt.label} returned status {resp.status_code}")
+                raise GenerationError(f"Runtime failed mid-generation: {_response_error(resp)}", 502)
+
             rdata = resp.json()
             chunk = rdata.get("response", "")
+            # A failure is not an answer: fail before publishing it, so it
+            # is never streamed, coalesced onto, cached or kept as context
+            error = rdata.get("error")
+            if error is None and not full_text and chunk.startswith(RUNTIME_ERROR_PREFIXES):
+                error = chunk
+            if error:
+                rt.session = None
+                logger.error(f"Generation on {rt.label} failed: {error}")
+                raise GenerationError(f"Runtime error: {error}", 502)
             full_text += chunk
-            
+            if chunk:
+                rt.last_token_at = last_output = time.time()
+                t_chunk = time.perf_counter()
+                if t_first is None:
+                    t_first = t_chunk
+                else:
+                    TOKEN_SECONDS.observe(t_chunk - t_last)
+                t_last = t_chunk
+                n_chunks += 1
+                flight.publish(chunk)
+
             if rdata.get("done", False):
+                completed = True
+                runtime_metrics = rdata.get("metrics")
                 break
-                
-            # Timeout safety
-            if time.time() - start_time > 120: # 2 min timeout
-                logger.error("Generation timed out")
-                break
-                
+
+            # A truncated text is not an answer: time out as an error
+            now = time.time()
+            if now - last_output > RUNTIME_STALL_TIMEOUT:
+                rt.session = None
+                _mark_wedged(rt, f"no output for {now - last_output:.0f}s")
+                raise GenerationError(f"Runtime stopped producing output for {now - last_output:.0f}s", 504)
+            if now - start_time > GENERATION_TIMEOUT:
+                rt.session = None
+                logger.error(f"Generation on {rt.label} timed out after {GENERATION_TIMEOUT:.0f}s")
+                try:
+                    requests.get(f"{rt.url}/api/stop", timeout=PROBE_TIMEOUT)
+                except requests.RequestException:
+                    pass
+                raise GenerationError(f"Generation timed out after {GENERATION_TIMEOUT:.0f}s", 504)
+
             time.sleep(0.05) # Poll interval
-            
+
+        except GenerationError:
+            raise
         except Exception as e:
-            logger.error(f"Error polling generation: {e}")
-            return jsonify({"error": f"Error polling generation: {e}"}), 500
-            
-    return jsonify({"text": full_text})
+            rt.session = None
+            if not rt.alive(epoch):
+                raise RuntimeCrashed(f"{rt.label} died mid-generation: {e}")
+            logger.error(f"Error polling generation on {rt.label}: {e}")
+            raise GenerationError(f"Error polling generation: {e}")
+
+    # The runtime now holds this exchange
+    rt.session = {
+        "system": system_prompt,
+        "turns": turns + [{"role": "assistant", "content": full_text}]
+    }
+
+    first_chunk_at = t_first
+    if add_span:
+        add_span("stream", request_id, t_post0, time.perf_counter(), cat="proxy",
+                 args={"chunks": n_chunks, "completed": completed})
+    if runtime_metrics:
+        metrics = _metrics(runtime_metrics, source="runtime")
+    else:
+        # The C++ server reports no timings: use what the proxy saw. The
+        # runtime pushes one chunk per token; the prompt count is estimated.
+        t_end = time.perf_counter()
+        t_first = t_first or t_end
+        metrics = _metrics({
+            "prompt_eval_count": _estimate_tokens(prompt),
+            "prompt_eval_duration": int((t_first - t_start) * 1e9),
+            "eval_count": n_chunks,
+            "eval_duration": int((t_end - t_first) * 1e9)
+        }, source="proxy")
+    return {"text": full_text, "completed": completed, "metrics": metrics,
+            "first_chunk_at": first_chunk_at}
+
+def _observe_generation(result, t_start):
+    """Record a finished generation in the Prometheus metrics."""
+    metrics = result["metrics"]
+    if result["first_chunk_at"] is not None:
+        TTFT.observe(result["first_chunk_at"] - t_start)
+    if metrics["prompt_eval_duration"] > 0:
+        PREFILL_RATE.observe(metrics["prompt_eval_count"] / (metrics["prompt_eval_duration"] / 1e9))
+    TOKENS.labels("prompt").inc(metrics["prompt_eval_count"])
+    TOKENS.labels("eval").inc(metrics["eval_count"])
+
+def _metrics(values, source=None, cached=False):
+    """Ollama timing/count fields (durations in ns), plus any engine extras."""
+    metrics = {field: 0 for field in ("total_duration", "load_duration", "prompt_eval_count",
+                                      "prompt_eval_duration", "eval_count", "eval_duration")}
+    if cached:
+        metrics.update({k: values[k] for k in ("prompt_eval_count", "eval_count") if k in values})
+        metrics["source"] = "cache"
+        return metrics
+    metrics.update(values)
+    metrics["source"] = source
+    return metrics
+
+def _session_report():
+    """Snapshot of session-affinity counters for /health."""
+    n = SESSION_STATS["requests"]
+    return {
+        "affinity": SESSION_AFFINITY,
+        "requests": n,
+        "resets": SESSION_STATS["resets"],
+        "reset_rate": (SESSION_STATS["resets"] / n) if n else 0.0,
+        "prefill_tokens_avoided": SESSION_STATS["prefill_tokens_avoided"]
+    }
 
 @APP.route("/load", methods=["POST"])
 def proxy_load():
-    """Handle model load request."""
+    """Handle model load request.
+
+    `model_path` loads (and registers) a model directory and makes it the
+    default; `model` alone preloads an already registered model. The new
+    runtimes are warmed before traffic moves, and the previous model stays
+    resident while keep_alive and the memory budget allow.
+    """
+    global CURRENT_MODEL_PATH
     data = request.get_json(force=True)
     path = data.get("model_path")
+    name = data.get("model")
+    keep_alive = parse_keep_alive(data.get("keep_alive"), DEFAULT_KEEP_ALIVE)
+
     if path:
-        logger.info(f"Reloading model: {path}")
-        if start_runtime(path):
-            return jsonify({"status": "loaded", "model": path})
-        else:
-            return jsonify({"status": "error", "message": "Failed to start runtime"}), 500
-    return jsonify({"status": "ok", "model": CURRENT_MODEL_PATH})
+        name = normalize_name(name or os.path.basename(os.path.normpath(path)))
+        old = MODELS.models.get(name)
+        if old is not None and old.path != path and old.resident:
+            # Same name, new files: the old runtimes can't be kept
+            unload_model(old, f"replaced by {path}")
+        model = MODELS.register(name, path)
+    elif name:
+        model = MODELS.get(name)
+    else:
+        return jsonify({"status": "ok", "model": CURRENT_MODEL_PATH})
+
+    logger.info(f"Loading model: {model.name} ({model.path})")
+    if not ensure_resident(model):
+        return jsonify({"status": "error", "message": "Failed to start runtime"}), 500
+    model.touch(keep_alive)
+    if path:
+        MODELS.default_name = model.name
+        CURRENT_MODEL_PATH = path
+        # New weights: cached responses no longer describe what we'd generate
+        if RESPONSE_CACHE is not None:
+            RESPONSE_CACHE.clear()
+    return jsonify({"status": "loaded", "model": model.path, "name": model.name,
+                    "switch": SWITCH_STATS["last"]})
+
+@APP.route("/unload", methods=["POST"])
+def proxy_unload():
+    """Unload a model now (Ollama's keep_alive: 0 with an empty prompt)."""
+    data = request.get_json(force=True, silent=True) or {}
+    model = MODELS.get(data.get("model"))
+    if model is None:
+        return jsonify({"status": "error", "message": "Unknown model"}), 404
+    unload_model(model)
+    return jsonify({"status": "unloaded", "name": model.name})
+
+@APP.route("/models", methods=["GET"])
+def list_models():
+    """Registered models and what is actually resident (for /api/tags, /api/ps)."""
+    models = []
+    for model in MODELS.models.values():
+        info = model.describe()
+        info["default"] = model.name == MODELS.default_name
+        models.append(info)
+    return jsonify({
+        "models": models,
+        "budget_bytes": MODELS.budget_bytes,
+        "switching": SWITCH_STATS
+    })
 
 @APP.route("/health", methods=["GET"])
 def health_check():
-    """Proxy health check."""
-    runtime_up = False
-    try:
-        requests.get(f"{RUNTIME_URL}/api/stop", timeout=0.5)
-        runtime_up = True
-    except:
-        pass
-        
+    """Proxy health check, answered from the prober's cached state."""
+    with POOL_LOCK:
+        pool = list(RUNTIMES)
+
+    runtimes = [rt.describe() for rt in pool]
     return jsonify({
         "status": "ok",
-        "runtime_up": runtime_up,
+        "runtime_up": any(rt.healthy for rt in pool),
+        "runtimes": runtimes,
+        "supervisor": {
+            "crashes": sum(r["crashes"] for r in runtimes),
+            "restarts": sum(r["restarts"] for r in runtimes),
+            "downtime_s": round(sum(r["downtime_s"] for r in runtimes), 3)
+        },
         "model": CURRENT_MODEL_PATH,
-        "mode": "proxy"
+        "resident_models": [m.name for m in MODELS.resident()],
+        "switching": SWITCH_STATS,
+        "mode": "proxy",
+        "tokenizer": TOKENIZER.describe(),
+        "session": _session_report(),
+        "response_cache": RESPONSE_CACHE.report() if RESPONSE_CACHE is not None else None,
+        "coalescing": dict(FLIGHTS.report(), enabled=COALESCE)
     })
 
+@APP.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus metrics for the proxy."""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@APP.route("/trace", methods=["GET"])
+def export_trace():
+    """Chrome/Perfetto trace of the proxy, its runtimes and NPU utilization.
+
+    Filter with ?request_id=..., ?window=<last N seconds>, or ?since=/until=
+    (perf_counter seconds, i.e. CLOCK_MONOTONIC).
+    """
+    request_id = request.args.get("request_id")
+    since = request.args.get("since", type=float)
+    until = request.args.get("until", type=float)
+    window = request.args.get("window", type=float)
+    if window is not None:
+        since = time.perf_counter() - window
+    query = {k: v for k, v in (("request_id", request_id), ("since", since), ("until", until)) if v is not None}
+
+    events = tracing.SPANS.export(request_id, since, until, process_name="ax650 proxy")
+    with POOL_LOCK:
+        pool = list(RUNTIMES)
+    for rt in pool:
+        try:
+            resp = requests.get(f"{rt.url}/trace", params=query, timeout=5)
+            if resp.status_code == 200:
+                events.extend(resp.json().get("traceEvents", []))
+        except Exception as e:
+            logger.warning(f"Could not fetch trace from {rt.label}: {e}")
+    return jsonify(tracing.chrome_trace(events))
+
+@APP.route("/layer_stats", methods=["GET"])
+def layer_stats():
+    """Per-layer NPU latency merged across runtimes (?format=raw for sketches)."""
+    merged = LayerStats()
+    with POOL_LOCK:
+        pool = list(RUNTIMES)
+    for rt in pool:
+        try:
+            resp = requests.get(f"{rt.url}/layer_stats", params={"format": "raw"}, timeout=5)
+            if resp.status_code == 200:
+                merged.merge(LayerStats.from_dict(resp.json()))
+        except Exception as e:
+            logger.warning(f"Could not fetch layer stats from {rt.label}: {e}")
+    if request.args.get("format") == "raw":
+        return jsonify(merged.to_dict())
+    return jsonify(merged.report())
+
+@APP.route("/telemetry", methods=["GET"])
+def telemetry_samples():
+    """Device telemetry history.
+
+    ?since=/until= (epoch seconds) or ?window= (last N seconds), ?device=
+    (card index or "host"), ?format=csv.
+    """
+    since = request.args.get("since", type=float)
+    until = request.args.get("until", type=float)
+    window = request.args.get("window", type=float)
+    if window is not None:
+        since = time.time() - window
+    rows = TELEMETRY.series.query(since, until, request.args.get("device"))
+    if request.args.get("format") == "csv":
+        return Response(telemetry.TimeSeries.to_csv(rows), content_type="text/csv")
+    return jsonify({"interval": TELEMETRY.interval, "samples": rows})
+
+@APP.route("/telemetry/summary", methods=["GET"])
+def telemetry_summary():
+    """min/mean/max/last per device and field over ?since=/?until=/?window=."""
+    since = request.args.get("since", type=float)
+    until = request.args.get("until", type=float)
+    window = request.args.get("window", type=float)
+    if window is not None:
+        since = time.time() - window
+    return jsonify({"devices": TELEMETRY.series.summary(since, until), "read_errors": TELEMETRY.errors})
+
 def main():
     logger.info("="*60)
     logger.info("AX650 Hybrid Proxy Starting")
     logger.info("="*60)
-    
+
+    if TELEMETRY_INTERVAL > 0:
+        if TELEMETRY.source is None:
+            logger.info("axcl-smi not found; device telemetry limited to host CPU")
+        TELEMETRY.start()
+
     # Start runtime on launch
     if not start_runtime():
-        logger.warning("Initial runtime launch failed, will retry on /load")
-    
+        logger.warning("Initial runtime launch failed, supervisor will keep retrying")
+
     try:
         APP.run(host="0.0.0.0", port=PROXY_PORT, debug=False, use_reloader=False)
     finally:
+        TELEMETRY.stop()
         stop_runtime()
 
 if __name__ == "__main__":
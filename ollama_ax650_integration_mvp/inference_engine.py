@@ -9,12 +9,31 @@ import numpy as np
 import torch
 from transformers import AutoTokenizer
 import time
+import threading
 import ml_dtypes
 import uuid
+from metrics_registry import Counter, Gauge, Histogram, RATE_BUCKETS
+import tracing
+from layer_stats import LayerStats, POST_LAYER
+import profiler
+from watchdog import StepWatchdog, StepStalled
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Engine metrics, exposed by whichever server hosts the engine (the mock's /metrics)
+ENGINE_REQUESTS = Counter("ax650_engine_generations_total", "Generations started")
+ENGINE_ERRORS = Counter("ax650_engine_errors_total", "Generations that raised an error")
+ENGINE_TOKENS = Counter("ax650_engine_tokens_total", "Tokens processed", ("phase",))
+ENGINE_TTFT = Histogram("ax650_engine_ttft_seconds", "Time from generate() to the first sampled token")
+ENGINE_TOKEN_SECONDS = Histogram("ax650_engine_token_seconds", "Latency of one decode step")
+ENGINE_PREFILL_RATE = Histogram("ax650_engine_prefill_tokens_per_second", "Prefill throughput",
+                                buckets=RATE_BUCKETS)
+ENGINE_LAYER_SECONDS = Histogram("ax650_engine_layer_seconds", "Time of one layer's NPU call")
+ENGINE_POST_SECONDS = Histogram("ax650_engine_post_seconds", "Time of the post (lm_head) NPU call")
+ENGINE_SAMPLING_SECONDS = Histogram("ax650_engine_sampling_seconds", "Host-side sampling time per step")
+ENGINE_KV_BYTES = Gauge("ax650_engine_kv_cache_bytes", "Host memory held by the KV caches")
+
 class AX650Backend:
     def __init__(self):
         self.impl = None
@@ -26,6 +45,26 @@ class AX650Backend:
         self.tokenizer = None
         self.layers = []
         self.post_model = None
+        # Set (e.g. by /api/stop) to end the running generation after its current step
+        self.stop_requested = False
+        # Timing and token counts of the last generate() call, using Ollama's
+        # field names (durations in ns) plus a per-stage breakdown.
+        self.last_metrics = {}
+        # Why the last generate() call failed (its text is then the error
+        # message, not model output), or None
+        self.last_error = None
+        # Per-layer latency sketches by context position (see layer_stats.py)
+        self.layer_stats = LayerStats() if os.environ.get("AX650_LAYER_STATS", "1") != "0" else None
+        # Default trace level; generate(trace=...) overrides it per request
+        self.tracer = tracing.Tracer(logger, tracing.parse_level(os.environ.get("AX650_TRACE")),
+                                     os.environ.get("AX650_TRACE_DIR", "/tmp"))
+        # Device this engine drives (the proxy sets it per runtime in a pool)
+        self.device_id = int(os.environ.get("AX650_DEVICE_ID", 0))
+        # Stalled-NPU-call detection and recovery (see watchdog.py)
+        self.watchdog = None
+        if os.environ.get("AX650_WATCHDOG", "1") != "0":
+            self.watchdog = StepWatchdog(self, self.device_id)
+            self.watchdog.start()
         
         # Try to import manufacturer python bindings
         self.backend_type = None
@@ -40,7 +79,12 @@ class AX650Backend:
             logger.warning("Could not import axcl - device reset will not be available")
 
         try:
-            from axengine import InferenceSession  # type: ignore
+            if os.environ.get("AX650_SIMULATE", "0") != "0":
+                # Latency-modelled sessions over a synthetic model dir (sim_session.py)
+                from sim_session import SimulatedSession as InferenceSession
+                logger.info("AX650_SIMULATE set: using simulated InferenceSession")
+            else:
+                from axengine import InferenceSession  # type: ignore
             self.impl = InferenceSession
             self.backend_type = "axengine"
             logger.info("Successfully imported axengine.InferenceSession")
@@ -82,7 +126,24 @@ class AX650Backend:
             logger.warning("Cannot reset device: pyaxcl not available")
             return False
 
-    def load_model(self, model_path: str = None):
+    def recover(self, device_id=None):
+        """Reset the device and reload the current model after a stalled NPU call.
+
+        Latency history survives the reload so the watchdog keeps its budgets.
+        Returns True if the model is loaded again.
+        """
+        device_id = self.device_id if device_id is None else device_id
+        saved = self.layer_stats.to_dict() if self.layer_stats is not None else None
+        self.reset_device(device_id)
+        self.session = None
+        self.layers = []
+        self.post_model = None
+        result = self.load_model(self.model_path, reset=False)
+        if saved is not None:
+            self.layer_stats.merge(LayerStats.from_dict(saved))
+        return str(result.get("status", "")).startswith("loaded")
+
+    def load_model(self, model_path: str = None, reset: bool = True):
         """Load AX650 model using InferenceSession.
         
         For LLM models, expects directory structure:
@@ -101,9 +162,9 @@ class AX650Backend:
             return {"status": "error", "message": f"Model path not found: {model_path}"}
         
         # Reset device before loading new model to ensure clean state
-        if self.session or self.axcl:
+        if reset and (self.session or self.axcl):
             logger.info("Resetting device before model load...")
-            self.reset_device(0)
+            self.reset_device(self.device_id)
             self.session = None
             self.layers = []
             self.post_model = None
@@ -160,6 +221,9 @@ class AX650Backend:
         """Load Qwen3-4B specific multi-layer model structure."""
         logger.info("Detected Qwen3-4B model structure")
         self.model_type = "qwen3-4b"
+        # Latency stats describe one set of layer models
+        if self.layer_stats is not None:
+            self.layer_stats.reset()
         
         # Load embeddings
         # Try .bin first (bfloat16)
@@ -180,7 +244,8 @@ class AX650Backend:
              # Try .npy
              embed_path = os.path.join(model_path, "model.embed_tokens.weight.npy")
              if os.path.exists(embed_path):
-                 self.embedding_weights = np.load(embed_path)
+                 # Memory-mapped: only the rows looked up are paged in
+                 self.embedding_weights = np.load(embed_path, mmap_mode="r")
                  logger.info(f"Loaded .npy embeddings from {embed_path}")
 
         # Load layers
@@ -249,18 +314,23 @@ class AX650Backend:
             np.zeros((1, max_seq_len, kv_dim), dtype=dtype)
             for _ in range(num_layers)
         ]
+        ENGINE_KV_BYTES.set(sum(c.nbytes for c in self.k_caches + self.v_caches))
         logger.info(f"Initialized KV caches: {num_layers} layers, {max_seq_len} seq len, {kv_dim} dims")
 
     def generate(self, prompt: str, max_tokens: int = 128, temperature: float = 0.8, 
-                 top_p: float = 0.9, top_k: int = 40, request_id: str = None):
+                 top_p: float = 0.9, top_k: int = 40, request_id: str = None, trace=None,
+                 seed: int = None):
         """Generate text using AX650 NPU inference.
         
         Args:
             prompt: Input text prompt
             max_tokens: Maximum tokens to generate
-            temperature: Sampling temperature (0.0-2.0)
+            temperature: Sampling temperature (0.0-2.0); 0 is greedy
             top_p: Nucleus sampling threshold
             top_k: Top-k sampling parameter
+            trace: Trace level for this request (see tracing.py); None uses
+                the global AX650_TRACE level
+            seed: Seed for sampling, so the same request reproduces its output
         
         Returns:
             Generated text string
@@ -269,26 +339,59 @@ class AX650Backend:
         if not request_id:
             request_id = str(uuid.uuid4())
 
-        logger.info("REQ %s: generate start, prompt_len=%d", request_id, len(prompt))
+        trace_level = tracing.parse_level(trace, self.tracer.level)
+        if trace_level >= tracing.SUMMARY:
+            self.tracer.log("REQ %s: generate start, prompt_len=%d", request_id, len(prompt))
+        self.last_metrics = {}
+        self.last_error = None
+        t_start = time.perf_counter()
+        ENGINE_REQUESTS.inc()
 
         if self.backend_type == "dummy":
             logger.info("REQ %s: DUMMY backend echoing prompt", request_id)
-            return f"Echo: {prompt}"
+            text = f"Echo: {prompt}"
+            # No tokenizer in dummy mode; count words so the fields aren't empty
+            self.last_metrics.update(prompt_eval_count=len(prompt.split()), eval_count=len(text.split()))
+            self._finish_metrics(t_start)
+            return text
         
         if not self.session:
-            return "Error: Model not loaded. Call /load first."
+            self.last_error = "Model not loaded. Call /load first."
+            return f"Error: {self.last_error}"
         
+        text = None
         try:
-            if self.backend_type == "axengine":
-                return self._generate_axengine(prompt, max_tokens, temperature, top_p, top_k, request_id=request_id)
-            elif self.backend_type == "pyaxcl":
-                return self._generate_pyaxcl(prompt, max_tokens)
+            # No-op unless an on-demand profile (/admin/profile) is running
+            with profiler.profiling():
+                if self.backend_type == "axengine":
+                    text = self._generate_axengine(prompt, max_tokens, temperature, top_p, top_k,
+                                                   request_id=request_id, trace_level=trace_level,
+                                                   seed=seed)
+                elif self.backend_type == "pyaxcl":
+                    text = self._generate_pyaxcl(prompt, max_tokens)
+        except StepStalled as e:
+            ENGINE_ERRORS.inc()
+            logger.warning(f"Generation abandoned: {e}")
+            self.last_error = str(e)
+            return f"Error during generation: {str(e)}"
         except Exception as e:
+            ENGINE_ERRORS.inc()
             logger.error(f"Generation failed: {e}", exc_info=True)
+            self.last_error = str(e)
             return f"Error during generation: {str(e)}"
+        self._finish_metrics(t_start)
+        return text
+
+    def _finish_metrics(self, t_start):
+        """Fill in totals and defaults for last_metrics."""
+        m = self.last_metrics
+        m["total_duration"] = int((time.perf_counter() - t_start) * 1e9)
+        for field in ("prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration"):
+            m.setdefault(field, 0)
     
     def _generate_axengine(self, prompt: str, max_tokens: int, temperature: float,
-                          top_p: float, top_k: int, request_id: str = None):
+                          top_p: float, top_k: int, request_id: str = None,
+                          trace_level=tracing.SUMMARY, seed: int = None):
         """Generate using axengine InferenceSession.
         
         This implements a basic autoregressive generation loop:
@@ -299,7 +402,8 @@ class AX650Backend:
         5. Stop on EOS or max_tokens
         """
         if getattr(self, "model_type", None) == "qwen3-4b":
-            return self._generate_qwen3_4b(prompt, max_tokens, temperature, top_p, top_k, request_id=request_id)
+            return self._generate_qwen3_4b(prompt, max_tokens, temperature, top_p, top_k,
+                                           request_id=request_id, trace_level=trace_level, seed=seed)
 
         # For now, return a placeholder showing the SDK is connected
         # Real implementation requires:
@@ -329,15 +433,22 @@ class AX650Backend:
         
         return f"[axengine] Generated response for: {prompt} (SDK integrated, full pipeline TODO)"
 
-    def _generate_qwen3_4b(self, prompt, max_tokens, temperature, top_p, top_k, request_id: str = None):
+    def _generate_qwen3_4b(self, prompt, max_tokens, temperature, top_p, top_k, request_id: str = None,
+                           trace_level=tracing.SUMMARY, seed: int = None):
         """Generation loop for Qwen3-4B multi-layer model."""
         if not self.tokenizer:
-            return "Error: Tokenizer not loaded (transformers required)"
+            self.last_error = "Tokenizer not loaded (transformers required)"
+            return f"Error: {self.last_error}"
         
         if not request_id:
             request_id = str(uuid.uuid4())
 
-        logger.info("REQ %s: Starting Qwen3-4B generation for prompt: %s...", request_id, prompt[:50])
+        tracer = self.tracer
+        trace_summary = trace_level >= tracing.SUMMARY
+        trace_step = trace_level >= tracing.STEP
+        trace_tensors = trace_level >= tracing.TENSORS
+        if trace_summary:
+            tracer.log("REQ %s: Starting Qwen3-4B generation for prompt: %s...", request_id, prompt[:50])
         
         # Timing accumulators
         t_start_total = time.perf_counter()
@@ -348,11 +459,30 @@ class AX650Backend:
         t_sampling = 0.0
         t_detokenize = 0.0
         n_npu_calls = 0
+        t_first_token = None  # end of prefill: the first new token is sampled
+        # Resolved once: the loop below only does O(1) observe() calls
+        observe_layer = ENGINE_LAYER_SECONDS.observe
+        observe_post = ENGINE_POST_SECONDS.observe
+        observe_sampling = ENGINE_SAMPLING_SECONDS.observe
+        observe_token = ENGINE_TOKEN_SECONDS.observe
+        # Span recording (Chrome trace export): phases at summary, every
+        # step/layer/post/sample at step level
+        add_span = tracing.SPANS.add
+        tid = threading.get_native_id()
+        record_layer = self.layer_stats.record if self.layer_stats is not None else None
+        # Seeded requests sample from their own generator, not torch's global one
+        generator = torch.Generator().manual_seed(int(seed)) if seed is not None else None
+        # The watchdog sees each NPU call in flight; if it has to recover the
+        # device meanwhile, the incident count moves and this generation stops
+        watch = self.watchdog
+        incidents = watch.incidents if watch is not None else 0
 
         # 1. Tokenize
         t0 = time.perf_counter()
         input_ids = self.tokenizer.encode(prompt)
         t_tokenize = time.perf_counter() - t0
+        if trace_summary:
+            add_span("tokenize", request_id, t0, t0 + t_tokenize, tid=tid)
         generated_ids = []
         
         # 2. Reset KV caches (zero out)
@@ -364,7 +494,8 @@ class AX650Backend:
         # 3. Prefill (process prompt tokens)
         # Note: This model seems to process one token at a time (batch=1, seq=1)
         # We must loop through the prompt.
-        logger.info("REQ %s: Prefilling %d tokens...", request_id, len(input_ids))
+        if trace_summary:
+            tracer.log("REQ %s: Prefilling %d tokens...", request_id, len(input_ids))
         
         next_token = None
         
@@ -384,6 +515,9 @@ class AX650Backend:
                 
             if step >= len(input_ids) + max_tokens:
                 break
+            if self.stop_requested:
+                logger.info("REQ %s: stop requested at step %d", request_id, step)
+                break
                 
             # Stop if EOS generated
             if not is_prefill and (token_id == self.tokenizer.eos_token_id or token_id in [151643, 151645]): # Qwen EOS
@@ -396,7 +530,10 @@ class AX650Backend:
             # Convert to bfloat16 for NPU input
             t_e0 = time.perf_counter()
             hidden_state = self.embedding_weights[token_id].reshape(1, 1, 2560).astype(ml_dtypes.bfloat16)
-            t_embedding += time.perf_counter() - t_e0
+            t_e1 = time.perf_counter()
+            t_embedding += t_e1 - t_e0
+            if trace_step:
+                add_span("embed", request_id, t_e0, t_e1, tid=tid)
             
             # Prepare mask
             # Mask is [1, 1, 1024]. 1 for valid, 0 for masked.
@@ -428,8 +565,22 @@ class AX650Backend:
                 
                 # Run layer
                 t_layer0 = time.perf_counter()
+                if watch is not None:
+                    watch.pending = (i, current_pos, t_layer0)
                 outputs = layer_sess.run(None, inputs)
-                t_layer_runs += time.perf_counter() - t_layer0
+                t_layer1 = time.perf_counter()
+                if watch is not None:
+                    # Abandoned: leave `pending` alone, a new generation may own it by now
+                    if watch.incidents != incidents:
+                        raise StepStalled(f"layer {i} stalled; request cancelled by the watchdog")
+                    watch.pending = None
+                dt = t_layer1 - t_layer0
+                t_layer_runs += dt
+                observe_layer(dt)
+                if record_layer:
+                    record_layer(i, current_pos, dt)
+                if trace_step:
+                    add_span("layer", request_id, t_layer0, t_layer1, tid=tid, args={"layer": i})
                 n_npu_calls += 1
                 
                 # Outputs: K_cache_out, V_cache_out, output
@@ -456,84 +607,100 @@ class AX650Backend:
             # Output: output [1, 1, 151936]
             # Ensure hidden_state is bfloat16 (it should be from layer output, but verify)
             t_post0 = time.perf_counter()
+            if watch is not None:
+                watch.pending = (POST_LAYER, current_pos, t_post0)
             post_out = self.post_model.run(None, {"input": hidden_state})
-            t_post += time.perf_counter() - t_post0
+            t_post1 = time.perf_counter()
+            if watch is not None:
+                if watch.incidents != incidents:
+                    raise StepStalled("post model stalled; request cancelled by the watchdog")
+                watch.pending = None
+            dt = t_post1 - t_post0
+            t_post += dt
+            observe_post(dt)
+            if record_layer:
+                record_layer(POST_LAYER, current_pos, dt)
+            if trace_step:
+                add_span("post", request_id, t_post0, t_post1, tid=tid)
             n_npu_calls += 1
             logits = post_out[0] # [1, 1, 151936]
 
-            # Log logits shape and top-k candidates for this step for correlation/debugging
-            try:
-                lshape = getattr(logits, 'shape', None)
-                logger.info("REQ %s: step=%d post logits shape=%s", request_id, step, lshape)
-                # Convert to numpy float32 if needed
-                try:
-                    logits_np = np.array(logits)
-                except Exception:
-                    logits_np = np.asarray(logits)
-
-                if logits_np.dtype == ml_dtypes.bfloat16:
-                    logits_np = logits_np.astype(np.float32)
-
-                # Extract top-k ids for quick sanity check
-                try:
-                    flat = logits_np.reshape(-1)
-                    k = min(10, flat.size)
-                    topk_idx = np.argpartition(flat, -k)[-k:]
-                    topk_sorted = topk_idx[np.argsort(-flat[topk_idx])]
-                    logger.info("REQ %s: step=%d logits topk_ids=%s", request_id, step, topk_sorted.tolist())
-                except Exception:
-                    logger.warning("REQ %s: step=%d failed to compute topk", request_id, step)
-
-                # Optionally save logits for offline inspection (first few steps only)
-                if step < 3:
-                    try:
-                        out_path = f"/tmp/{request_id}_logits_step{step}.npy"
-                        np.save(out_path, logits_np.astype(np.float32))
-                        logger.info("REQ %s: saved logits to %s", request_id, out_path)
-                    except Exception as e:
-                        logger.warning("REQ %s: failed to save logits: %s", request_id, e)
-            except Exception as e:
-                logger.warning("REQ %s: error logging logits/topk: %s", request_id, e)
+            # Debug tracing: top-k ids and early-step logit dumps (worker thread)
+            if trace_tensors:
+                tracer.tensors(request_id, step, logits)
             
             # Sample next token
             t_sample0 = time.perf_counter()
-            next_token = self._sample(logits, temperature, top_p, top_k)
-            t_sampling += time.perf_counter() - t_sample0
+            next_token = self._sample(logits, temperature, top_p, top_k, generator)
+            t_sample_end = time.perf_counter()
+            t_sampling += t_sample_end - t_sample0
+            observe_sampling(t_sample_end - t_sample0)
             
             if not is_prefill:
                 generated_ids.append(next_token)
-
-            # Log per-step timing to help correlate with NPU trace
-            try:
-                step_elapsed = time.perf_counter() - t_start_total
-                logger.info("REQ %s: step=%d elapsed=%.6fs step_layer_time=%.6fs npu_calls=%d", request_id, step, step_elapsed, t_layer_step, n_npu_calls)
-            except Exception:
-                pass
+                observe_token(t_sample_end - t_e0)
+            elif step == len(input_ids) - 1:
+                t_first_token = t_sample_end
+
+            # Per-step timing to correlate with the NPU trace
+            if trace_step:
+                add_span("sample", request_id, t_sample0, t_sample_end, tid=tid)
+                add_span("prefill_step" if is_prefill else "decode_step", request_id, t_e0, t_sample_end,
+                         tid=tid, args={"step": step, "pos": current_pos})
+                tracer.log("REQ %s: step=%d elapsed=%.6fs step_layer_time=%.6fs npu_calls=%d",
+                           request_id, step, t_sample_end - t_start_total, t_layer_step, n_npu_calls)
                 
             current_pos += 1
             if current_pos >= 1023:
                 logger.warning("Context length limit reached")
                 break
                 
+        t_loop_end = time.perf_counter()
+        if t_first_token is None:
+            t_first_token = t_loop_end
+        prefill_s = t_first_token - t_start_total
+        ENGINE_TTFT.observe(prefill_s)
+        if prefill_s > 0:
+            ENGINE_PREFILL_RATE.observe(len(input_ids) / prefill_s)
+        ENGINE_TOKENS.labels("prefill").inc(len(input_ids))
+        ENGINE_TOKENS.labels("decode").inc(len(generated_ids))
+
         # Decode generated tokens
         t_d0 = time.perf_counter()
         output_text = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
         t_detokenize = time.perf_counter() - t_d0
 
         t_total = time.perf_counter() - t_start_total
-
-        # Log profiling summary
-        try:
-            logger.info("Generation timing summary: total=%.3fs, tokenize=%.4fs, embedding=%.4fs, layer_runs=%.4fs, post=%.4fs, sampling=%.4fs, detokenize=%.4fs, npu_calls=%d, steps=%d",
-                        t_total, t_tokenize, t_embedding, t_layer_runs, t_post, t_sampling, t_detokenize, n_npu_calls, len(input_ids) + len(generated_ids))
-        except Exception:
-            # Ensure we never crash profiling
-            pass
+        if trace_summary:
+            add_span("prefill", request_id, t0 + t_tokenize, t_first_token, tid=tid, args={"tokens": len(input_ids)})
+            add_span("decode", request_id, t_first_token, t_loop_end, tid=tid, args={"tokens": len(generated_ids)})
+            add_span("detokenize", request_id, t_d0, t_d0 + t_detokenize, tid=tid)
+            add_span("generate", request_id, t_start_total, t_start_total + t_total, tid=tid)
+
+        # Profiling summary
+        if trace_summary:
+            tracer.log("REQ %s: Generation timing summary: total=%.3fs, tokenize=%.4fs, embedding=%.4fs, layer_runs=%.4fs, post=%.4fs, sampling=%.4fs, detokenize=%.4fs, npu_calls=%d, steps=%d",
+                       request_id, t_total, t_tokenize, t_embedding, t_layer_runs, t_post, t_sampling, t_detokenize, n_npu_calls, len(input_ids) + len(generated_ids))
+
+        ns = lambda seconds: int(seconds * 1e9)
+        self.last_metrics.update({
+            "prompt_eval_count": len(input_ids),
+            "prompt_eval_duration": ns(t_first_token - t_start_total),
+            "eval_count": len(generated_ids),
+            "eval_duration": ns(t_loop_end - t_first_token),
+            "tokenize_duration": ns(t_tokenize),
+            "embedding_duration": ns(t_embedding),
+            "layer_duration": ns(t_layer_runs),
+            "post_duration": ns(t_post),
+            "sampling_duration": ns(t_sampling),
+            "detokenize_duration": ns(t_detokenize),
+            "npu_calls": n_npu_calls
+        })
 
         return output_text
 
-    def _sample(self, logits, temperature, top_p, top_k):
-        """Sample next token from logits."""
+    def _sample(self, logits, temperature, top_p, top_k, generator=None):
+        """Sample next token from logits (greedy when temperature <= 0)."""
         # logits shape: [1, 1, vocab_size]
         # Convert ml_dtypes.bfloat16 to float32 for torch compatibility
         if logits.dtype == ml_dtypes.bfloat16:
@@ -541,9 +708,10 @@ class AX650Backend:
 
         logits = torch.tensor(logits[0, 0, :])
         
-        # Apply temperature
-        if temperature > 0:
-            logits = logits / temperature
+        # Temperature 0: always the most likely token
+        if temperature <= 0:
+            return int(torch.argmax(logits).item())
+        logits = logits / temperature
         
         # Top-K
         if top_k > 0:
@@ -563,7 +731,7 @@ class AX650Backend:
             
         # Sample
         probs = torch.softmax(logits, dim=-1)
-        next_token = torch.multinomial(probs, num_samples=1).item()
+        next_token = torch.multinomial(probs, num_samples=1, generator=generator).item()
         return next_token
 
 
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Streaming per-layer NPU latency statistics.
+
+Every layer `run()` (and the post model) is recorded into a quantile sketch
+keyed by (layer, context-position bucket), so we can tell whether one
+`qwen3_p128_l{i}` model, the post model or a particular KV-length range is
+slow without keeping raw samples. Sketches are mergeable, so the proxy can
+combine the stats of all its runtimes, and serializable, so a snapshot can
+be saved and compared after a model or firmware change.
+"""
+import math
+import threading
+
+POST_LAYER = "post"
+# Context positions per bucket (the KV cache holds 1024 positions)
+POSITION_BUCKET = 64
+
+
+class QuantileSketch:
+    """Log-bucketed histogram with bounded relative error (DDSketch-style).
+
+    add() is O(1); quantiles are within `relative_accuracy` of the true value.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, value):
+        # Values are seconds; clamp to 1 ns so log() is defined
+        key = math.ceil(math.log(max(value, 1e-9)) / self._log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                # Midpoint of the bucket (gamma^(k-1), gamma^k], within the observed range
+                return min(max(2 * self.gamma ** key / (self.gamma + 1), self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def merge(self, other):
+        for key, n in list(other.bins.items()):
+            self.bins[key] = self.bins.get(key, 0) + n
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def to_dict(self):
+        return {"alpha": self.relative_accuracy, "bins": {str(k): n for k, n in list(self.bins.items())},
+                "count": self.count, "sum": self.sum,
+                "min": None if self.min == math.inf else self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data.get("alpha", 0.01))
+        sketch.bins = {int(k): n for k, n in data["bins"].items()}
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        sketch.min = math.inf if data.get("min") is None else data["min"]
+        sketch.max = data.get("max", 0.0)
+        return sketch
+
+
+def _layer_key(layer):
+    return POST_LAYER if layer == POST_LAYER else int(layer)
+
+
+def _layer_order(layer):
+    """Numeric layers first, then the post model."""
+    return (1, 0) if layer == POST_LAYER else (0, layer)
+
+
+class LayerStats:
+    """Quantile sketches of layer latency by (layer, position bucket)."""
+
+    def __init__(self, position_bucket=POSITION_BUCKET):
+        self.position_bucket = position_bucket
+        self.sketches = {}
+        self._lock = threading.Lock()
+
+    def record(self, layer, position, seconds):
+        key = (layer, position // self.position_bucket)
+        sketch = self.sketches.get(key)
+        if sketch is None:
+            with self._lock:
+                sketch = self.sketches.setdefault(key, QuantileSketch())
+        sketch.add(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.sketches = {}
+
+    def merge(self, other):
+        with self._lock:
+            for key, sketch in other.sketches.items():
+                mine = self.sketches.setdefault(key, QuantileSketch(sketch.relative_accuracy))
+                mine.merge(sketch)
+
+    def to_dict(self):
+        return {
+            "position_bucket": self.position_bucket,
+            "sketches": [{"layer": layer, "bucket": bucket, "sketch": s.to_dict()}
+                         for (layer, bucket), s in list(self.sketches.items())]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data.get("position_bucket", POSITION_BUCKET))
+        for entry in data.get("sketches", []):
+            stats.sketches[(_layer_key(entry["layer"]), entry["bucket"])] = \
+                QuantileSketch.from_dict(entry["sketch"])
+        return stats
+
+    def _by(self, index):
+        """Merge sketches over everything except key[index]."""
+        merged = {}
+        for key, sketch in list(self.sketches.items()):
+            target = merged.setdefault(key[index], QuantileSketch(sketch.relative_accuracy))
+            target.merge(sketch)
+        return merged
+
+    def by_layer(self):
+        """One sketch per layer ("post" included), merged over all positions."""
+        return self._by(0)
+
+    def report(self):
+        """Layers ranked by median latency, and latency versus context position."""
+        layers = []
+        for layer, s in self.by_layer().items():
+            layers.append({"layer": layer, "count": s.count, "mean_ms": s.mean * 1e3,
+                           "p50_ms": s.quantile(0.5) * 1e3, "p90_ms": s.quantile(0.9) * 1e3,
+                           "p99_ms": s.quantile(0.99) * 1e3, "max_ms": s.max * 1e3})
+        layers.sort(key=lambda r: -r["p50_ms"])
+        for rank, row in enumerate(layers, 1):
+            row["rank"] = rank
+
+        positions = []
+        for bucket, s in sorted(self._by(1).items()):
+            lo = bucket * self.position_bucket
+            positions.append({"positions": f"{lo}-{lo + self.position_bucket - 1}", "count": s.count,
+                              "p50_ms": s.quantile(0.5) * 1e3, "p90_ms": s.quantile(0.9) * 1e3,
+                              "p99_ms": s.quantile(0.99) * 1e3})
+
+        # Median per layer per position bucket, for the latency-vs-position grid
+        grid = {}
+        for (layer, bucket), s in list(self.sketches.items()):
+            grid.setdefault(str(layer), {})[bucket * self.position_bucket] = s.quantile(0.5) * 1e3
+        return {"layers": layers, "positions": positions, "layer_by_position_p50_ms": grid}
+
+
+def compare(baseline, current, threshold=1.10, quantile=0.5, min_count=20):
+    """Flag layers (and layer/position cells) slower than the baseline.
+
+    Returns rows for every layer present in both, with `regression` set when
+    the chosen quantile grew by more than `threshold` (ratio).
+    """
+    rows = []
+    base_layers, cur_layers = baseline.by_layer(), current.by_layer()
+    for layer in sorted(set(base_layers) & set(cur_layers), key=_layer_order):
+        b, c = base_layers[layer], cur_layers[layer]
+        if b.count < min_count or c.count < min_count:
+            continue
+        bq, cq = b.quantile(quantile), c.quantile(quantile)
+        ratio = cq / bq if bq else math.inf
+        rows.append({"layer": layer, "baseline_ms": bq * 1e3, "current_ms": cq * 1e3,
+                     "ratio": ratio, "regression": ratio > threshold})
+    cells = []
+    for key in set(baseline.sketches) & set(current.sketches):
+        b, c = baseline.sketches[key], current.sketches[key]
+        if b.count < min_count or c.count < min_count:
+            continue
+        ratio = c.quantile(quantile) / b.quantile(quantile)
+        if ratio > threshold:
+            cells.append({"layer": key[0], "positions_from": key[1] * current.position_bucket,
+                          "ratio": ratio})
+    cells.sort(key=lambda r: -r["ratio"])
+    return {"layers": rows, "regressed_cells": cells,
+            "regressions": [r["layer"] for r in rows if r["regression"]]}
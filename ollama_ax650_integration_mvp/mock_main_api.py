@@ -10,14 +10,25 @@ import logging
 import threading
 import queue
 import time
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file
 from inference_engine import AX650Backend
+from metrics_registry import REGISTRY, CONTENT_TYPE, Counter, Gauge
+import tracing
+import profiler
+from runtime_emulator import RuntimeEmulator, count_tokens
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# The proxy polls /api/status every second; keep it out of the access log
+logging.getLogger("werkzeug").addFilter(lambda record: "/api/status" not in record.getMessage())
 
 APP = Flask(__name__)
 BACKEND = AX650Backend()
+# AX650_EMULATE=1: reproduce the C++ runtime's token cadence, busy
+# semantics and faults instead of running the engine (runtime_emulator.py)
+EMULATOR = RuntimeEmulator.from_env() if os.environ.get("AX650_EMULATE", "0") != "0" else None
+# Device this instance stands in for (set by the proxy when running a pool)
+DEVICE_ID = int(os.environ.get("AX650_DEVICE_ID", 0))
 
 # Global state for async generation
 # The C++ server uses a queue to store generated tokens for /api/generate_provider
@@ -25,10 +36,50 @@ BACKEND = AX650Backend()
 MSG_QUEUE = queue.Queue()
 IS_RUNNING = False
 LOCK = threading.Lock()
+# Set by /api/stop; the running generation ends at its next token
+STOP = threading.Event()
+# The C++ server answers "llm is running" for a moment after /api/reset
+# (emulated with the reset_busy_ms fault)
+RESET_BUSY_UNTIL = 0.0
 
-def generation_worker(prompt, max_tokens, temperature, top_p, top_k):
+# Bumped when a generation starts or is cancelled by the watchdog; a worker
+# whose generation is no longer current drops its result
+GENERATION = 0
+
+# Wall-clock time the last output was produced (reported by /api/status)
+LAST_TOKEN_AT = None
+
+# Runtime metrics (the engine registers its own in the same registry)
+REQUESTS = Counter("ax650_runtime_requests_total", "Accepted /api/generate calls")
+ERRORS = Counter("ax650_runtime_errors_total", "Rejected or failed generations", ("reason",))
+CANCELLATIONS = Counter("ax650_runtime_cancellations_total", "Generations stopped via /api/stop")
+Gauge("ax650_runtime_queue_depth", "Output chunks waiting to be polled").set_function(lambda: MSG_QUEUE.qsize())
+Gauge("ax650_runtime_busy", "1 while a generation is running").set_function(lambda: int(IS_RUNNING))
+
+# Engine timing/token counts of the current generation, handed to the proxy
+# with the final provider response; LOAD_NS is a model load that the
+# generation had to wait for.
+METRICS = None
+LOAD_NS = 0
+# Why the current generation failed, reported with its final provider
+# response; the C++ server has no such field (see the proxy's fallback)
+ERROR = None
+
+# Conversation context. Like the C++ server, /api/generate appends a user turn
+# to the current context and /api/reset starts a new one, so the proxy can
+# continue a conversation without resetting.
+CONTEXT = []
+
+def render_context(messages):
+    """Flatten the conversation into a prompt for the Python engine."""
+    if len(messages) == 1 and messages[0]["role"] == "user":
+        return messages[0]["content"]
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+def generation_worker(prompt, max_tokens, temperature, top_p, top_k, trace=None, request_id=None,
+                      generation=None, seed=None):
     """Background thread to run inference and push results to queue."""
-    global IS_RUNNING
+    global IS_RUNNING, LAST_TOKEN_AT, METRICS, ERROR
     try:
         logger.info("MockServer: Starting generation worker")
         # Note: The current Python backend generates the FULL text at once.
@@ -41,27 +92,88 @@ def generation_worker(prompt, max_tokens, temperature, top_p, top_k):
             max_tokens=max_tokens, 
             temperature=temperature, 
             top_p=top_p, 
-            top_k=top_k
+            top_k=top_k,
+            request_id=request_id,
+            trace=trace,
+            seed=seed
         )
         
         with LOCK:
+            if generation != GENERATION:
+                logger.warning("MockServer: Dropping result of a cancelled generation")
+                return
+            if BACKEND.last_error is not None:
+                ERRORS.labels("engine").inc()
+                ERROR = BACKEND.last_error
+                return
             MSG_QUEUE.put(text)
+            LAST_TOKEN_AT = time.time()
+            METRICS = dict(BACKEND.last_metrics, load_duration=LOAD_NS)
+            CONTEXT.append({"role": "assistant", "content": text})
             logger.info(f"MockServer: Generation complete, pushed {len(text)} chars")
             
     except Exception as e:
+        ERRORS.labels("engine").inc()
         logger.error(f"MockServer: Generation failed: {e}")
         with LOCK:
-            MSG_QUEUE.put(f"Error: {str(e)}")
+            if generation == GENERATION:
+                ERROR = str(e)
     finally:
         with LOCK:
-            IS_RUNNING = False
+            if generation == GENERATION:
+                IS_RUNNING = False
+
+def emulator_worker(turn, context_tokens, max_tokens, seed=None, generation=None):
+    """Like generation_worker, with tokens streamed on the emulated cadence."""
+    global IS_RUNNING, LAST_TOKEN_AT, METRICS, ERROR
+    pieces = []
+
+    def emit(chunk):
+        global LAST_TOKEN_AT
+        pieces.append(chunk)
+        with LOCK:
+            if generation == GENERATION:
+                MSG_QUEUE.put(chunk)
+                LAST_TOKEN_AT = time.time()
+
+    try:
+        metrics = EMULATOR.generate(turn, max_tokens, emit, STOP, context_tokens, seed)
+        with LOCK:
+            if generation == GENERATION:
+                METRICS = dict(metrics, load_duration=LOAD_NS)
+                CONTEXT.append({"role": "assistant", "content": "".join(pieces)})
+    except Exception as e:
+        ERRORS.labels("engine").inc()
+        logger.error(f"MockServer: Emulated generation failed: {e}")
+        with LOCK:
+            if generation == GENERATION:
+                ERROR = str(e)
+    finally:
+        with LOCK:
+            if generation == GENERATION:
+                IS_RUNNING = False
+
+def handle_stall(incident):
+    """Watchdog callback: fail the stalled request once the engine is back."""
+    global IS_RUNNING, GENERATION, ERROR
+    with LOCK:
+        GENERATION += 1
+        if IS_RUNNING:
+            ERRORS.labels("stall").inc()
+            ERROR = (f"NPU stalled at layer {incident['layer']}; request cancelled "
+                     f"(device recovered in {incident['recovery_seconds']:.1f}s)")
+        IS_RUNNING = False
+
+if BACKEND.watchdog is not None:
+    BACKEND.watchdog.on_incident = handle_stall
 
 @APP.route("/api/reset", methods=["POST"])
 def handle_reset():
     """Reset the engine state."""
-    global IS_RUNNING
+    global IS_RUNNING, RESET_BUSY_UNTIL
     with LOCK:
         if IS_RUNNING:
+            ERRORS.labels("busy").inc()
             return jsonify({"error": "llm is running"}), 400
             
     data = request.get_json(force=True, silent=True) or {}
@@ -71,30 +183,43 @@ def handle_reset():
     # Our Python backend doesn't explicitly support setting system prompt separately from generate,
     # but we can reset the device/cache.
     logger.info(f"MockServer: Resetting with system_prompt len={len(system_prompt)}")
+    with LOCK:
+        CONTEXT.clear()
+        if system_prompt:
+            CONTEXT.append({"role": "system", "content": system_prompt})
     
+    if EMULATOR is not None:
+        RESET_BUSY_UNTIL = time.monotonic() + EMULATOR.reset_busy_seconds
+        return jsonify({"status": "ok"})
+
     # We can call reset_device if needed, or just clear internal state if we had any.
     # The Python backend resets cache at start of generate() anyway.
     # But let's call reset_device to be safe if using real hardware.
-    BACKEND.reset_device(0)
+    BACKEND.reset_device(DEVICE_ID)
     
     return jsonify({"status": "ok"})
 
 @APP.route("/api/generate", methods=["POST"])
 def handle_generate():
     """Start async generation."""
-    global IS_RUNNING
+    global IS_RUNNING, METRICS, LOAD_NS, GENERATION, ERROR
     
     # Check if model is loaded
-    if not BACKEND.session and BACKEND.backend_type != "dummy":
+    load_ns = 0
+    if EMULATOR is None and not BACKEND.session and BACKEND.backend_type != "dummy":
          # Auto-load if not loaded (helper for dev)
          model_path = os.environ.get("AX650_MODEL_PATH")
          if model_path:
+             t0 = time.perf_counter()
              BACKEND.load_model(model_path)
+             load_ns = int((time.perf_counter() - t0) * 1e9)
          else:
              return jsonify({"error": "Model not init"}), 400
 
     with LOCK:
-        if IS_RUNNING:
+        if IS_RUNNING or time.monotonic() < RESET_BUSY_UNTIL or \
+                (BACKEND.watchdog is not None and BACKEND.watchdog.recovering):
+            ERRORS.labels("busy").inc()
             return jsonify({"error": "llm is running"}), 400
         
         # Clear queue from previous runs
@@ -102,10 +227,18 @@ def handle_generate():
             MSG_QUEUE.get()
             
         IS_RUNNING = True
+        METRICS = None
+        ERROR = None
+        LOAD_NS = load_ns
+        STOP.clear()
+        BACKEND.stop_requested = False
+        GENERATION += 1
+        generation = GENERATION
 
     data = request.get_json(force=True, silent=True)
     if not data or "prompt" not in data:
         with LOCK: IS_RUNNING = False
+        ERRORS.labels("invalid").inc()
         return jsonify({"error": "Invalid request format"}), 400
 
     prompt = data["prompt"]
@@ -115,9 +248,29 @@ def handle_generate():
     temperature = float(data.get("temperature", 0.8))
     top_p = float(data.get("top-p", 0.9)) # Note hyphen in C++ API
     top_k = int(data.get("top-k", 40))    # Note hyphen in C++ API
-    
+
+    # Continue the current conversation (the C++ server keeps its KV cache)
+    with LOCK:
+        context_tokens = count_tokens(render_context(CONTEXT)) if CONTEXT else 0
+        CONTEXT.append({"role": "user", "content": prompt})
+        full_prompt = render_context(CONTEXT)
+
+    REQUESTS.inc()
     # Start worker
-    t = threading.Thread(target=generation_worker, args=(prompt, max_tokens, temperature, top_p, top_k))
+    # Not C++ server parameters: per-request trace level and the proxy's
+    # request id, so engine spans and log lines correlate with the proxy's
+    trace = data.get("trace")
+    request_id = data.get("request_id")
+    if EMULATOR is not None:
+        # Like the C++ server, only the new turn is prefilled; earlier
+        # turns are already in the KV cache
+        t = threading.Thread(target=emulator_worker,
+                             args=(prompt, context_tokens, max_tokens, data.get("seed"), generation),
+                             daemon=True)
+    else:
+        t = threading.Thread(target=generation_worker,
+                             args=(full_prompt, max_tokens, temperature, top_p, top_k, trace, request_id,
+                                   generation, data.get("seed")))
     t.start()
     
     return jsonify({"status": "ok"})
@@ -133,46 +286,207 @@ def content_provider():
             response_text += MSG_QUEUE.get()
         
         is_done = not IS_RUNNING
+        metrics = METRICS
+        error = ERROR
         
-    return jsonify({
+    result = {
         "response": response_text,
         "done": is_done
-    })
+    }
+    # Not part of the C++ server's response; the proxy uses it when present
+    if is_done and metrics:
+        result["metrics"] = metrics
+    if is_done and error:
+        result["error"] = error
+    return jsonify(result)
 
 @APP.route("/api/stop", methods=["GET"])
 def handle_stop():
-    """Stop generation."""
-    # We can't easily stop the Python thread, but we can flag it.
-    # For MVP mock, we just pretend.
-    global IS_RUNNING
+    """Stop generation.
+
+    The generation ends at its next token (next engine step) and is then
+    reported done by /api/generate_provider; a hung runtime ignores this.
+    """
     with LOCK:
-        IS_RUNNING = False
+        if IS_RUNNING:
+            CANCELLATIONS.inc()
+            STOP.set()
+            BACKEND.stop_requested = True
     return jsonify({"status": "ok"})
 
+@APP.route("/metrics", methods=["GET"])
+def handle_metrics():
+    """Prometheus metrics for this runtime and its engine."""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@APP.route("/trace", methods=["GET"])
+def handle_trace():
+    """Engine spans as Chrome trace events (?request_id=, ?since=/until= in perf_counter s)."""
+    since = request.args.get("since", type=float)
+    until = request.args.get("until", type=float)
+    events = tracing.SPANS.export(request.args.get("request_id"), since, until,
+                                  process_name=f"runtime device {DEVICE_ID}")
+    return jsonify(tracing.chrome_trace(events))
+
+@APP.route("/layer_stats", methods=["GET", "DELETE"])
+def handle_layer_stats():
+    """Per-layer latency report (?format=raw for mergeable sketches); DELETE resets."""
+    stats = BACKEND.layer_stats
+    if stats is None:
+        return jsonify({"error": "layer stats disabled (AX650_LAYER_STATS=0)"}), 404
+    if request.method == "DELETE":
+        stats.reset()
+        return jsonify({"status": "ok"})
+    if request.args.get("format") == "raw":
+        return jsonify(stats.to_dict())
+    return jsonify(stats.report())
+
+@APP.route("/emulator", methods=["GET", "POST"])
+def handle_emulator():
+    """Emulator cadence and faults; POST {"faults": {...}} replaces the faults."""
+    if EMULATOR is None:
+        return jsonify({"error": "not emulating (AX650_EMULATE=0)"}), 404
+    if request.method == "POST":
+        data = request.get_json(force=True, silent=True) or {}
+        try:
+            for key in ("ttft_ms", "prefill_ms_per_token", "tokens_per_sec", "jitter"):
+                if key in data:
+                    setattr(EMULATOR, key, float(data[key]))
+            if "faults" in data:
+                EMULATOR.set_faults(data["faults"])
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify(EMULATOR.config())
+
+@APP.route("/watchdog", methods=["GET"])
+def handle_watchdog():
+    """Stall incidents, recovery times and the current per-layer budgets."""
+    if BACKEND.watchdog is None:
+        return jsonify({"error": "watchdog disabled (AX650_WATCHDOG=0)"}), 404
+    return jsonify(BACKEND.watchdog.report())
+
+@APP.route("/admin/profile", methods=["POST"])
+def start_profile():
+    """Profile the engine for N seconds or N generations.
+
+    Body: {"modes": ["cprofile", "sample", "tracemalloc"], "seconds": 30,
+    "requests": null, "interval": 0.005, "wait": false}. Returns 202 with the
+    session (or 200 with the results when "wait" is set); 409 if a profile
+    is already running.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        session = profiler.ProfileSession(
+            modes=data.get("modes") or profiler.MODES,
+            seconds=data.get("seconds"),
+            requests=data.get("requests"),
+            interval=float(data.get("interval", 0.005)))
+        session.start()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    if data.get("wait"):
+        session.wait()
+        return jsonify(session.to_dict())
+    return jsonify(session.to_dict()), 202
+
+@APP.route("/admin/profile", methods=["GET", "DELETE"])
+def list_profiles():
+    """Recent profile sessions; DELETE stops the running one early."""
+    if request.method == "DELETE":
+        session = profiler.ACTIVE
+        if session is None:
+            return jsonify({"error": "no profile running"}), 404
+        session.stop()
+        return jsonify(session.to_dict())
+    return jsonify({"profiles": [s.to_dict() for s in reversed(profiler.SESSIONS.values())]})
+
+@APP.route("/admin/profile/<profile_id>", methods=["GET"])
+def get_profile(profile_id):
+    """One session's status and summary (?wait=1 blocks until it is done)."""
+    session = profiler.SESSIONS.get(profile_id)
+    if session is None:
+        return jsonify({"error": "unknown profile"}), 404
+    if request.args.get("wait"):
+        session.wait(profiler.MAX_SECONDS)
+    return jsonify(session.to_dict())
+
+@APP.route("/admin/profile/<profile_id>/<name>", methods=["GET"])
+def download_profile(profile_id, name):
+    """Download a result file (profile.pstats, stacks.collapsed, ...)."""
+    session = profiler.SESSIONS.get(profile_id)
+    path = session.file_path(name) if session is not None and session.state == "done" else None
+    if path is None:
+        return jsonify({"error": "no such file", "files": session.files if session else []}), 404
+    return send_file(path, mimetype=profiler.FILES[name], as_attachment=True, download_name=name)
+
+@APP.route("/api/status", methods=["GET"])
+def handle_status():
+    """Side-effect-free status probe.
+
+    Not part of the C++ server's API; the proxy uses it when present and
+    falls back to a TCP check otherwise. Unlike /api/stop it never touches a
+    generation in progress.
+    """
+    with LOCK:
+        busy = IS_RUNNING
+        pending = MSG_QUEUE.qsize()
+        turns = len(CONTEXT)
+    return jsonify({
+        "status": "ok",
+        "ready": EMULATOR is not None or BACKEND.backend_type == "dummy" or bool(BACKEND.session),
+        "busy": busy,
+        "pending_chunks": pending,
+        "context_turns": turns,
+        "last_token_at": LAST_TOKEN_AT,
+        "model": BACKEND.model_path,
+        "backend": "emulator" if EMULATOR is not None else BACKEND.backend_type,
+        "recovering": BACKEND.watchdog is not None and BACKEND.watchdog.recovering,
+        "stall_incidents": BACKEND.watchdog.incidents if BACKEND.watchdog is not None else 0
+    })
+
 @APP.route("/api/chat", methods=["POST"])
 def handle_chat():
     """Synchronous chat endpoint."""
     # main_api.cpp implements this as a blocking call that returns the full response.
+    global IS_RUNNING
     data = request.get_json(force=True, silent=True)
     if not data or "messages" not in data:
         return jsonify({"error": "Invalid request format"}), 400
-        
+
     messages = data["messages"]
-    # Simple concatenation for mock (real backend handles this better usually)
-    # But here we just take the last message content as prompt for simplicity
-    # or construct a prompt.
-    # The C++ server iterates messages and calls RunSync.
-    
-    # Let's just use the last user message for now
-    last_msg = messages[-1]
-    if "content" not in last_msg:
+    if not messages or any("content" not in m for m in messages):
         return jsonify({"error": "Invalid message format"}), 400
-        
-    prompt = last_msg["content"]
-    
-    # Run synchronously
-    text = BACKEND.generate(prompt)
-    
+    # The whole conversation is the prompt, not just the last message
+    prompt = render_context([{"role": m.get("role", "user"), "content": m["content"]} for m in messages])
+    max_tokens = int(data.get("max_tokens", 128))
+
+    # Occupies the runtime like /api/generate does
+    with LOCK:
+        if IS_RUNNING:
+            ERRORS.labels("busy").inc()
+            return jsonify({"error": "llm is running"}), 400
+        IS_RUNNING = True
+        STOP.clear()
+        BACKEND.stop_requested = False
+    REQUESTS.inc()
+    try:
+        if EMULATOR is not None:
+            pieces = []
+            EMULATOR.generate(prompt, max_tokens, pieces.append, STOP, seed=data.get("seed"))
+            text = "".join(pieces)
+        else:
+            text = BACKEND.generate(prompt, max_tokens=max_tokens)
+            if BACKEND.last_error is not None:
+                raise RuntimeError(BACKEND.last_error)
+    except Exception as e:
+        ERRORS.labels("engine").inc()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        with LOCK:
+            IS_RUNNING = False
+
     return jsonify({
         "message": text,
         "done": True
@@ -180,11 +494,13 @@ def handle_chat():
 
 def main():
     port = int(os.environ.get("AX650_PORT", 8000)) # Default to 8000 to match C++ server
-    logger.info(f"Mock C++ Server starting on port {port}")
+    logger.info(f"Mock C++ Server starting on port {port} (device {DEVICE_ID})")
     
     # Load model on start if env var set
     model_path = os.environ.get("AX650_MODEL_PATH")
-    if model_path:
+    if EMULATOR is not None:
+        logger.info(f"Emulating the C++ runtime: {EMULATOR.config()}")
+    elif model_path:
         logger.info(f"Auto-loading model: {model_path}")
         BACKEND.load_model(model_path)
     else:
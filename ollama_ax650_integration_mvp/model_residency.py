@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Model residency bookkeeping for the AX650 proxy.
+
+Tracks which models are known, which are resident on the runtime pool,
+when each should be unloaded (Ollama `keep_alive` semantics) and which idle
+models to evict when another one needs room under the device memory budget.
+Process management stays in backend.py.
+"""
+import os
+import re
+import json
+import time
+import logging
+
+logger = logging.getLogger("AX650Proxy")
+
+DEFAULT_MODEL_NAME = "qwen3-ax650:latest"
+
+# Go-style duration units accepted by Ollama ("5m", "1h30m", "10s", "500ms")
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def normalize_name(name):
+    """Ollama treats `model` and `model:latest` as the same model."""
+    if not name:
+        return None
+    return name if ":" in name else f"{name}:latest"
+
+
+def parse_keep_alive(value, default=None):
+    """Convert an Ollama keep_alive value to seconds.
+
+    Numbers are seconds, strings are Go durations. Negative values mean
+    "keep loaded forever" and return None. Missing or unparsable values
+    return `default`.
+    """
+    if value is None or value == "":
+        return default
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        text = str(value).strip()
+        try:
+            seconds = float(text)
+        except ValueError:
+            sign = -1.0 if text.startswith("-") else 1.0
+            parts = _DURATION_RE.findall(text.lstrip("+-"))
+            if not parts:
+                logger.warning(f"Ignoring unparsable keep_alive {value!r}")
+                return default
+            seconds = sign * sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+    return None if seconds < 0 else seconds
+
+
+def model_size_bytes(path):
+    """Device memory a model needs: the size of its .axmodel files.
+
+    Embeddings are mmapped on the host, so only the compiled layer and post
+    models count against the card's CMM. Returns 0 for missing paths
+    (e.g. the mock running without a model).
+    """
+    if not path or not os.path.isdir(path):
+        return 0
+    total = 0
+    for fname in os.listdir(path):
+        if fname.endswith(".axmodel"):
+            total += os.path.getsize(os.path.join(path, fname))
+    return total
+
+
+class ModelEntry:
+    """A model the proxy can serve, and its residency state."""
+
+    def __init__(self, name, path, size_bytes=None):
+        self.name = name
+        self.path = path
+        self.size_bytes = model_size_bytes(path) if size_bytes is None else int(size_bytes)
+        self.resident = False
+        self.loaded_at = None
+        self.last_used = None
+        self.expires_at = None  # None while resident means "never"
+        self.unloading = False
+        self.modified_at = os.path.getmtime(path) if path and os.path.exists(path) else time.time()
+
+    def touch(self, keep_alive_s):
+        """Record a use and restart the keep_alive countdown."""
+        now = time.time()
+        self.last_used = now
+        self.expires_at = None if keep_alive_s is None else now + keep_alive_s
+
+    def expired(self, now=None):
+        now = now or time.time()
+        return self.resident and self.expires_at is not None and now >= self.expires_at
+
+    def describe(self):
+        return {
+            "name": self.name,
+            "path": self.path,
+            "size": self.size_bytes,
+            "resident": self.resident,
+            "loaded_at": self.loaded_at,
+            "last_used": self.last_used,
+            "expires_at": self.expires_at,
+            "modified_at": self.modified_at
+        }
+
+
+class ModelRegistry:
+    """Known models plus the memory budget that bounds co-residency."""
+
+    def __init__(self, budget_bytes=0, default_name=DEFAULT_MODEL_NAME):
+        self.budget_bytes = budget_bytes  # 0 = unlimited
+        self.default_name = default_name
+        self.models = {}
+
+    def register(self, name, path, size_bytes=None):
+        name = normalize_name(name)
+        entry = self.models.get(name)
+        # A new path is a new model; the caller unloads the old one first
+        if entry is None or entry.path != path:
+            entry = ModelEntry(name, path, size_bytes)
+            self.models[name] = entry
+        return entry
+
+    def load_file(self, path):
+        """Register models from a JSON file: {"name": {"path": ..., "size_mb": ...}}."""
+        with open(path, "r", encoding="utf-8") as fh:
+            spec = json.load(fh)
+        for name, cfg in spec.items():
+            size = cfg.get("size_mb")
+            self.register(name, cfg.get("path"), None if size is None else int(size * 1024 * 1024))
+
+    def get(self, name):
+        """Look up a model; unknown or missing names resolve to the default."""
+        entry = self.models.get(normalize_name(name))
+        if entry is None:
+            entry = self.models.get(self.default_name)
+        return entry
+
+    @property
+    def default(self):
+        return self.models.get(self.default_name)
+
+    def resident(self):
+        return [m for m in self.models.values() if m.resident]
+
+    def plan_evictions(self, incoming, busy_names=()):
+        """Pick resident models to unload so `incoming` fits the budget.
+
+        Least recently used idle models go first. Returns the list to evict,
+        or None if the model cannot fit even after evicting every idle one.
+        """
+        if not self.budget_bytes:
+            return []
+        others = [m for m in self.resident() if m is not incoming]
+        used = sum(m.size_bytes for m in others)
+        if used + incoming.size_bytes <= self.budget_bytes:
+            return []
+        evict = []
+        for m in sorted(others, key=lambda m: m.last_used or 0.0):
+            # Busy models can't go; zero-size ones wouldn't free anything
+            if m.name in busy_names or not m.size_bytes:
+                continue
+            evict.append(m)
+            used -= m.size_bytes
+            if used + incoming.size_bytes <= self.budget_bytes:
+                return evict
+        return None
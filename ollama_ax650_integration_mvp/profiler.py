@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""On-demand profiling of the live engine.
+
+A ProfileSession runs for a number of seconds or generations and collects
+any of:
+  cprofile     deterministic profile of each generation (pstats file)
+  sample       stack samples of the generation threads (collapsed stacks,
+               for flamegraph.pl / speedscope)
+  tracemalloc  allocation snapshot plus the peak traced memory per generation
+
+Only one session runs at a time. The engine calls `profiling()` around each
+generation; with no session active that is a global read returning a shared
+null context. cProfile attaches to generations that start after the session
+does, and finalization (writing files) runs on its own thread, so triggering
+a profile under load never blocks or restarts the serving path.
+"""
+import os
+import io
+import sys
+import time
+import uuid
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+import collections
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+MODES = ("cprofile", "sample", "tracemalloc")
+DEFAULT_SECONDS = 30
+MAX_SECONDS = 600
+# Files a finished session may contain (also the download whitelist)
+FILES = {
+    "profile.pstats": "application/octet-stream",
+    "profile.txt": "text/plain",
+    "stacks.collapsed": "text/plain",
+    "tracemalloc.txt": "text/plain",
+    "tracemalloc.snapshot": "application/octet-stream",
+}
+
+PROFILE_DIR = os.environ.get("AX650_PROFILE_DIR", "/tmp/ax650_profiles")
+
+_NULL = contextlib.nullcontext()
+# The running session, read by the engine on every generation
+ACTIVE = None
+# Finished and running sessions by id (most recent last)
+SESSIONS = collections.OrderedDict()
+_START_LOCK = threading.Lock()
+
+
+def profiling():
+    """Context manager for one generation; a no-op unless a session is active."""
+    session = ACTIVE
+    return session.generation() if session is not None else _NULL
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class ProfileSession:
+    def __init__(self, modes=MODES, seconds=None, requests=None, interval=0.005, out_dir=PROFILE_DIR):
+        unknown = set(modes) - set(MODES)
+        if unknown or not modes:
+            raise ValueError(f"modes must be a non-empty subset of {MODES}")
+        if seconds is None and requests is None:
+            seconds = DEFAULT_SECONDS
+        self.id = uuid.uuid4().hex[:12]
+        self.modes = tuple(modes)
+        self.seconds = min(seconds, MAX_SECONDS) if seconds is not None else MAX_SECONDS
+        self.requests = requests
+        self.interval = interval
+        self.out_dir = os.path.join(out_dir, self.id)
+        self.state = "created"
+        self.started_at = None
+        self.finished_at = None
+        self.generations = 0
+        self.samples = 0
+        self.peaks = []
+        self.files = []
+        self.summary = {}
+        self.error = None
+        self._stats = None
+        self._stacks = collections.Counter()
+        self._threads = set()  # generation threads currently running
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._timer = None
+        self._started_tracemalloc = False
+
+    # -- lifecycle -------------------------------------------------------
+
+    def start(self):
+        global ACTIVE
+        with _START_LOCK:
+            if ACTIVE is not None:
+                raise RuntimeError(f"profile {ACTIVE.id} is already running")
+            if "tracemalloc" in self.modes and not tracemalloc.is_tracing():
+                tracemalloc.start(int(os.environ.get("AX650_PROFILE_TRACEMALLOC_FRAMES", 16)))
+                self._started_tracemalloc = True
+            self.state = "running"
+            self.started_at = time.time()
+            SESSIONS[self.id] = self
+            while len(SESSIONS) > 8:
+                SESSIONS.popitem(last=False)
+            ACTIVE = self
+        if "sample" in self.modes:
+            threading.Thread(target=self._sampler, name="ax650-profile-sampler", daemon=True).start()
+        self._timer = threading.Timer(self.seconds, self.stop)
+        self._timer.daemon = True
+        self._timer.start()
+        logger.info(f"Profile {self.id} started: modes={','.join(self.modes)} "
+                    f"seconds={self.seconds} requests={self.requests}")
+        return self
+
+    def stop(self):
+        """End collection; files are written on a background thread."""
+        global ACTIVE
+        with _START_LOCK:
+            if ACTIVE is not self:
+                return
+            ACTIVE = None
+            self.state = "finalizing"
+        if self._timer is not None:
+            self._timer.cancel()
+        threading.Thread(target=self._finalize, name="ax650-profile-finalize", daemon=True).start()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    # -- collection ------------------------------------------------------
+
+    @contextlib.contextmanager
+    def generation(self):
+        thread = threading.get_ident()
+        profile = cProfile.Profile() if "cprofile" in self.modes else None
+        trace_memory = "tracemalloc" in self.modes and tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        with self._lock:
+            self._threads.add(thread)
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler owns this thread; keep sampling only
+                profile = None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            with self._lock:
+                self._threads.discard(thread)
+                if self.state == "running":
+                    self.generations += 1
+                    if profile is not None:
+                        if self._stats is None:
+                            self._stats = pstats.Stats(profile)
+                        else:
+                            self._stats.add(profile)
+                    if trace_memory:
+                        self.peaks.append(tracemalloc.get_traced_memory()[1] - base)
+                    limit_reached = self.requests is not None and self.generations >= self.requests
+                else:
+                    limit_reached = False
+            if limit_reached:
+                self.stop()
+
+    def _sampler(self):
+        """Walk the stacks of running generation threads every `interval`."""
+        own = threading.get_ident()
+        while self.state == "running":
+            with self._lock:
+                threads = tuple(self._threads)
+            if threads:
+                frames = sys._current_frames()
+                stacks = []
+                for thread in threads:
+                    frame = frames.get(thread)
+                    if frame is None or thread == own:
+                        continue
+                    names = []
+                    while frame is not None:
+                        names.append(_frame_name(frame))
+                        frame = frame.f_back
+                    stacks.append(";".join(reversed(names)))
+                del frames
+                with self._lock:
+                    self._stacks.update(stacks)
+                    self.samples += len(stacks)
+            time.sleep(self.interval)
+
+    # -- results ---------------------------------------------------------
+
+    def _finalize(self):
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            with self._lock:
+                stats = self._stats
+                stacks = dict(self._stacks)
+            if "cprofile" in self.modes and stats is not None:
+                stats.dump_stats(self._path("profile.pstats"))
+                text = io.StringIO()
+                pstats.Stats(self._path("profile.pstats"), stream=text).sort_stats("cumulative").print_stats(40)
+                self._write("profile.txt", text.getvalue())
+                self.summary["top_functions"] = self._top_functions(stats)
+            if "sample" in self.modes:
+                self._write("stacks.collapsed",
+                            "".join(f"{stack} {n}\n" for stack, n in
+                                    sorted(stacks.items(), key=lambda kv: -kv[1])))
+                self.summary["top_stacks"] = [
+                    {"leaf": stack.rsplit(";", 1)[-1], "samples": n, "stack": stack}
+                    for stack, n in collections.Counter(stacks).most_common(10)]
+            if "tracemalloc" in self.modes and tracemalloc.is_tracing():
+                self._snapshot()
+        except Exception as e:
+            self.error = str(e)
+            logger.error(f"Profile {self.id} failed to finalize: {e}", exc_info=True)
+        finally:
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+            self.finished_at = time.time()
+            self.state = "failed" if self.error else "done"
+            self._done.set()
+            logger.info(f"Profile {self.id} {self.state}: {self.generations} generations, "
+                        f"{self.samples} samples, files={self.files}")
+
+    def _snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+        snapshot.dump(self._path("tracemalloc.snapshot"))
+        lines = []
+        top = snapshot.statistics("lineno")[:30]
+        for stat in top:
+            lines.append(str(stat))
+        # Allocations made from the engine's own code (the decode loop)
+        engine = snapshot.filter_traces((tracemalloc.Filter(True, "*inference_engine.py"),))
+        lines.append("\n# inference_engine.py")
+        lines.extend(str(stat) for stat in engine.statistics("lineno")[:20])
+        self._write("tracemalloc.txt", "\n".join(lines) + "\n")
+        self.summary["top_allocations"] = [
+            {"where": str(s.traceback), "size_bytes": s.size, "count": s.count} for s in top[:10]]
+        if self.peaks:
+            self.summary["generation_peak_bytes"] = {"max": max(self.peaks),
+                                                     "mean": sum(self.peaks) / len(self.peaks)}
+
+    @staticmethod
+    def _top_functions(stats, n=20):
+        rows = []
+        for (filename, line, name), (cc, nc, tt, ct, _) in stats.stats.items():
+            rows.append({"function": f"{os.path.basename(filename)}:{line}({name})",
+                         "calls": nc, "tottime_s": tt, "cumtime_s": ct})
+        rows.sort(key=lambda r: -r["cumtime_s"])
+        return rows[:n]
+
+    def _path(self, name):
+        if name not in self.files:
+            self.files.append(name)
+        return os.path.join(self.out_dir, name)
+
+    def _write(self, name, text):
+        with open(self._path(name), "w") as f:
+            f.write(text)
+
+    def file_path(self, name):
+        """Path of a result file, or None if the session did not produce it."""
+        if name not in FILES or name not in self.files:
+            return None
+        return os.path.join(self.out_dir, name)
+
+    def to_dict(self):
+        return {"id": self.id, "state": self.state, "modes": list(self.modes),
+                "seconds": self.seconds, "requests": self.requests, "interval": self.interval,
+                "started_at": self.started_at, "finished_at": self.finished_at,
+                "generations": self.generations, "samples": self.samples,
+                "files": list(self.files), "error": self.error, "summary": self.summary}
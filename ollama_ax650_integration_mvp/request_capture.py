@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Opt-in capture of request metadata for timed replay.
+
+Each finished request becomes one JSON line: arrival time, endpoint, model,
+sampling parameters, chat depth and per-message lengths, outcome, latency
+and token counts. Prompts are stored according to `prompts`:
+  - none: lengths only
+  - hash: lengths plus SHA-256 hashes of the messages, whole and one per
+          message (default), so repeated prompts and shared conversation
+          prefixes can be recognized without keeping their text
+  - text: the messages themselves
+
+Files rotate at `max_bytes`, keeping `backups` older files (capture.jsonl.1
+is the newest of those). performance_evaluation/replay_capture.py reissues
+a capture against the proxy, the Ollama port or a runtime.
+
+Enabled in backend.py with AX650_CAPTURE_FILE and in ollama_proxy.sh with
+OLLAMA_CAPTURE_FILE; AX650_CAPTURE_MAX_MB, AX650_CAPTURE_BACKUPS and
+AX650_CAPTURE_PROMPTS apply to both.
+"""
+import os
+import json
+import hashlib
+import logging
+import logging.handlers
+
+PROMPT_MODES = ("none", "hash", "text")
+
+
+def prompt_hash(messages):
+    """Stable hash of a message list (roles and contents)."""
+    canonical = json.dumps([[m.get("role", "user"), m.get("content", "")] for m in messages],
+                           ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class RequestCapture:
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backups=5, prompts="hash"):
+        if prompts not in PROMPT_MODES:
+            raise ValueError(f"prompts must be one of {PROMPT_MODES}, not {prompts!r}")
+        self.path = path
+        self.prompts = prompts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                       encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        # A private logger: the handler's lock serializes writers and rotation
+        self._logger = logging.getLogger(f"ax650.capture.{os.path.abspath(path)}")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.handlers = [handler]
+
+    @classmethod
+    def from_env(cls, path_var="AX650_CAPTURE_FILE"):
+        """A capture configured by the environment, or None if `path_var` is unset."""
+        path = os.environ.get(path_var)
+        if not path:
+            return None
+        return cls(path,
+                   max_bytes=int(float(os.environ.get("AX650_CAPTURE_MAX_MB", 64)) * 1024 * 1024),
+                   backups=int(os.environ.get("AX650_CAPTURE_BACKUPS", 5)),
+                   prompts=os.environ.get("AX650_CAPTURE_PROMPTS", "hash"))
+
+    def describe(self, messages):
+        """Prompt fields of a record for a list of {"role", "content"} messages."""
+        fields = {"n_messages": len(messages),
+                  "roles": [m.get("role", "user") for m in messages],
+                  "message_chars": [len(m.get("content", "")) for m in messages]}
+        fields["prompt_chars"] = sum(fields["message_chars"])
+        if self.prompts == "hash":
+            fields["prompt_sha256"] = prompt_hash(messages)
+            fields["message_sha256"] = [prompt_hash([m]) for m in messages]
+        elif self.prompts == "text":
+            fields["messages"] = [{"role": m.get("role", "user"), "content": m.get("content", "")}
+                                  for m in messages]
+        return fields
+
+    def record(self, messages, **fields):
+        fields.update(self.describe(messages))
+        self._logger.info(json.dumps(fields, ensure_ascii=False, default=str))
+
+    def close(self):
+        for handler in self._logger.handlers:
+            handler.close()
+
+
+def capture_files(path):
+    """The capture file and its rotated backups, oldest first."""
+    backups = []
+    n = 1
+    while os.path.exists(f"{path}.{n}"):
+        backups.append(f"{path}.{n}")
+        n += 1
+    return list(reversed(backups)) + ([path] if os.path.exists(path) else [])
+
+
+def read_capture(path):
+    """Records of a capture (including rotated files) sorted by arrival time."""
+    records = []
+    for name in capture_files(path):
+        with open(name, encoding="utf-8") as fh:
+            records.extend(json.loads(line) for line in fh if line.strip())
+    return sorted(records, key=lambda r: r.get("arrival", 0))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Deterministic response cache for the AX650 proxy.
+
+Repeated requests with the same model, prompt and deterministic sampling
+settings (top_k=1) produce the same text, so the proxy can answer them
+without another multi-second NPU generation.
+
+Two tiers:
+  - memory: LRU bounded by total bytes
+  - disk: one JSON file per entry under a directory, bounded by total bytes
+    (least recently used files go first) and kept across restarts
+
+The whole cache is dropped when the model changes (/load).
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import collections
+
+logger = logging.getLogger("AX650Proxy")
+
+
+def is_deterministic(params):
+    """True if these sampling parameters always produce the same output.
+
+    Only top_k=1 qualifies. Greedy decoding at temperature 0 and seeded
+    sampling are honoured by the Python engine, but not known to be by the
+    C++ runtime, so they are not relied on.
+    """
+    try:
+        return int(params.get("top_k")) == 1
+    except (TypeError, ValueError):
+        # Missing or malformed: the runtime path reports bad values
+        return False
+
+
+def cache_key(model_name, model_path, messages, params):
+    """Stable key for a request.
+
+    The proxy has no tokenizer, so the exact message text stands in for the
+    prompt tokens; the tokenizer is deterministic for a given model.
+    """
+    material = json.dumps({
+        "model": model_name,
+        "path": model_path,
+        "messages": messages,
+        "params": params
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier (memory LRU + disk) cache of completed generations."""
+
+    def __init__(self, directory, memory_bytes=64 * 2**20, disk_bytes=512 * 2**20):
+        self.directory = directory
+        self.memory_limit = memory_bytes
+        self.disk_limit = disk_bytes
+        self._memory = collections.OrderedDict()  # key -> (bytes, value)
+        self._memory_bytes = 0
+        self._disk = collections.OrderedDict()    # key -> size, oldest first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0,
+                      "stores": 0, "evictions": 0, "invalidations": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        """Rebuild the disk index (LRU order by mtime) after a restart."""
+        entries = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith(".json"):
+                st = os.stat(os.path.join(self.directory, fname))
+                entries.append((st.st_mtime, fname[:-5], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        if entries:
+            logger.info(f"Response cache: {len(entries)} entries ({self._disk_bytes} bytes) on disk")
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                return self._memory[key][1]
+            on_disk = self.directory and key in self._disk
+
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as fh:
+                    blob = fh.read()
+                value = json.loads(blob)
+                os.utime(self._path(key))
+            except (OSError, ValueError):
+                value = None
+            with self._lock:
+                if value is not None:
+                    self._disk.move_to_end(key)
+                    self._remember(key, value, len(blob))
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+                    return value
+                self._forget_disk(key)
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, value):
+        blob = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._remember(key, value, len(blob))
+            self.stats["stores"] += 1
+        if not self.directory:
+            return
+        tmp = self._path(key) + ".tmp"
+        try:
+            with open(tmp, "wb") as fh:
+                fh.write(blob)
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            logger.warning(f"Response cache: failed to write {key}: {e}")
+            return
+        with self._lock:
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+            self._disk[key] = len(blob)
+            self._disk_bytes += len(blob)
+            while self._disk_bytes > self.disk_limit and len(self._disk) > 1:
+                oldest = next(iter(self._disk))
+                self._forget_disk(oldest)
+                self.stats["evictions"] += 1
+
+    def _remember(self, key, value, size):
+        """Insert into the memory tier (caller holds the lock)."""
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key)[0]
+        self._memory[key] = (size, value)
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_limit and len(self._memory) > 1:
+            _, (old_size, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= old_size
+            self.stats["evictions"] += 1
+
+    def _forget_disk(self, key):
+        """Drop a disk entry (caller holds the lock)."""
+        self._disk_bytes -= self._disk.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        """Invalidate everything (the model changed)."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            for key in list(self._disk):
+                self._forget_disk(key)
+            self.stats["invalidations"] += 1
+
+    def total_bytes(self):
+        return self._memory_bytes + self._disk_bytes
+
+    def report(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(self.stats,
+                        hit_rate=(self.stats["hits"] / lookups) if lookups else 0.0,
+                        memory_entries=len(self._memory),
+                        memory_bytes=self._memory_bytes,
+                        disk_entries=len(self._disk),
+                        disk_bytes=self._disk_bytes,
+                        updated_at=time.time())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Emulation of main_api_ax650's generation cadence and failure modes.
+
+With AX650_EMULATE=1, mock_main_api.py produces tokens from this model
+instead of running the Python engine: a time to first token of
+`ttft_ms + prefill_ms_per_token * prompt_tokens`, then tokens at
+`tokens_per_sec` (default 4.5 t/s, the manufacturer's figure for Qwen3-4B
+on the C++ runtime), each delay jittered by `jitter` (relative std dev).
+Text is deterministic per prompt and seed. Generation stops at max_tokens,
+on /api/stop, or when the 1024-token context is full.
+
+Faults (AX650_EMU_FAULTS as JSON, or POST /emulator with {"faults": {...}},
+which can also set ttft_ms, prefill_ms_per_token, tokens_per_sec and jitter)
+make the runtime misbehave the way the real binary can:
+
+  {"slow_tokens": {"probability": 0.05, "delay_ms": 2000},
+   "error":       {"probability": 0.01},
+   "crash":       {"probability": 0.0, "after_tokens": 5},
+   "hang":        {"next": 1, "after_tokens": 3},
+   "reset_busy_ms": 200}
+
+Each fault fires with `probability` per request (slow_tokens: per token),
+or for the `next` N requests. A crash exits the process; a hang stops
+producing tokens and ignores /api/stop, like a wedged runtime;
+reset_busy_ms reproduces the "llm is running" window after /api/reset.
+"""
+import os
+import json
+import time
+import zlib
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_LIMIT = 1024
+# Exit status of an injected crash (EX_SOFTWARE)
+CRASH_EXIT_CODE = 70
+WORDS = ("the", "a", "model", "runs", "on", "an", "NPU", "with", "layers", "and", "each", "token",
+         "is", "sampled", "from", "logits", "after", "which", "we", "cache", "keys", "values",
+         "for", "next", "step", "so", "latency", "stays", "low", "while", "memory", "bandwidth",
+         "limits", "throughput", "of", "small", "edge", "devices", "like", "this", "one", "today")
+
+
+class EmulatedError(RuntimeError):
+    """An injected generation error."""
+
+
+def count_tokens(text):
+    """Rough token count (about four characters per token)."""
+    return max(1, (len(text) + 3) // 4)
+
+
+class RuntimeEmulator:
+    def __init__(self, ttft_ms=500.0, prefill_ms_per_token=5.0, tokens_per_sec=4.5, jitter=0.1,
+                 context_limit=CONTEXT_LIMIT, faults=None):
+        self.ttft_ms = ttft_ms
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self.tokens_per_sec = tokens_per_sec
+        self.jitter = jitter
+        self.context_limit = context_limit
+        self.faults = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+        self.set_faults(faults or {})
+
+    @classmethod
+    def from_env(cls):
+        env = os.environ.get
+        return cls(ttft_ms=float(env("AX650_EMU_TTFT_MS", 500)),
+                   prefill_ms_per_token=float(env("AX650_EMU_PREFILL_MS_PER_TOKEN", 5)),
+                   tokens_per_sec=float(env("AX650_EMU_TOKENS_PER_SEC", 4.5)),
+                   jitter=float(env("AX650_EMU_JITTER", 0.1)),
+                   faults=json.loads(env("AX650_EMU_FAULTS", "{}")))
+
+    def config(self):
+        return {"ttft_ms": self.ttft_ms, "prefill_ms_per_token": self.prefill_ms_per_token,
+                "tokens_per_sec": self.tokens_per_sec, "jitter": self.jitter,
+                "context_limit": self.context_limit, "faults": self.faults}
+
+    def set_faults(self, faults):
+        unknown = set(faults) - {"slow_tokens", "error", "crash", "hang", "reset_busy_ms"}
+        if unknown:
+            raise ValueError(f"unknown faults: {sorted(unknown)}")
+        with self._lock:
+            self.faults = {k: (dict(v) if isinstance(v, dict) else v) for k, v in faults.items()}
+
+    def _fires(self, name):
+        """Whether a per-request fault fires now; returns its spec or None."""
+        with self._lock:
+            spec = self.faults.get(name)
+            if not spec:
+                return None
+            if spec.get("next", 0) > 0:
+                spec["next"] -= 1
+                return spec
+            if self._rng.random() < spec.get("probability", 0.0):
+                return spec
+        return None
+
+    @property
+    def reset_busy_seconds(self):
+        return self.faults.get("reset_busy_ms", 0) / 1000.0
+
+    def _delay(self, ms):
+        if self.jitter:
+            ms *= max(0.1, 1.0 + self._rng.gauss(0.0, self.jitter))
+        return ms / 1000.0
+
+    def generate(self, prompt, max_tokens, emit, stop_event, context_tokens=0, seed=None):
+        """Produce tokens through `emit(text)` on the emulated cadence.
+
+        Returns Ollama-style metrics. `stop_event` ends the generation early.
+        """
+        t_start = time.perf_counter()
+        prompt_tokens = count_tokens(prompt)
+        if self._fires("error"):
+            raise EmulatedError("injected runtime error")
+        crash = self._fires("crash")
+        hang = self._fires("hang")
+        slow = self.faults.get("slow_tokens")
+        budget = max(0, min(max_tokens, self.context_limit - context_tokens - prompt_tokens))
+        words = random.Random(seed if seed is not None else zlib.crc32(prompt.encode()))
+
+        stopped = stop_event.wait(self._delay(self.ttft_ms + self.prefill_ms_per_token * prompt_tokens))
+        t_first = time.perf_counter()
+        produced = 0
+        while not stopped and produced < budget:
+            if produced:
+                delay = self._delay(1000.0 / self.tokens_per_sec)
+                if slow and self._rng.random() < slow.get("probability", 0.0):
+                    delay += slow.get("delay_ms", 1000) / 1000.0
+                if stop_event.wait(delay):
+                    break
+            if crash and produced >= crash.get("after_tokens", 0):
+                logger.error("Emulator: injected crash")
+                os._exit(CRASH_EXIT_CODE)
+            if hang and produced >= hang.get("after_tokens", 0):
+                logger.error("Emulator: injected hang (ignores /api/stop)")
+                threading.Event().wait()
+            word = words.choice(WORDS)
+            emit(word if produced == 0 else " " + word)
+            produced += 1
+        t_end = time.perf_counter()
+        ns = lambda seconds: int(seconds * 1e9)
+        return {"prompt_eval_count": prompt_tokens, "prompt_eval_duration": ns(t_first - t_start),
+                "eval_count": produced, "eval_duration": ns(t_end - t_first),
+                "total_duration": ns(t_end - t_start)}
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""Simulated axengine InferenceSession for hardware-free runs.
+
+SimulatedSession is a drop-in for `axengine.InferenceSession` with the I/O
+of the Qwen3-4B layer and post models:
+
+  layer  input [1,1,2560] bf16, K_cache/V_cache [1,1023,1024] bf16,
+         indices [1,1] uint32, mask [1,1,1024] bf16
+         -> K_cache_out [1,1,1024], V_cache_out [1,1,1024], output [1,1,2560] (bf16)
+  post   input [1,1,2560] bf16 -> output [1,1,151936] bf16
+
+Inputs are checked like the runtime would (missing names, wrong shapes or
+dtypes raise ValueError) and every run() waits according to a latency
+model, calibrated by default from the Nov 2025 profile (0.68 s of layer
+time per step over 37 NPU calls, i.e. ~18.4 ms per call).
+
+Faults (the "faults" section of simulation.json, or set_faults()) make the
+sessions misbehave like a wedged device:
+
+  {"hang": {"layer": 5, "next": 1, "seconds": 30}}
+
+A hang blocks one run() of `layer` (an index or "post"; any layer if
+omitted) for `seconds` before it returns, for the `next` N calls or with
+`probability` per call, so the watchdog has a stall to detect and recover.
+
+`create_model_dir()` writes a synthetic model directory (layer/post
+.axmodel stubs, a sparse embedding file, a byte-level tokenizer with the
+Qwen special-token ids and simulation.json), so that with AX650_SIMULATE=1
+`AX650Backend.load_model()` and the whole `_generate_qwen3_4b` path run on
+any Linux box:
+
+  python3 sim_session.py create /tmp/qwen3-sim
+  AX650_SIMULATE=1 AX650_MODEL_PATH=/tmp/qwen3-sim python3 mock_main_api.py
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+
+import numpy as np
+import ml_dtypes
+
+HIDDEN = 2560
+KV_DIM = 1024
+KV_LEN = 1023
+VOCAB = 151936
+NUM_LAYERS = 36
+# Qwen special tokens (kept at their real ids in the synthetic tokenizer)
+SPECIAL_TOKENS = {"<|endoftext|>": 151643, "<|im_start|>": 151644, "<|im_end|>": 151645}
+CHAT_TEMPLATE = ("{% for message in messages %}<|im_start|>{{ message['role'] }}\n"
+                 "{{ message['content'] }}<|im_end|>\n{% endfor %}"
+                 "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}")
+CONFIG_FILE = "simulation.json"
+MAGIC = "ax650-sim"
+
+BF16 = np.dtype(ml_dtypes.bfloat16)
+NodeArg = collections.namedtuple("NodeArg", ("name", "shape", "dtype"))
+
+LAYER_INPUTS = (
+    NodeArg("input", (1, 1, HIDDEN), BF16),
+    NodeArg("K_cache", (1, KV_LEN, KV_DIM), BF16),
+    NodeArg("V_cache", (1, KV_LEN, KV_DIM), BF16),
+    NodeArg("indices", (1, 1), np.dtype(np.uint32)),
+    NodeArg("mask", (1, 1, KV_LEN + 1), BF16),
+)
+LAYER_OUTPUTS = (
+    NodeArg("K_cache_out", (1, 1, KV_DIM), BF16),
+    NodeArg("V_cache_out", (1, 1, KV_DIM), BF16),
+    NodeArg("output", (1, 1, HIDDEN), BF16),
+)
+POST_INPUTS = (NodeArg("input", (1, 1, HIDDEN), BF16),)
+POST_OUTPUTS = (NodeArg("output", (1, 1, VOCAB), BF16),)
+
+
+class LatencyModel:
+    """Per-call latency: base (per layer or default) + position slope, with jitter.
+
+    `mode` is "sleep" (releases the GIL like a blocking driver call), "spin"
+    (busy-waits for sub-millisecond accuracy) or "none"; `scale` multiplies
+    every latency (e.g. 0.01 for fast functional runs).
+    """
+
+    def __init__(self, layer_ms=18.4, post_ms=18.4, per_position_us=0.0, jitter=0.05,
+                 layer_ms_by_index=None, mode="sleep", scale=1.0, seed=0):
+        self.layer_ms = layer_ms
+        self.post_ms = post_ms
+        self.per_position_us = per_position_us
+        self.jitter = jitter
+        self.layer_ms_by_index = {int(k): v for k, v in (layer_ms_by_index or {}).items()}
+        self.mode = os.environ.get("AX650_SIM_MODE", mode)
+        self.scale = float(os.environ.get("AX650_SIM_SCALE", scale))
+        self._rng = random.Random(seed)
+
+    def seconds(self, layer, position):
+        if layer == "post":
+            base = self.post_ms
+        else:
+            base = self.layer_ms_by_index.get(layer, self.layer_ms)
+        ms = base + self.per_position_us * position / 1000.0
+        if self.jitter:
+            ms *= max(0.0, 1.0 + self._rng.gauss(0.0, self.jitter))
+        return ms * self.scale / 1000.0
+
+    def wait(self, seconds):
+        if self.mode == "none" or seconds <= 0:
+            return
+        if self.mode == "spin":
+            end = time.perf_counter() + seconds
+            while time.perf_counter() < end:
+                pass
+        else:
+            time.sleep(seconds)
+
+    def to_dict(self):
+        return {"layer_ms": self.layer_ms, "post_ms": self.post_ms, "per_position_us": self.per_position_us,
+                "jitter": self.jitter, "layer_ms_by_index": self.layer_ms_by_index,
+                "mode": self.mode, "scale": self.scale}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{k: v for k, v in data.items()
+                      if k in ("layer_ms", "post_ms", "per_position_us", "jitter", "layer_ms_by_index",
+                               "mode", "scale", "seed")})
+
+    @classmethod
+    def from_layer_stats(cls, stats, jitter=0.05):
+        """Calibrate from a LayerStats snapshot (layer_report.py --save).
+
+        Per-layer medians become the base latencies and a least-squares fit
+        of median latency against context position gives the slope.
+        """
+        by_layer = stats.by_layer()
+        layers = {k: s.quantile(0.5) * 1e3 for k, s in by_layer.items() if k != "post"}
+        post = by_layer.get("post")
+        xs, ys = [], []
+        for (layer, bucket), s in stats.sketches.items():
+            if layer != "post" and layer in layers:
+                xs.append((bucket + 0.5) * stats.position_bucket)
+                ys.append(s.quantile(0.5) * 1e3 - layers[layer])
+        slope_us = float(np.polyfit(xs, ys, 1)[0]) * 1000.0 if len(set(xs)) > 1 else 0.0
+        mean_layer = sum(layers.values()) / len(layers) if layers else 18.4
+        return cls(layer_ms=mean_layer, post_ms=post.quantile(0.5) * 1e3 if post else mean_layer,
+                   per_position_us=max(0.0, slope_us), jitter=jitter, layer_ms_by_index=layers)
+
+
+class SimFaults:
+    """Injected failures, shared by the sessions of one synthetic directory."""
+
+    def __init__(self, faults=None):
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+        self.set(faults or {})
+
+    def set(self, faults):
+        unknown = set(faults) - {"hang"}
+        if unknown:
+            raise ValueError(f"unknown faults: {sorted(unknown)}")
+        with self._lock:
+            self.faults = {k: dict(v) for k, v in faults.items()}
+
+    def hang_seconds(self, layer):
+        """How long this run() of `layer` hangs (0 if it does not)."""
+        with self._lock:
+            spec = self.faults.get("hang")
+            if not spec or spec.get("layer", layer) != layer:
+                return 0.0
+            if spec.get("next", 0) > 0:
+                spec["next"] -= 1
+            elif self._rng.random() >= spec.get("probability", 0.0):
+                return 0.0
+            return float(spec.get("seconds", 60.0))
+
+
+_MODELS = {}
+_FAULTS = {}
+
+
+def _latency_model(model_dir):
+    """One LatencyModel per synthetic directory, shared by its sessions."""
+    model = _MODELS.get(model_dir)
+    if model is None:
+        path = os.path.join(model_dir, CONFIG_FILE)
+        data = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f).get("latency", {})
+        model = _MODELS[model_dir] = LatencyModel.from_dict(data)
+    return model
+
+
+def _faults(model_dir):
+    """One SimFaults per synthetic directory, shared by its sessions."""
+    faults = _FAULTS.get(model_dir)
+    if faults is None:
+        path = os.path.join(model_dir, CONFIG_FILE)
+        data = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f).get("faults", {})
+        faults = _FAULTS[model_dir] = SimFaults(data)
+    return faults
+
+
+def set_faults(model_dir, faults):
+    """Replace the faults of a synthetic directory's sessions (in this process)."""
+    _faults(os.path.abspath(model_dir)).set(faults)
+
+
+def _byte_vocab():
+    from tokenizers import pre_tokenizers
+    return {ch: i for i, ch in enumerate(sorted(pre_tokenizers.ByteLevel.alphabet()))}
+
+
+def _text_token_ids():
+    """Ids of a-z and space ("\u0120" in byte-level form) in the synthetic vocab."""
+    vocab = _byte_vocab()
+    return [vocab[ch] for ch in "abcdefghijklmnopqrstuvwxyz\u0120"]
+
+
+class SimulatedSession:
+    """Stands in for axengine.InferenceSession(path)."""
+
+    def __init__(self, path, **_):
+        with open(path) as f:
+            header = json.load(f)
+        if header.get("format") != MAGIC:
+            raise ValueError(f"{path} is not a simulated axmodel")
+        self.path = path
+        self.kind = header["kind"]
+        self.layer = header.get("index", "post")
+        self.latency = _latency_model(os.path.dirname(os.path.abspath(path)))
+        self.faults = _faults(os.path.dirname(os.path.abspath(path)))
+        self._inputs = LAYER_INPUTS if self.kind == "layer" else POST_INPUTS
+        self._outputs = LAYER_OUTPUTS if self.kind == "layer" else POST_OUTPUTS
+        if self.kind == "post":
+            # A bank of logit rows concentrated on letters and spaces of the
+            # synthetic tokenizer, so sampling produces readable text and
+            # never an EOS token
+            rng = np.random.default_rng(0)
+            ids = _text_token_ids()
+            bank = np.full((64, VOCAB), -20.0, dtype=np.float32)
+            bank[:, ids] = rng.normal(0.0, 2.0, size=(64, len(ids)))
+            self._bank = bank.astype(BF16)
+        self.calls = 0
+
+    def get_inputs(self):
+        return list(self._inputs)
+
+    def get_outputs(self):
+        return list(self._outputs)
+
+    def _check(self, feed):
+        for arg in self._inputs:
+            if arg.name not in feed:
+                raise ValueError(f"{os.path.basename(self.path)}: missing input '{arg.name}'")
+            value = np.asarray(feed[arg.name])
+            if value.shape != arg.shape or value.dtype != arg.dtype:
+                raise ValueError(f"{os.path.basename(self.path)}: input '{arg.name}' expects "
+                                 f"{arg.dtype}{list(arg.shape)}, got {value.dtype}{list(value.shape)}")
+
+    def run(self, output_names, input_feed, **_):
+        self._check(input_feed)
+        self.calls += 1
+        hidden = input_feed["input"]
+        if self.kind == "layer":
+            position = int(input_feed["indices"][0, 0])
+            seconds = self.latency.seconds(self.layer, position)
+            out = hidden.copy()
+            # Mark (layer, position) in the hidden state so the post model's
+            # choice of logits depends on where we are in the sequence
+            out[0, 0, (position * 7 + self.layer) % HIDDEN] += 1
+            results = {"K_cache_out": hidden[:, :, :KV_DIM].copy(),
+                       "V_cache_out": hidden[:, :, KV_DIM:2 * KV_DIM].copy(),
+                       "output": out}
+        else:
+            seconds = self.latency.seconds("post", 0)
+            row = int(np.argmax(hidden.reshape(-1).astype(np.float32))) % len(self._bank)
+            results = {"output": self._bank[row].reshape(1, 1, VOCAB).copy()}
+        hang = self.faults.hang_seconds(self.layer)
+        if hang:
+            time.sleep(hang)
+        self.latency.wait(seconds)
+        names = output_names or [arg.name for arg in self._outputs]
+        return [results[name] for name in names]
+
+
+def _write_tokenizer(model_dir):
+    """Byte-level tokenizer (no merges) with the Qwen special-token ids."""
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+    from transformers import PreTrainedTokenizerFast
+    vocab = _byte_vocab()
+    vocab.update(SPECIAL_TOKENS)
+    tok = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    fast = PreTrainedTokenizerFast(tokenizer_object=tok, eos_token="<|im_end|>", pad_token="<|endoftext|>",
+                                   additional_special_tokens=["<|im_start|>"])
+    fast.chat_template = CHAT_TEMPLATE
+    fast.save_pretrained(model_dir)
+
+
+def create_model_dir(model_dir, num_layers=NUM_LAYERS, latency=None, faults=None):
+    """Write a synthetic Qwen3-4B model directory loadable by AX650Backend."""
+    os.makedirs(model_dir, exist_ok=True)
+    for i in range(num_layers):
+        with open(os.path.join(model_dir, f"qwen3_p128_l{i}_together.axmodel"), "w") as f:
+            json.dump({"format": MAGIC, "kind": "layer", "index": i}, f)
+    with open(os.path.join(model_dir, "qwen3_post.axmodel"), "w") as f:
+        json.dump({"format": MAGIC, "kind": "post"}, f)
+    with open(os.path.join(model_dir, CONFIG_FILE), "w") as f:
+        json.dump({"latency": (latency or LatencyModel()).to_dict(), "faults": faults or {}}, f, indent=2)
+    # Zero embeddings as a sparse .npy: 1.5 GB logical, a few KB on disk
+    embed = os.path.join(model_dir, "model.embed_tokens.weight.npy")
+    if not os.path.exists(embed):
+        np.lib.format.open_memmap(embed, mode="w+", dtype=np.float32, shape=(VOCAB, HIDDEN)).flush()
+    _write_tokenizer(model_dir)
+    _MODELS.pop(os.path.abspath(model_dir), None)
+    _FAULTS.pop(os.path.abspath(model_dir), None)
+    return model_dir
+
+
+def main():
+    p = argparse.ArgumentParser(description="Synthetic AX650 model directories")
+    sub = p.add_subparsers(dest="command", required=True)
+    c = sub.add_parser("create", help="Write a synthetic Qwen3-4B model directory")
+    c.add_argument("model_dir")
+    c.add_argument("--layers", type=int, default=NUM_LAYERS)
+    c.add_argument("--layer-ms", type=float, default=18.4)
+    c.add_argument("--post-ms", type=float, default=18.4)
+    c.add_argument("--per-position-us", type=float, default=0.0,
+                   help="Extra latency per context position (us)")
+    c.add_argument("--jitter", type=float, default=0.05, help="Relative standard deviation")
+    c.add_argument("--mode", choices=("sleep", "spin", "none"), default="sleep")
+    c.add_argument("--scale", type=float, default=1.0)
+    c.add_argument("--calibrate", help="LayerStats snapshot (layer_report.py --save) to calibrate from")
+    c.add_argument("--faults", default="{}", help='Injected faults as JSON, e.g. \'{"hang": {"layer": 5, "next": 1}}\'')
+    args = p.parse_args()
+
+    if args.calibrate:
+        from layer_stats import LayerStats
+        with open(args.calibrate) as f:
+            latency = LatencyModel.from_layer_stats(LayerStats.from_dict(json.load(f)), args.jitter)
+        latency.mode, latency.scale = args.mode, args.scale
+    else:
+        latency = LatencyModel(args.layer_ms, args.post_ms, args.per_position_us, args.jitter,
+                               mode=args.mode, scale=args.scale)
+    create_model_dir(args.model_dir, args.layers, latency, json.loads(args.faults))
+    print(f"Wrote synthetic model to {args.model_dir}: {json.dumps(latency.to_dict())}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
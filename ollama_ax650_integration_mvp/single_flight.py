@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Single-flight coalescing of identical generations.
+
+The NPU runs one generation at a time per runtime, so identical requests
+(dashboards refreshing, clients retrying) would otherwise queue up and
+repeat the same work. The first request for a key becomes the leader and
+runs the generation; later ones attach to its Flight and receive the same
+chunk stream from the beginning, including chunks produced before they
+arrived.
+"""
+import threading
+
+
+class Flight:
+    """One generation and the chunks it has produced so far."""
+
+    def __init__(self, key=None):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self.subscribers = 1
+        self.delivered = False  # a streaming reader has seen a chunk
+        self._cond = threading.Condition()
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def rewind(self):
+        """Forget published chunks before a retry; False if already streamed."""
+        with self._cond:
+            if self.delivered:
+                return False
+            self.chunks = []
+            return True
+
+    def finish(self, result=None, error=None):
+        with self._cond:
+            self.result = result
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """Block until the generation ends; returns the result or raises its error."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.done, timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def stream(self):
+        """Yield every chunk from the start, then return once the flight ends."""
+        i = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.done or i < len(self.chunks))
+                pending = self.chunks[i:]
+                finished = self.done
+                if pending:
+                    self.delivered = True
+            for chunk in pending:
+                yield chunk
+            i += len(pending)
+            if finished and i >= len(self.chunks):
+                return
+
+
+class FlightTable:
+    """In-flight generations by key."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def join(self, key):
+        """Return (flight, leader). The leader must run it and call land()."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.subscribers += 1
+                self.stats["coalesced"] += 1
+                return flight, False
+            flight = Flight(key)
+            self._flights[key] = flight
+            self.stats["leaders"] += 1
+            return flight, True
+
+    def land(self, flight):
+        """Stop accepting subscribers for a finished (or failed) flight."""
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def report(self):
+        with self._lock:
+            return dict(self.stats,
+                        in_flight=len(self._flights),
+                        subscribers=sum(f.subscribers for f in self._flights.values()))
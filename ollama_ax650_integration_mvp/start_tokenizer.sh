@@ -1,7 +1,12 @@
 #!/bin/bash
 # Start the tokenizer service required by the C++ runtime
+#
+# backend.py starts tokenizer_service.py itself (AX650_TOKENIZER); use this
+# to run it on its own. Extra arguments go to tokenizer_service.py.
 
-cd "$(dirname "$0")/../ax650_raspberry_pi_services/reference_projects_and_documentation/Qwen3-4B"
+cd "$(dirname "$0")"
 
-echo "Starting Qwen3 tokenizer service on port 12345..."
-python3 qwen3_tokenizer_uid.py
+TOKENIZER_PATH="${AX650_TOKENIZER_PATH:-../ax650_raspberry_pi_services/reference_projects_and_documentation/Qwen3-4B/qwen3_tokenizer}"
+
+echo "Starting Qwen3 tokenizer service on port ${AX650_TOKENIZER_PORT:-12345}..."
+exec python3 tokenizer_service.py --model-path "$TOKENIZER_PATH" --port "${AX650_TOKENIZER_PORT:-12345}" "$@"
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""Continuous device telemetry.
+
+One long-running collector replaces the per-sample `axcl-smi` calls of the
+profiling scripts: it parses the whole `axcl-smi` table (NPU and device CPU
+utilization, temperature, power, system and CMM memory of every card), adds
+the host CPU from /proc/stat, and keeps the samples in a fixed-size ring
+buffer that can be queried by time range and exported as CSV or JSON.
+Samples also feed the Prometheus gauges and the NPU counter track of the
+Chrome trace export.
+
+The pyaxcl bindings the engine uses only provide device management
+(`axcl.rt.reset_device`), so readings come from `axcl-smi`, run in a loop
+whose output is parsed as it streams. The default loop is a shell loop:
+each sample still forks `axcl-smi` (and `sleep`), but from one long-lived
+shell, off the collector's thread. `AX650_AXCL_SMI_CMD` replaces it, e.g.
+with the tool's own continuous mode where the installed version has one,
+which removes the per-sample fork. Sources are
+plain objects with `read()` (and optionally `close()`);
+`AX650_AXCL_SMI_FIXTURE` points the collector at recorded output instead
+of the tool (frames separated by `%%` lines).
+"""
+import os
+import re
+import csv
+import io
+import time
+import shlex
+import shutil
+import logging
+import threading
+import subprocess
+import collections
+
+import tracing
+from metrics_registry import Gauge
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("npu_pct", "cpu_pct", "temp_c", "power_w", "mem_used_mib", "mem_total_mib",
+          "cmm_used_mib", "cmm_total_mib")
+HOST = "host"
+
+# |    0  AX650N                    V2.26.0 | 0000:01:00.0 |                153 MiB /      954 MiB |
+_CARD_RE = re.compile(r"^\|\s+(\d+)\s+(\S+)\s+(\S+)\s+\|\s+(\S+)\s+\|\s+(\d+)\s*MiB\s*/\s*(\d+)\s*MiB\s*\|")
+# |   --   52C                      -- / -- | 2%       27% |               4747 MiB /     7040 MiB |
+_STATUS_RE = re.compile(r"^\|\s+(\S+)\s+(\d+)C\s+(\S+)\s*/\s*(\S+)\s+\|\s+(\d+)%\s+(\d+)%\s+\|"
+                        r"\s+(\d+)\s*MiB\s*/\s*(\d+)\s*MiB\s*\|")
+
+DEVICE_NPU = Gauge("ax650_device_npu_percent", "NPU utilization reported by axcl-smi", ("device",))
+DEVICE_CPU = Gauge("ax650_device_cpu_percent", "Device CPU utilization reported by axcl-smi", ("device",))
+DEVICE_TEMP = Gauge("ax650_device_temperature_celsius", "Device temperature", ("device",))
+DEVICE_CMM_USED = Gauge("ax650_device_cmm_used_bytes", "CMM (NPU) memory in use", ("device",))
+DEVICE_CMM_TOTAL = Gauge("ax650_device_cmm_total_bytes", "CMM (NPU) memory size", ("device",))
+HOST_CPU = Gauge("ax650_host_cpu_percent", "Host CPU utilization (all cores)")
+
+
+def _watts(value):
+    try:
+        return float(value.rstrip("W"))
+    except ValueError:
+        return None
+
+
+def parse_axcl_smi(text):
+    """Parse the `axcl-smi` device table into one dict per card."""
+    cards = []
+    card = None
+    for line in text.splitlines():
+        m = _CARD_RE.match(line)
+        if m:
+            card = {"device": int(m.group(1)), "name": m.group(2), "firmware": m.group(3),
+                    "bus_id": m.group(4), "mem_used_mib": int(m.group(5)), "mem_total_mib": int(m.group(6))}
+            continue
+        m = _STATUS_RE.match(line)
+        if m and card is not None:
+            card.update(temp_c=int(m.group(2)), power_w=_watts(m.group(3)),
+                        cpu_pct=int(m.group(5)), npu_pct=int(m.group(6)),
+                        cmm_used_mib=int(m.group(7)), cmm_total_mib=int(m.group(8)))
+            cards.append(card)
+            card = None
+    return cards
+
+
+class AxclSmiSource:
+    """Latest frame of a long-running `axcl-smi` loop (see the module docstring).
+
+    A reader thread parses frames as they stream in; a frame ends at a `%%`
+    line, the next banner or the processes table. read() returns the newest
+    cards; it raises (and restarts the loop) if the loop exited, and raises
+    if no frame has arrived for a while.
+    """
+
+    def __init__(self, binary=None, interval=1.0, command=None):
+        self.binary = binary or shutil.which("axcl-smi")
+        self.interval = interval
+        if command is None and os.environ.get("AX650_AXCL_SMI_CMD"):
+            command = shlex.split(os.environ["AX650_AXCL_SMI_CMD"])
+        # The loop ends with its parent, even one that was killed
+        self.command = command or ["sh", "-c", 'while kill -0 $PPID 2>/dev/null; do "$0"; echo %%; '
+                                   f'sleep {interval}; done', self.binary]
+        self.cards = []
+        self.frames = 0
+        self._frame_at = None
+        self._started_at = None
+        self._proc = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._proc = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                      text=True, bufsize=1)
+        self._started_at = time.monotonic()
+        threading.Thread(target=self._pump, args=(self._proc,), name="ax650-axcl-smi", daemon=True).start()
+
+    def _pump(self, proc):
+        lines = []
+        for line in proc.stdout:
+            if line.startswith("%%") or "AXCL-SMI" in line or "Processes:" in line:
+                cards = parse_axcl_smi("".join(lines))
+                lines = []
+                if cards:
+                    with self._lock:
+                        self.cards = cards
+                        self.frames += 1
+                        self._frame_at = time.monotonic()
+            else:
+                lines.append(line)
+
+    def read(self):
+        with self._lock:
+            if self._closed:
+                return []
+            if self._proc is None:
+                self._start()
+            elif self._proc.poll() is not None:
+                code = self._proc.returncode
+                self.cards = []
+                self._start()
+                raise RuntimeError(f"axcl-smi loop exited with code {code}; restarted")
+            cards, last = self.cards, max(self._frame_at or 0.0, self._started_at)
+        if time.monotonic() - last > 3 * self.interval + 5:
+            raise RuntimeError(f"axcl-smi produced no output for {time.monotonic() - last:.0f}s")
+        return cards
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._proc is not None and self._proc.poll() is None:
+                self._proc.terminate()
+                try:
+                    self._proc.wait(timeout=2)
+                except subprocess.TimeoutExpired:
+                    self._proc.kill()
+            self._proc = None
+
+
+class FixtureSource:
+    """Replays recorded `axcl-smi` output, cycling through its frames."""
+
+    def __init__(self, path):
+        with open(path) as f:
+            self.frames = [frame for frame in re.split(r"^%%\s*$", f.read(), flags=re.M) if frame.strip()]
+        self._next = 0
+
+    def read(self):
+        frame = self.frames[self._next % len(self.frames)]
+        self._next += 1
+        return parse_axcl_smi(frame)
+
+
+def default_source(interval=1.0):
+    """Fixture if configured, else axcl-smi if installed, else None."""
+    fixture = os.environ.get("AX650_AXCL_SMI_FIXTURE")
+    if fixture:
+        return FixtureSource(fixture)
+    if shutil.which("axcl-smi"):
+        return AxclSmiSource(interval=interval)
+    return None
+
+
+class HostCpu:
+    """Whole-host CPU utilization between successive calls, from /proc/stat."""
+
+    def __init__(self):
+        self._last = self._read()
+
+    @staticmethod
+    def _read():
+        try:
+            with open("/proc/stat") as f:
+                values = [int(v) for v in f.readline().split()[1:]]
+            idle = values[3] + (values[4] if len(values) > 4 else 0)
+            return sum(values), idle
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def percent(self):
+        current = self._read()
+        last, self._last = self._last, current
+        if current is None or last is None or current[0] == last[0]:
+            return None
+        total, idle = current[0] - last[0], current[1] - last[1]
+        return round(100.0 * (total - idle) / total, 1)
+
+
+class TimeSeries:
+    """Fixed-size ring buffer of (wall time, perf_counter, device, values)."""
+
+    def __init__(self, capacity=20000):
+        self.samples = collections.deque(maxlen=capacity)
+
+    def append(self, wall, mono, device, values):
+        self.samples.append((wall, mono, device, tuple(values.get(f) for f in FIELDS)))
+
+    def query(self, since=None, until=None, device=None):
+        """Samples as dicts; since/until are wall-clock seconds."""
+        rows = []
+        for wall, mono, dev, values in list(self.samples):
+            if since is not None and wall < since:
+                continue
+            if until is not None and wall > until:
+                continue
+            if device is not None and str(dev) != str(device):
+                continue
+            row = {"time": wall, "perf_counter": mono, "device": dev}
+            row.update((f, v) for f, v in zip(FIELDS, values) if v is not None)
+            rows.append(row)
+        return rows
+
+    def summary(self, since=None, until=None):
+        """min/mean/max/last of every field, per device."""
+        by_device = collections.defaultdict(lambda: collections.defaultdict(list))
+        for row in self.query(since, until):
+            for f in FIELDS:
+                if f in row:
+                    by_device[str(row["device"])][f].append(row[f])
+        return {dev: {f: {"min": min(v), "mean": sum(v) / len(v), "max": max(v), "last": v[-1],
+                          "samples": len(v)} for f, v in fields.items()}
+                for dev, fields in by_device.items()}
+
+    @staticmethod
+    def to_csv(rows):
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=("time", "perf_counter", "device") + FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+        return out.getvalue()
+
+
+class TelemetryCollector(threading.Thread):
+    """Samples the source every `interval` seconds into `series`."""
+
+    def __init__(self, interval=1.0, source=None, capacity=20000, recorder=tracing.SPANS):
+        super().__init__(name="ax650-telemetry", daemon=True)
+        self.interval = interval
+        self.source = source if source is not None else default_source(interval)
+        self.series = TimeSeries(capacity)
+        self.recorder = recorder
+        self.errors = 0
+        self._host_cpu = HostCpu()
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        """Take one sample now (also used directly by tests)."""
+        wall, mono = time.time(), time.perf_counter()
+        cards = []
+        if self.source is not None:
+            try:
+                cards = self.source.read()
+            except Exception as e:
+                self.errors += 1
+                logger.debug(f"Telemetry read failed: {e}")
+        for card in cards:
+            device = card["device"]
+            self.series.append(wall, mono, device, card)
+            DEVICE_NPU.labels(device).set(card["npu_pct"])
+            DEVICE_CPU.labels(device).set(card["cpu_pct"])
+            DEVICE_TEMP.labels(device).set(card["temp_c"])
+            DEVICE_CMM_USED.labels(device).set(card["cmm_used_mib"] * 1024 * 1024)
+            DEVICE_CMM_TOTAL.labels(device).set(card["cmm_total_mib"] * 1024 * 1024)
+        if cards and self.recorder is not None:
+            self.recorder.counter("npu", mono, {f"device{c['device']}_pct": c["npu_pct"] for c in cards})
+        host = self._host_cpu.percent()
+        if host is not None:
+            self.series.append(wall, mono, HOST, {"cpu_pct": host})
+            HOST_CPU.set(host)
+        return cards
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        close = getattr(self.source, "close", None)
+        if close is not None:
+            close()
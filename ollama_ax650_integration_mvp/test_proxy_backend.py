@@ -2,13 +2,20 @@
 """Test script for the Hybrid Proxy Backend (Direct).
 
 Verifies that the proxy correctly forwards requests to the mock C++ server
-and returns the generated text.
+and returns the generated text, and (starting its own proxy) that a pool
+of mock runtimes shares the load and is restarted after a crash.
 """
+import os
+import signal
+import subprocess
+import sys
+import threading
 import requests
 import json
 import time
 
 PROXY_URL = "http://localhost:5002"
+POOL_PORT = 5092
 
 def test_health():
     print("Testing /health...")
@@ -47,6 +54,74 @@ def test_generate():
         print(f"Generate failed: {e}")
         exit(1)
 
+def _pool_health(url, ready, timeout=60):
+    """Poll /health until ready(health) holds; returns the last health."""
+    deadline = time.time() + timeout
+    health = None
+    while time.time() < deadline:
+        try:
+            health = requests.get(f"{url}/health", timeout=2).json()
+            if ready(health):
+                return health
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise AssertionError(f"Timed out waiting for the pool: {json.dumps(health, indent=2)}")
+
+def test_runtime_pool():
+    print("\nTesting a pool of two mock runtimes...")
+    url = f"http://localhost:{POOL_PORT}"
+    env = dict(os.environ, AX650_PORT=str(POOL_PORT), AX650_RUNTIME_SLOTS="2", AX650_USE_MOCK="1",
+               AX650_EMULATE="1", AX650_EMU_TTFT_MS="300", AX650_EMU_TOKENS_PER_SEC="50", AX650_TELEMETRY_INTERVAL="0",
+               AX650_PROBE_INTERVAL="0.2")
+    backend = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             "backend.py")],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pids = []
+    try:
+        health = _pool_health(url, lambda h: len(h["runtimes"]) == 2 and all(r["healthy"] for r in h["runtimes"]))
+        pids = [r["pid"] for r in health["runtimes"]]
+        print(f"Runtimes: {[(r['slot'], r['url']) for r in health['runtimes']]}")
+
+        # Two concurrent requests go to the least-loaded runtime: one each
+        results = []
+        def generate(prompt):
+            resp = requests.post(f"{url}/generate", json={"prompt": prompt, "max_tokens": 8}, timeout=60)
+            results.append(resp.status_code)
+        threads = [threading.Thread(target=generate, args=(p,)) for p in ("Why is the sky blue?", "Name a color.")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        health = requests.get(f"{url}/health").json()
+        served = [r["served"] for r in health["runtimes"]]
+        print(f"Statuses: {results}, served per runtime: {served}")
+        assert results == [200, 200]
+        assert served == [1, 1]
+
+        # The supervisor restarts a runtime that dies
+        os.kill(pids[0], signal.SIGKILL)
+        health = _pool_health(url, lambda h: h["runtimes"][0]["restarts"] == 1 and h["runtimes"][0]["healthy"])
+        runtime = health["runtimes"][0]
+        print(f"Restarted: crashes={runtime['crashes']} restarts={runtime['restarts']} pid={runtime['pid']}")
+        assert runtime["crashes"] == 1 and runtime["pid"] != pids[0]
+        pids.append(runtime["pid"])
+        for prompt in ("Why is the sky blue?", "Name a color."):
+            resp = requests.post(f"{url}/generate", json={"prompt": prompt, "max_tokens": 8}, timeout=60)
+            assert resp.status_code == 200, resp.text
+    finally:
+        backend.send_signal(signal.SIGINT)
+        try:
+            backend.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            backend.kill()
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
 if __name__ == "__main__":
     test_health()
     test_generate()
+    test_runtime_pool()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Test script for the device telemetry parser and sources (telemetry.py).
+
+Parses the recorded `axcl-smi` frames in fixtures/axcl_smi.txt, and runs
+AxclSmiSource's streaming loop against a stand-in for the tool that prints
+those frames.
+"""
+import os
+import stat
+import tempfile
+import time
+
+from telemetry import AxclSmiSource, FixtureSource, TelemetryCollector
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "axcl_smi.txt")
+
+
+def test_fixture_frames():
+    print("Testing axcl-smi parsing...")
+    source = FixtureSource(FIXTURE)
+    assert len(source.frames) == 3
+    idle, busy, pool = source.read(), source.read(), source.read()
+    print(f"Frames: {idle}, {busy}, {pool}")
+
+    assert idle == [{"device": 0, "name": "AX650N", "firmware": "V2.26.0", "bus_id": "0000:01:00.0",
+                     "mem_used_mib": 153, "mem_total_mib": 954, "temp_c": 41, "power_w": None,
+                     "cpu_pct": 1, "npu_pct": 0, "cmm_used_mib": 18, "cmm_total_mib": 7040}]
+    assert (busy[0]["npu_pct"], busy[0]["cmm_used_mib"], busy[0]["temp_c"]) == (27, 4747, 52)
+    assert [c["device"] for c in pool] == [0, 1]
+    assert pool[1]["bus_id"] == "0000:03:00.0" and pool[1]["power_w"] == 2.1 and pool[1]["npu_pct"] == 41
+    # Cycles back to the first frame
+    assert source.read() == idle
+
+
+def test_collector_samples():
+    print("\nTesting collector samples...")
+    collector = TelemetryCollector(interval=0, source=FixtureSource(FIXTURE), recorder=None)
+    for _ in range(3):
+        collector.sample()
+    summary = collector.series.summary()
+    print(f"Summary: {summary['0']['npu_pct']}")
+    assert summary["0"]["npu_pct"]["samples"] == 3 and summary["0"]["npu_pct"]["max"] == 96
+    assert summary["1"]["npu_pct"]["last"] == 41
+    assert collector.errors == 0
+
+
+def test_streaming_source():
+    print("\nTesting the axcl-smi loop...")
+    with tempfile.TemporaryDirectory() as tmp:
+        # Stand-in for axcl-smi: prints one recorded frame per run
+        frames = FixtureSource(FIXTURE).frames
+        binary = os.path.join(tmp, "axcl-smi")
+        with open(binary, "w") as f:
+            f.write(f'#!/bin/sh\nn=$(cat {tmp}/n 2>/dev/null || echo 0)\necho $((n + 1)) > {tmp}/n\n'
+                    f'cat {tmp}/frame$((n % {len(frames)}))\n')
+        os.chmod(binary, os.stat(binary).st_mode | stat.S_IEXEC)
+        for i, frame in enumerate(frames):
+            with open(os.path.join(tmp, f"frame{i}"), "w") as f:
+                f.write(frame.strip("\n") + "\n")
+
+        source = AxclSmiSource(binary, interval=0.05)
+        try:
+            assert source.read() == []  # the loop has just started
+            deadline = time.time() + 10
+            while source.frames < 4 and time.time() < deadline:
+                time.sleep(0.05)
+            print(f"Frames parsed: {source.frames}, latest: {source.read()}")
+            assert source.frames >= 4
+            # Every frame was parsed whole: one or two cards, never a partial one
+            assert all(len(c) == 12 for c in source.read())
+        finally:
+            source.close()
+        assert source.read() == []
+
+
+if __name__ == "__main__":
+    test_fixture_frames()
+    test_collector_samples()
+    test_streaming_source()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Test script for the step watchdog (watchdog.py).
+
+Runs the engine on a synthetic model (sim_session.py) whose layer 2 hangs
+once, and checks that the watchdog records the incident, recovers the
+device, abandons the stalled generation and serves the next one.
+"""
+import os
+import tempfile
+import time
+
+os.environ.update(AX650_SIMULATE="1", AX650_SIM_MODE="none", AX650_WATCHDOG="1",
+                  AX650_WATCHDOG_DEFAULT_BUDGET="0.5", AX650_WATCHDOG_MIN_BUDGET="0.5")
+
+import sim_session
+from inference_engine import AX650Backend
+from layer_stats import LayerStats
+from watchdog import MIN_HISTORY, StepWatchdog
+
+
+def test_budgets_from_layer_stats():
+    print("Testing learned budgets...")
+
+    class Engine:
+        layer_stats = LayerStats()
+
+    for position in range(MIN_HISTORY):
+        Engine.layer_stats.record(0, position, 0.2)
+        Engine.layer_stats.record(1, position, 0.01)
+    Engine.layer_stats.record("post", 0, 0.2)
+    watchdog = StepWatchdog(Engine(), factor=10, min_budget=0.5, default_budget=30.0)
+    assert abs(watchdog.budget(0) - 2.0) < 0.05, watchdog.budget(0)
+    assert watchdog.budget(1) == 0.5             # floored at min_budget
+    assert watchdog.budget("post") == 30.0       # too few samples yet
+    print(f"Budgets: {watchdog.report()['budgets_seconds']}")
+
+
+def test_stall_recovery():
+    print("\nTesting stall recovery...")
+    with tempfile.TemporaryDirectory() as model_dir:
+        sim_session.create_model_dir(model_dir, faults={"hang": {"layer": 2, "next": 1, "seconds": 2.0}})
+        engine = AX650Backend()
+        assert engine.load_model(model_dir)["status"] == "loaded"
+        incidents = []
+        # Stands in for a new generation that is inside an NPU call by the
+        # time the stuck one returns (started in the future: never stalls)
+        other_call = (0, 0, time.perf_counter() + 1e6)
+
+        def on_incident(incident):
+            incidents.append(incident)
+            engine.watchdog.pending = other_call
+
+        engine.watchdog.on_incident = on_incident
+        layers = list(engine.layers)
+        try:
+            text = engine.generate("hello", max_tokens=4, temperature=0)
+            print(f"Stalled generation: {text}")
+            # StepStalled ended the abandoned generation
+            assert engine.last_error and "cancelled by the watchdog" in engine.last_error
+            assert engine.watchdog.incidents == 1 and len(incidents) == 1
+            assert incidents[0]["layer"] == 2 and incidents[0]["recovered"]
+            assert incidents[0]["stalled_seconds"] > 0.5
+            # The abandoned generation left the other call's watch in place
+            assert engine.watchdog.pending is other_call
+            engine.watchdog.pending = None
+            # Recovery reloaded the sessions
+            assert engine.layers and all(a is not b for a, b in zip(layers, engine.layers))
+
+            text = engine.generate("hello", max_tokens=4, temperature=0)
+            print(f"Next generation: {text!r}")
+            assert engine.last_error is None and text
+            assert engine.watchdog.incidents == 1
+        finally:
+            engine.watchdog.stop()
+
+
+if __name__ == "__main__":
+    test_budgets_from_layer_stats()
+    test_stall_recovery()
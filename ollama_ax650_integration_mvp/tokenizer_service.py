@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""Tokenizer service for the C++ runtime (main_api_ax650 --url_tokenizer_model).
+
+Implements the HTTP contract of the manufacturer's qwen3_tokenizer_uid.py:
+
+  GET  /get_uid                         -> {"uid"}
+  GET  /bos_id?uid=..., /eos_id?uid=... -> {"bos_id"} / {"eos_id"} (-1 if none)
+  POST /reset  {uid, system_prompt}     -> {"token_ids"}  system turn, no generation prompt
+  POST /encode {uid, text, last_reply}  -> {"token_ids", "diff"}  whole conversation and
+                                           the part the runtime has not prefilled yet
+  POST /decode {uid, token_ids}         -> {"text"}  "" while a UTF-8 sequence is incomplete
+
+plus, for other clients, POST /batch_encode {texts} -> {"token_ids"},
+POST /batch_decode {token_ids} -> {"texts"}, GET /health, /stats and /metrics.
+
+Unlike the reference script, the tokenizer is loaded once and shared by
+every uid (the reference loads a new one per /get_uid and never frees it),
+idle uids are evicted beyond --max-sessions, and requests are served by a
+thread per keep-alive connection instead of one at a time.
+
+Encodings are cached. /reset results are cached per system prompt. Chat
+template output is split at added tokens such as <|im_start|> and
+<|im_end|>, which the tokenizer never merges across, and each piece is
+encoded through an LRU cache: the system prompt, the template scaffolding
+and earlier turns are encoded once, and a new turn costs only its own text.
+At startup the split encoding is checked against a plain encode and turned
+off if the two differ.
+
+Usage:
+  python3 tokenizer_service.py --model-path ../ax650_raspberry_pi_services/reference_projects_and_documentation/Qwen3-4B/qwen3_tokenizer
+  python3 tokenizer_service.py --model-path ./models/qwen3 --port 12345
+
+backend.py starts this service next to the real runtime (AX650_TOKENIZER).
+performance_evaluation/tokenizer_service_bench.py measures its latency.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import socket
+import logging
+import argparse
+import threading
+import collections
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from metrics_registry import REGISTRY, CONTENT_TYPE, Counter, Gauge, Histogram
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 12345
+DEFAULT_SYSTEM_PROMPT = "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."
+# A UTF-8 character is at most 4 bytes, so at most 4 byte-level tokens
+MAX_PENDING_TOKENS = 4
+# Tokenizer calls take tens of microseconds to a few milliseconds
+CALL_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+CALLS = Counter("ax650_tokenizer_requests_total", "Tokenizer service requests", ("endpoint", "status"))
+CALL_SECONDS = Histogram("ax650_tokenizer_request_seconds", "Time to handle a request", ("endpoint",),
+                         buckets=CALL_BUCKETS)
+SESSIONS = Gauge("ax650_tokenizer_sessions", "Live uids")
+
+
+def _encoded_ids(out):
+    """Token ids from apply_chat_template/encode results across transformers versions."""
+    if hasattr(out, "keys"):
+        out = out["input_ids"]
+    return list(out)
+
+
+class SegmentEncoder:
+    """Encodes text piecewise between added tokens, caching each piece."""
+
+    def __init__(self, tokenizer, cache_size=4096):
+        self.tokenizer = tokenizer
+        self._backend = getattr(tokenizer, "backend_tokenizer", None)
+        # Slow (Python) tokenizers keep per-call state; the Rust one does not
+        self._lock = threading.Lock() if self._backend is None else None
+        self._piece = lru_cache(maxsize=cache_size)(self._encode_piece)
+        self._split = None
+        # Tokens that absorb surrounding whitespace would make pieces differ from a whole encode
+        added = [t.content for t in getattr(tokenizer, "added_tokens_decoder", {}).values()
+                 if not (t.lstrip or t.rstrip or t.single_word)]
+        if added and not self.encode_raw(""):
+            self._split = re.compile("(" + "|".join(re.escape(t) for t in sorted(added, key=len, reverse=True)) + ")")
+
+    def encode_raw(self, text, add_special_tokens=True):
+        if self._backend is not None:
+            return self._backend.encode(text, add_special_tokens=add_special_tokens).ids
+        with self._lock:
+            return self.tokenizer.encode(text, add_special_tokens=add_special_tokens)
+
+    def encode_batch(self, texts):
+        if self._backend is not None:
+            # Runs in Rust without the GIL, in parallel across texts
+            return [e.ids for e in self._backend.encode_batch(texts)]
+        return [self.encode_raw(t) for t in texts]
+
+    def _encode_piece(self, piece):
+        return tuple(self.encode_raw(piece, add_special_tokens=False))
+
+    def encode(self, text):
+        if self._split is None:
+            return self.encode_raw(text)
+        ids = []
+        for piece in self._split.split(text):
+            if piece:
+                ids.extend(self._piece(piece))
+        return ids
+
+    def verify(self, samples):
+        """Turn piecewise encoding off unless it reproduces a whole encode of every sample."""
+        if self._split is None:
+            return False
+        for text in samples:
+            if self.encode(text) != self.encode_raw(text):
+                logger.warning("Piecewise encoding differs from a whole encode; caching disabled")
+                self._split = None
+                return False
+        return True
+
+    def cache_info(self):
+        info = self._piece.cache_info()
+        return {"enabled": self._split is not None, "hits": info.hits, "misses": info.misses,
+                "size": info.currsize, "max_size": info.maxsize}
+
+
+class Session:
+    """Conversation state of one uid, as kept by the reference service."""
+
+    def __init__(self, system_prompt=DEFAULT_SYSTEM_PROMPT):
+        self.messages = [{"role": "system", "content": system_prompt}]
+        self.token_ids = []
+        # Ids held back by /decode until they form complete characters
+        self.pending = []
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+
+
+class TokenizerService:
+    def __init__(self, tokenizer, max_sessions=64, cache_size=4096):
+        self.tokenizer = tokenizer
+        self.encoder = SegmentEncoder(tokenizer, cache_size)
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()
+        self.sessions_lock = threading.Lock()
+        self.evicted = 0
+        self._reset = lru_cache(maxsize=256)(self._reset_ids)
+
+        probe = [{"role": "system", "content": DEFAULT_SYSTEM_PROMPT}, {"role": "user", "content": "Hello!"},
+                 {"role": "assistant", "content": "Hi, how can I help?"}, {"role": "user", "content": "Ünïcödé 你好 🙂"}]
+        self.encoder.verify([self.render(probe[:i], generation_prompt=g) for i in (1, 2, 4) for g in (False, True)])
+        # The reference strips the generation prompt ("<|im_start|>assistant\n", 3 tokens for Qwen)
+        self.generation_prompt_len = (len(self.encoder.encode(self.render(probe[:2], True)))
+                                      - len(self.encoder.encode(self.render(probe[:2], False))))
+
+    @classmethod
+    def load(cls, model_path, **kwargs):
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        return cls(tokenizer, **kwargs)
+
+    def render(self, messages, generation_prompt=True):
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=generation_prompt)
+
+    def _strip_generation_prompt(self, ids):
+        return ids[:len(ids) - self.generation_prompt_len]
+
+    # --- sessions ---
+
+    def new_uid(self):
+        uid = str(uuid.uuid4())
+        with self.sessions_lock:
+            self.sessions[uid] = Session()
+            while len(self.sessions) > self.max_sessions:
+                old, _ = self.sessions.popitem(last=False)
+                self.evicted += 1
+                logger.info(f"Evicted idle uid {old}")
+            SESSIONS.set(len(self.sessions))
+        return uid
+
+    def session(self, uid):
+        with self.sessions_lock:
+            session = self.sessions.get(uid)
+            if session is not None:
+                self.sessions.move_to_end(uid)
+                session.last_used = time.time()
+            return session
+
+    # --- the qwen3_tokenizer_uid.py operations ---
+
+    def _reset_ids(self, system_prompt):
+        text = self.render([{"role": "system", "content": system_prompt}])
+        return tuple(self._strip_generation_prompt(self.encoder.encode(text)))
+
+    def reset(self, session, system_prompt=None):
+        system_prompt = DEFAULT_SYSTEM_PROMPT if system_prompt is None else system_prompt
+        session.messages = [{"role": "system", "content": system_prompt}]
+        session.token_ids = list(self._reset(system_prompt))
+        session.pending = []
+        return session.token_ids
+
+    def encode(self, session, text, last_reply=None):
+        if last_reply is not None:
+            session.messages.append({"role": "assistant", "content": last_reply})
+            session.token_ids = self._strip_generation_prompt(self.encoder.encode(self.render(session.messages)))
+        session.messages.append({"role": "user", "content": text})
+        token_ids = self.encoder.encode(self.render(session.messages))
+        diff = token_ids[len(session.token_ids):]
+        session.token_ids = token_ids
+        return token_ids, diff
+
+    def decode(self, session, token_ids):
+        session.pending.extend(token_ids)
+        text = self.tokenizer.decode(session.pending)
+        # Hold back a character split across tokens, but not forever: a
+        # UTF-8 character spans at most MAX_PENDING_TOKENS byte tokens
+        if text.endswith("\ufffd") and len(session.pending) < MAX_PENDING_TOKENS:
+            return ""
+        session.pending = []
+        return text
+
+    def report(self):
+        with self.sessions_lock:
+            sessions = len(self.sessions)
+        return {"sessions": sessions, "max_sessions": self.max_sessions, "evicted": self.evicted,
+                "piece_cache": self.encoder.cache_info(), "reset_cache": self._reset.cache_info()._asdict(),
+                "generation_prompt_tokens": self.generation_prompt_len,
+                "tokenizer": getattr(self.tokenizer, "name_or_path", None)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between requests
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections give their thread back after this long
+    timeout = 60
+    service = None
+
+    def setup(self):
+        super().setup()
+        # Responses are small; don't let Nagle hold them back for the client's delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _send(self, status, body, content_type="application/json"):
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, endpoint, fn):
+        t0 = time.perf_counter()
+        try:
+            status, body = fn()
+        except Exception as e:
+            logger.exception(f"{endpoint} failed")
+            status, body = 500, {"error": str(e)}
+        self._send(status, body, CONTENT_TYPE if isinstance(body, bytes) else "application/json")
+        CALLS.labels(endpoint, str(status)).inc()
+        CALL_SECONDS.labels(endpoint).observe(time.perf_counter() - t0)
+
+    def _with_session(self, uid, fn):
+        session = self.service.session(uid)
+        if session is None:
+            # The reference answers 200 with an error field
+            return 200, {"error": "Invalid uid"}
+        with session.lock:
+            return 200, fn(session)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        uid = parse_qs(url.query).get("uid", [None])[0]
+        svc = self.service
+        routes = {
+            "/get_uid": lambda: (200, {"uid": svc.new_uid()}),
+            "/bos_id": lambda: self._with_session(uid, lambda s: {"bos_id": _or_minus_one(svc.tokenizer.bos_token_id)}),
+            "/eos_id": lambda: self._with_session(uid, lambda s: {"eos_id": _or_minus_one(svc.tokenizer.eos_token_id)}),
+            "/health": lambda: (200, {"status": "ok"}),
+            "/stats": lambda: (200, svc.report()),
+            "/metrics": lambda: (200, REGISTRY.render().encode()),
+        }
+        route = routes.get(url.path)
+        if route is None:
+            self._send(404, {"error": f"unknown path {url.path}"})
+            return
+        self._handle(url.path, route)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            req = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send(400, {"error": "invalid JSON"})
+            return
+        svc = self.service
+
+        def encode(session):
+            token_ids, diff = svc.encode(session, req.get("text", ""), req.get("last_reply"))
+            return {"token_ids": token_ids, "diff": diff}
+
+        routes = {
+            "/encode": lambda: self._with_session(req.get("uid"), encode),
+            "/decode": lambda: self._with_session(req.get("uid"),
+                                                  lambda s: {"text": svc.decode(s, req.get("token_ids") or [])}),
+            "/reset": lambda: self._with_session(req.get("uid"),
+                                                 lambda s: {"token_ids": svc.reset(s, req.get("system_prompt"))}),
+            "/batch_encode": lambda: (200, {"token_ids": svc.encoder.encode_batch(req.get("texts") or [])}),
+            "/batch_decode": lambda: (200, {"texts": svc.tokenizer.batch_decode(
+                req.get("token_ids") or [], skip_special_tokens=bool(req.get("skip_special_tokens")))}),
+        }
+        route = routes.get(path)
+        if route is None:
+            self._send(404, {"error": f"unknown path {path}"})
+            return
+        self._handle(path, route)
+
+
+def _or_minus_one(value):
+    return -1 if value is None else value
+
+
+def make_server(service, host="0.0.0.0", port=DEFAULT_PORT):
+    handler = type("BoundHandler", (Handler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    p = argparse.ArgumentParser(description="Tokenizer service for main_api_ax650")
+    p.add_argument("--model-path", default=os.environ.get("AX650_TOKENIZER_PATH"),
+                   help="Tokenizer directory or repo id (default: AX650_TOKENIZER_PATH)")
+    p.add_argument("--host", default="0.0.0.0")
+    p.add_argument("--port", type=int, default=DEFAULT_PORT)
+    p.add_argument("--max-sessions", type=int, default=64, help="Live uids kept before the oldest is evicted")
+    p.add_argument("--cache-size", type=int, default=4096, help="Encoded pieces kept in the LRU cache")
+    args = p.parse_args()
+    if not args.model_path:
+        p.error("--model-path (or AX650_TOKENIZER_PATH) is required")
+
+    t0 = time.time()
+    service = TokenizerService.load(args.model_path, max_sessions=args.max_sessions, cache_size=args.cache_size)
+    logger.info(f"Loaded tokenizer from {args.model_path} in {time.time() - t0:.2f}s "
+                f"(piecewise cache {'on' if service.encoder.cache_info()['enabled'] else 'off'})")
+    server = make_server(service, args.host, args.port)
+    # Same banner as qwen3_tokenizer_uid.py; backend.py waits for it
+    print("Server running at http://%s:%s" % (args.host, args.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Tiered, asynchronous tracing for the inference engine.
+
+Levels:
+  off      nothing is recorded
+  summary  one start line and one timing summary per generation (default)
+  step     plus a line per step, in the format analyze_trace.py parses
+  tensors  plus top-10 logit ids per step and .npy logit dumps of the
+           first steps (debug only; costs a full logits copy per step)
+
+The level is global (AX650_TRACE) and can be overridden per request. Records
+are queued and written by a background thread, so the generation loop only
+pays for a queue put; with tracing off it pays a boolean check per step.
+
+Alongside the log records, SPANS keeps timed spans (summary: request phases;
+step: every step, layer run, post and sample) in a ring buffer, exportable
+as Chrome trace-event JSON for Perfetto / chrome://tracing. Timestamps are
+time.perf_counter(), i.e. CLOCK_MONOTONIC on Linux, which is shared by all
+processes on the host, so proxy, runtime and NPU samples (telemetry.py)
+line up.
+"""
+import os
+import queue
+import threading
+import collections
+
+OFF, SUMMARY, STEP, TENSORS = 0, 1, 2, 3
+LEVELS = {
+    "off": OFF, "none": OFF, "0": OFF,
+    "summary": SUMMARY, "1": SUMMARY,
+    "step": STEP, "per-step": STEP, "2": STEP,
+    "tensors": TENSORS, "debug-tensors": TENSORS, "debug": TENSORS, "3": TENSORS,
+}
+LEVEL_NAMES = {OFF: "off", SUMMARY: "summary", STEP: "step", TENSORS: "tensors"}
+
+# Logit dumps are limited to the first few steps of a request
+DUMP_STEPS = 3
+
+
+def parse_level(value, default=SUMMARY):
+    """Map a level name or number to a level; None/unknown gives `default`."""
+    if value is None or value == "":
+        return default
+    if isinstance(value, int):
+        return min(max(value, OFF), TENSORS)
+    return LEVELS.get(str(value).strip().lower(), default)
+
+
+class Tracer:
+    """Queue-backed trace sink; records are formatted and written off-thread."""
+
+    def __init__(self, logger, level=SUMMARY, dump_dir="/tmp"):
+        self.logger = logger
+        self.level = level
+        self.dump_dir = dump_dir
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="ax650-trace", daemon=True)
+                    self._thread.start()
+
+    def log(self, fmt, *args):
+        """Queue a log line (lazy %-formatting happens on the worker)."""
+        self._ensure_worker()
+        self._queue.put(("log", fmt, args))
+
+    def tensors(self, request_id, step, logits):
+        """Queue top-k extraction (and for early steps a dump) of a step's logits."""
+        self._ensure_worker()
+        self._queue.put(("tensors", request_id, (step, logits)))
+
+    def flush(self):
+        """Block until every queued record has been written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            kind, a, b = self._queue.get()
+            try:
+                if kind == "log":
+                    self.logger.info(a, *b)
+                else:
+                    self._write_tensors(a, *b)
+            except Exception as e:
+                self.logger.warning(f"Trace record dropped: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write_tensors(self, request_id, step, logits):
+        import numpy as np
+        import ml_dtypes
+        logits_np = np.asarray(logits)
+        if logits_np.dtype == ml_dtypes.bfloat16:
+            logits_np = logits_np.astype(np.float32)
+        self.logger.info("REQ %s: step=%d post logits shape=%s", request_id, step, logits_np.shape)
+        flat = logits_np.reshape(-1)
+        k = min(10, flat.size)
+        topk_idx = np.argpartition(flat, -k)[-k:]
+        topk_sorted = topk_idx[np.argsort(-flat[topk_idx])]
+        self.logger.info("REQ %s: step=%d logits topk_ids=%s", request_id, step, topk_sorted.tolist())
+        if step < DUMP_STEPS:
+            out_path = os.path.join(self.dump_dir, f"{request_id}_logits_step{step}.npy")
+            np.save(out_path, logits_np.astype(np.float32))
+            self.logger.info("REQ %s: saved logits to %s", request_id, out_path)
+
+
+class SpanRecorder:
+    """Ring buffer of finished spans and counter samples.
+
+    Events are plain tuples appended to a bounded deque (O(1), no lock);
+    the conversion to trace-event dicts happens only on export.
+    """
+
+    def __init__(self, capacity=200000):
+        self.events = collections.deque(maxlen=capacity)
+        self.pid = os.getpid()
+
+    def add(self, name, request_id, start, end, cat="engine", args=None, tid=None):
+        """Record a span; start/end are perf_counter() seconds."""
+        self.events.append(("X", name, cat, request_id, start, end - start,
+                            tid or threading.get_native_id(), args))
+
+    def counter(self, name, ts, values):
+        """Record a counter sample ({series: value}) at perf_counter() time `ts`."""
+        self.events.append(("C", name, "counter", None, ts, 0.0, 0, values))
+
+    def export(self, request_id=None, since=None, until=None, process_name="ax650"):
+        """Chrome trace events matching the filter.
+
+        With `request_id`, only that request's spans plus the counter samples
+        within its time range are returned; since/until bound the window.
+        """
+        events = list(self.events)
+        if request_id is not None:
+            spans = [e for e in events if e[0] == "X" and e[3] == request_id]
+            if not spans:
+                return []
+            lo = min(e[4] for e in spans)
+            hi = max(e[4] + e[5] for e in spans)
+            counters = [e for e in events if e[0] == "C" and lo <= e[4] <= hi]
+            events = spans + counters
+        if since is not None:
+            events = [e for e in events if e[4] + e[5] >= since]
+        if until is not None:
+            events = [e for e in events if e[4] <= until]
+
+        out = [{"ph": "M", "name": "process_name", "pid": self.pid, "tid": 0,
+                "args": {"name": f"{process_name} ({self.pid})"}}]
+        for ph, name, cat, rid, ts, dur, tid, args in events:
+            event = {"ph": ph, "name": name, "cat": cat, "pid": self.pid, "tid": tid,
+                     "ts": round(ts * 1e6, 3)}
+            if ph == "X":
+                event["dur"] = round(dur * 1e6, 3)
+                event["args"] = dict(args or {}, request_id=rid)
+            else:
+                event["args"] = args
+            out.append(event)
+        return out
+
+
+def chrome_trace(events):
+    """Wrap trace events in the JSON object format Perfetto loads."""
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+# Per-process span buffer shared by the engine and the servers
+SPANS = SpanRecorder(int(os.environ.get("AX650_TRACE_BUFFER", 200000)))
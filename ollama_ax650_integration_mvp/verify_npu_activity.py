@@ -1,21 +1,18 @@
 import time
 import threading
-import subprocess
 import requests
-import re
 import sys
+from telemetry import default_source
+
+# Same source as the backend's telemetry collector (one axcl-smi loop, or
+# AX650_AXCL_SMI_FIXTURE); None without axcl-smi
+SOURCE = default_source(interval=0.1)
 
 def get_npu_usage():
     try:
-        result = subprocess.run(["axcl-smi"], capture_output=True, text=True)
-        output = result.stdout
-        # Look for the line with NPU usage. 
-        # Format: |   --   52C                      -- / -- | 2%        0% |               4747 MiB /     7040 MiB |
-        # We want the percentage before the pipe before CMM-Usage
-        # Regex to find "X%        Y%" where Y is NPU
-        match = re.search(r'\|\s+\d+%\s+(\d+)%\s+\|', output)
-        if match:
-            return int(match.group(1))
+        cards = SOURCE.read() if SOURCE is not None else []
+        if cards:
+            return max(card["npu_pct"] for card in cards)
     except Exception:
         pass
     return 0
@@ -70,3 +67,5 @@ if __name__ == "__main__":
     run_inference()
     
     monitor_thread.join()
+    if SOURCE is not None and hasattr(SOURCE, "close"):
+        SOURCE.close()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Step watchdog: detect stalled NPU calls and recover the device.
+
+A layer `run()` that never returns (wedged device, driver hang) would block
+`_generate_qwen3_4b` forever. The engine publishes the call in progress as
+`watchdog.pending = (layer, position, start)`; this thread compares its age
+against a per-layer budget learned from the layer latency history
+(`factor` x p99, at least `min_budget`; `default_budget` until a layer has
+enough samples). On a stall it cancels the request, resets the device,
+reloads the model sessions and hands the engine back to service.
+
+The stuck call itself cannot be interrupted from Python. The generation
+that made it is abandoned: when (if) the call returns, the engine sees the
+incident count changed and raises StepStalled instead of touching the
+reloaded state.
+"""
+import os
+import time
+import logging
+import threading
+
+from metrics_registry import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+STALLS = Counter("ax650_engine_stalls_total", "NPU calls that exceeded their latency budget")
+RECOVERY_SECONDS = Histogram("ax650_engine_recovery_seconds", "Device reset and model reload after a stall")
+RECOVERY_FAILURES = Counter("ax650_engine_recovery_failures_total", "Recoveries that did not reload the model")
+
+# Layers need this many samples before their learned budget replaces the default
+MIN_HISTORY = 50
+# How often budgets are recomputed from the latency sketches (seconds)
+BUDGET_REFRESH = 5.0
+
+
+class StepStalled(RuntimeError):
+    """Raised in a generation abandoned by the watchdog."""
+
+
+class StepWatchdog(threading.Thread):
+    def __init__(self, engine, device_id=0, factor=None, min_budget=None, default_budget=None,
+                 interval=0.1):
+        super().__init__(name="ax650-watchdog", daemon=True)
+        self.engine = engine
+        self.device_id = device_id
+        self.factor = factor or float(os.environ.get("AX650_WATCHDOG_FACTOR", 10))
+        self.min_budget = min_budget or float(os.environ.get("AX650_WATCHDOG_MIN_BUDGET", 1.0))
+        self.default_budget = default_budget or float(os.environ.get("AX650_WATCHDOG_DEFAULT_BUDGET", 30.0))
+        self.interval = interval
+        # Written by the generation thread around every NPU call
+        self.pending = None
+        self.incidents = 0
+        self.recovering = False
+        self.last_recovery_seconds = None
+        self.history = []  # recent incidents, newest last
+        # Called with the incident dict once the engine is back in service
+        self.on_incident = None
+        self._budgets = {}
+        self._budgets_at = 0.0
+        self._stop_event = threading.Event()
+        Gauge("ax650_engine_watchdog_incidents", "Stalls handled by the watchdog").set_function(
+            lambda: self.incidents)
+        Gauge("ax650_engine_last_recovery_seconds", "Duration of the most recent recovery").set_function(
+            lambda: self.last_recovery_seconds or 0)
+
+    def budget(self, layer):
+        now = time.monotonic()
+        if now - self._budgets_at > BUDGET_REFRESH:
+            self._refresh_budgets()
+            self._budgets_at = now
+        return self._budgets.get(layer, self.default_budget)
+
+    def _refresh_budgets(self):
+        stats = self.engine.layer_stats
+        if stats is None:
+            return
+        budgets = {}
+        for layer, sketch in stats.by_layer().items():
+            if sketch.count >= MIN_HISTORY:
+                budgets[layer] = max(self.min_budget, self.factor * sketch.quantile(0.99))
+        self._budgets = budgets
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            pending = self.pending
+            if pending is None or self.recovering:
+                continue
+            layer, position, started = pending
+            elapsed = time.perf_counter() - started
+            budget = self.budget(layer)
+            if elapsed > budget and self.pending is pending:
+                self._handle_stall(layer, position, elapsed, budget)
+
+    def _handle_stall(self, layer, position, elapsed, budget):
+        self.recovering = True
+        self.pending = None
+        self.incidents += 1
+        STALLS.inc()
+        logger.error(f"Watchdog: layer {layer} at position {position} stalled for {elapsed:.1f}s "
+                     f"(budget {budget:.2f}s); resetting device {self.device_id}")
+        t0 = time.perf_counter()
+        try:
+            ok = self.engine.recover(self.device_id)
+        except Exception as e:
+            logger.error(f"Watchdog: recovery raised: {e}", exc_info=True)
+            ok = False
+        self.last_recovery_seconds = time.perf_counter() - t0
+        RECOVERY_SECONDS.observe(self.last_recovery_seconds)
+        if not ok:
+            RECOVERY_FAILURES.inc()
+        incident = {"at": time.time(), "layer": layer, "position": position,
+                    "stalled_seconds": elapsed, "budget_seconds": budget,
+                    "recovery_seconds": self.last_recovery_seconds, "recovered": ok}
+        self.history = (self.history + [incident])[-20:]
+        logger.info(f"Watchdog: recovery {'succeeded' if ok else 'FAILED'} "
+                    f"in {self.last_recovery_seconds:.1f}s")
+        self.recovering = False
+        if self.on_incident is not None:
+            try:
+                self.on_incident(incident)
+            except Exception as e:
+                logger.error(f"Watchdog: incident callback failed: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+
+    def report(self):
+        return {"incidents": self.incidents, "recovering": self.recovering,
+                "last_recovery_seconds": self.last_recovery_seconds,
+                "default_budget_seconds": self.default_budget,
+                "budgets_seconds": {str(k): v for k, v in self._budgets.items()},
+                "history": list(self.history)}
@@ -6,6 +6,8 @@ set -e
 
 OLLAMA_PORT="${OLLAMA_PORT:-11434}"
 BACKEND_URL="${AX650_BACKEND_URL:-http://localhost:5002}"
+# Shared helpers (request capture, keep_alive parsing) live next to backend.py
+export AX650_MVP_DIR="${AX650_MVP_DIR:-$(cd "$(dirname "$0")" && pwd)/ollama_ax650_integration_mvp}"
 
 echo "Starting Ollama AX650 Proxy on port $OLLAMA_PORT"
 echo "Backend: $BACKEND_URL"
@@ -14,13 +16,99 @@ echo "Backend: $BACKEND_URL"
 python3 << 'PYTHON_SCRIPT'
 import json
 import sys
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import requests
 import os
+import time
+import uuid
+from datetime import datetime, timezone
 
 BACKEND_URL = os.getenv('AX650_BACKEND_URL', 'http://localhost:5002')
 OLLAMA_PORT = int(os.getenv('OLLAMA_PORT', '11434'))
 
+# Opt-in request capture (OLLAMA_CAPTURE_FILE), same format as the backend's
+sys.path.insert(0, os.getenv('AX650_MVP_DIR', ''))
+from request_capture import RequestCapture
+from model_residency import parse_keep_alive
+CAPTURE = RequestCapture.from_env('OLLAMA_CAPTURE_FILE')
+
+# Details for the models we know how to describe; others get a generic entry
+MODEL_DETAILS = {
+    "qwen3-ax650:latest": {
+        "parent_model": "",
+        "format": "axmodel",
+        "family": "qwen3",
+        "families": ["qwen3"],
+        "parameter_size": "4B",
+        "quantization_level": "INT8"
+    }
+}
+
+def iso_time(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+# Timing/count fields Ollama reports on a finished response (durations in ns)
+TIMING_FIELDS = ('total_duration', 'load_duration', 'prompt_eval_count',
+                 'prompt_eval_duration', 'eval_count', 'eval_duration')
+
+def now_iso():
+    return iso_time(datetime.now(timezone.utc).timestamp())
+
+def timing_fields(result):
+    """Map the backend's engine/runtime measurements onto Ollama's fields."""
+    metrics = result.get('metrics') or {}
+    return {field: int(metrics.get(field) or 0) for field in TIMING_FIELDS}
+
+def done_reason(result, max_tokens):
+    """'length' when the reply used its whole num_predict budget."""
+    return 'length' if 0 < int(max_tokens) <= timing_fields(result)['eval_count'] else 'stop'
+
+def capture(path, data, backend_request, arrival, t_arrival, status=200, result=None,
+            t_first=None, outcome='ok'):
+    """Append a finished /api/generate or /api/chat request to the capture file."""
+    if CAPTURE is None:
+        return
+    counts = timing_fields(result or {})
+    max_tokens = backend_request['max_tokens']
+    messages = data.get('messages') or [{'role': 'user', 'content': data.get('prompt', '')}]
+    try:
+        CAPTURE.record(
+            messages, arrival=arrival, endpoint=path, request_id=backend_request['request_id'],
+            model=data.get('model'), stream=bool(data.get('stream')), chat=path == '/api/chat',
+            params={k: backend_request[k] for k in ('max_tokens', 'temperature', 'top_p', 'top_k', 'seed')},
+            keep_alive=data.get('keep_alive'), outcome=outcome, status=status,
+            duration_s=round(time.perf_counter() - t_arrival, 6),
+            ttft_s=round(t_first - t_arrival, 6) if t_first is not None else None,
+            prompt_tokens=counts['prompt_eval_count'] if result else None,
+            eval_tokens=counts['eval_count'] if result else None,
+            stop_reason=done_reason(result, max_tokens) if result else None)
+    except Exception as e:
+        print(f'Request capture failed: {e}')
+
+def backend_models():
+    """Registered/resident models as reported by the backend."""
+    response = requests.get(f'{BACKEND_URL}/models', timeout=5)
+    response.raise_for_status()
+    return response.json().get('models', [])
+
+def model_record(m):
+    details = MODEL_DETAILS.get(m['name'], {
+        "parent_model": "",
+        "format": "axmodel",
+        "family": m['name'].split(':')[0],
+        "families": [m['name'].split(':')[0]],
+        "parameter_size": "",
+        "quantization_level": ""
+    })
+    return {
+        "name": m['name'],
+        "model": m['name'],
+        "modified_at": iso_time(m['modified_at']),
+        "size": m['size'],
+        "digest": f"ax650:{m['name']}",
+        "details": details
+    }
+
 class OllamaProxyHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         if self.path == '/':
@@ -28,27 +116,34 @@ class OllamaProxyHandler(BaseHTTPRequestHandler):
             self.send_header('Content-type', 'text/plain')
             self.end_headers()
             self.wfile.write(b'Ollama AX650 Proxy is running')
-        elif self.path == '/api/tags':
+        elif self.path in ('/api/tags', '/api/ps'):
+            try:
+                models = backend_models()
+            except Exception as e:
+                self.send_response(502)
+                self.send_header('Content-type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({'error': f'backend unavailable: {e}'}).encode())
+                return
+
+            if self.path == '/api/tags':
+                response = {"models": [model_record(m) for m in models]}
+            else:
+                # /api/ps: only what is loaded right now
+                running = []
+                for m in models:
+                    if not m['resident']:
+                        continue
+                    record = model_record(m)
+                    # Far-future expiry for "keep forever", as Ollama does
+                    expires = m['expires_at'] or 253402300799
+                    record.update({'size_vram': m['size'], 'expires_at': iso_time(expires)})
+                    running.append(record)
+                response = {"models": running}
+
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
-            response = {
-                "models": [{
-                    "name": "qwen3-ax650:latest",
-                    "model": "qwen3-ax650:latest",
-                    "modified_at": "2025-11-24T00:00:00Z",
-                    "size": 5100000000,
-                    "digest": "ax650:qwen3-4b",
-                    "details": {
-                        "parent_model": "",
-                        "format": "axmodel",
-                        "family": "qwen3",
-                        "families": ["qwen3"],
-                        "parameter_size": "4B",
-                        "quantization_level": "INT8"
-                    }
-                }]
-            }
             self.wfile.write(json.dumps(response).encode())
         else:
             self.send_response(404)
@@ -57,6 +152,7 @@ class OllamaProxyHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         content_length = int(self.headers.get('Content-Length', 0))
         body = self.rfile.read(content_length)
+        arrival, t_arrival = time.time(), time.perf_counter()
         
         try:
             data = json.loads(body.decode('utf-8'))
@@ -64,6 +160,12 @@ class OllamaProxyHandler(BaseHTTPRequestHandler):
             self.send_error(400, 'Invalid JSON')
             return
         
+        if self.path in ('/api/generate', '/api/chat') and not (data.get('prompt') or data.get('messages')):
+            # Ollama convention: an empty request loads the model, or unloads
+            # it when keep_alive is 0
+            self.handle_residency(data)
+            return
+
         if self.path == '/api/generate':
             # Convert Ollama format to backend format
             prompt = data.get('prompt', '')
@@ -71,13 +173,23 @@ class OllamaProxyHandler(BaseHTTPRequestHandler):
             stream = data.get('stream', False)
             
             backend_request = {
+                'model': data.get('model'),
+                'keep_alive': data.get('keep_alive'),
                 'prompt': prompt,
                 'max_tokens': options.get('num_predict', 128),
                 'temperature': options.get('temperature', 0.8),
                 'top_p': options.get('top_p', 0.9),
-                'top_k': options.get('top_k', 40)
+                'top_k': options.get('top_k', 40),
+                'seed': options.get('seed'),
+                'request_id': str(uuid.uuid4())
             }
+            done = lambda status, result=None, t_first=None, outcome='ok': capture(
+                self.path, data, backend_request, arrival, t_arrival, status, result, t_first, outcome)
             
+            if stream:
+                self.stream_backend(backend_request, lambda text: {'response': text}, done)
+                return
+
             try:
                 # Call backend
                 response = requests.post(
@@ -89,40 +201,21 @@ class OllamaProxyHandler(BaseHTTPRequestHandler):
                 result = response.json()
                 
                 # Convert backend response to Ollama format
-                if stream:
-                    # For streaming, send chunks
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/x-ndjson')
-                    self.end_headers()
-                    
-                    # Send the complete response as one chunk
-                    chunk = {
-                        'model': data.get('model', 'qwen3-ax650'),
-                        'created_at': '2025-11-24T00:00:00Z',
-                        'response': result.get('text', ''),
-                        'done': True
-                    }
-                    self.wfile.write((json.dumps(chunk) + '\n').encode())
-                else:
-                    # Non-streaming response
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    
-                    ollama_response = {
-                        'model': data.get('model', 'qwen3-ax650'),
-                        'created_at': '2025-11-24T00:00:00Z',
-                        'response': result.get('text', ''),
-                        'done': True,
-                        'context': [],
-                        'total_duration': 0,
-                        'load_duration': 0,
-                        'prompt_eval_count': 0,
-                        'prompt_eval_duration': 0,
-                        'eval_count': len(result.get('text', '').split()),
-                        'eval_duration': 0
-                    }
-                    self.wfile.write(json.dumps(ollama_response).encode())
+                self.send_response(200)
+                self.send_header('Content-type', 'application/json')
+                self.end_headers()
+                
+                ollama_response = {
+                    'model': data.get('model', 'qwen3-ax650'),
+                    'created_at': now_iso(),
+                    'response': result.get('text', ''),
+                    'done': True,
+                    'done_reason': done_reason(result, backend_request['max_tokens']),
+                    'context': []
+                }
+                ollama_response.update(timing_fields(result))
+                self.wfile.write(json.dumps(ollama_response).encode())
+                done(200, result)
                     
             except Exception as e:
                 self.send_response(500)
@@ -130,6 +223,7 @@ class OllamaProxyHandler(BaseHTTPRequestHandler):
                 self.end_headers()
                 error_response = {'error': str(e)}
                 self.wfile.write(json.dumps(error_response).encode())
+                done(500, outcome='error')
                 
         elif self.path == '/api/chat':
             # Convert chat format to simple generate
@@ -140,14 +234,28 @@ class OllamaProxyHandler(BaseHTTPRequestHandler):
             options = data.get('options', {})
             stream = data.get('stream', False)
             
+            # Pass the structured messages too so the backend can continue
+            # the conversation already resident in the runtime
             backend_request = {
+                'model': data.get('model'),
+                'keep_alive': data.get('keep_alive'),
                 'prompt': prompt,
+                'messages': messages,
                 'max_tokens': options.get('num_predict', 128),
                 'temperature': options.get('temperature', 0.8),
                 'top_p': options.get('top_p', 0.9),
-                'top_k': options.get('top_k', 40)
+                'top_k': options.get('top_k', 40),
+                'seed': options.get('seed'),
+                'request_id': str(uuid.uuid4())
             }
+            done = lambda status, result=None, t_first=None, outcome='ok': capture(
+                self.path, data, backend_request, arrival, t_arrival, status, result, t_first, outcome)
             
+            if stream:
+                self.stream_backend(backend_request,
+                                    lambda text: {'message': {'role': 'assistant', 'content': text}}, done)
+                return
+
             try:
                 response = requests.post(
                     f'{BACKEND_URL}/generate',
@@ -158,36 +266,23 @@ class OllamaProxyHandler(BaseHTTPRequestHandler):
                 result = response.json()
                 
                 # Convert to Ollama chat format
-                if stream:
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/x-ndjson')
-                    self.end_headers()
-                    
-                    chunk = {
-                        'model': data.get('model', 'qwen3-ax650'),
-                        'created_at': '2025-11-24T00:00:00Z',
-                        'message': {
-                            'role': 'assistant',
-                            'content': result.get('text', '')
-                        },
-                        'done': True
-                    }
-                    self.wfile.write((json.dumps(chunk) + '\n').encode())
-                else:
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    
-                    ollama_response = {
-                        'model': data.get('model', 'qwen3-ax650'),
-                        'created_at': '2025-11-24T00:00:00Z',
-                        'message': {
-                            'role': 'assistant',
-                            'content': result.get('text', '')
-                        },
-                        'done': True
-                    }
-                    self.wfile.write(json.dumps(ollama_response).encode())
+                self.send_response(200)
+                self.send_header('Content-type', 'application/json')
+                self.end_headers()
+                
+                ollama_response = {
+                    'model': data.get('model', 'qwen3-ax650'),
+                    'created_at': now_iso(),
+                    'message': {
+                        'role': 'assistant',
+                        'content': result.get('text', '')
+                    },
+                    'done': True,
+                    'done_reason': done_reason(result, backend_request['max_tokens'])
+                }
+                ollama_response.update(timing_fields(result))
+                self.wfile.write(json.dumps(ollama_response).encode())
+                done(200, result)
                     
             except Exception as e:
                 self.send_response(500)
@@ -195,15 +290,105 @@ class OllamaProxyHandler(BaseHTTPRequestHandler):
                 self.end_headers()
                 error_response = {'error': str(e)}
                 self.wfile.write(json.dumps(error_response).encode())
+                done(500, outcome='error')
         else:
             self.send_response(404)
             self.end_headers()
     
+    def stream_backend(self, backend_request, payload, done):
+        """Relay the backend's NDJSON chunks as Ollama stream chunks.
+
+        `payload(text)` builds the endpoint-specific part of a chunk
+        ('response' for generate, 'message' for chat); `done(status, result,
+        t_first, outcome)` is called once the request has finished.
+        """
+        try:
+            response = requests.post(
+                f'{BACKEND_URL}/generate',
+                json=dict(backend_request, stream=True),
+                stream=True,
+                timeout=3600
+            )
+            response.raise_for_status()
+        except Exception as e:
+            self.send_response(500)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'error': str(e)}).encode())
+            done(500, outcome='error')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson')
+        self.end_headers()
+        model = backend_request.get('model') or 'qwen3-ax650'
+        t_first = None
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                chunk = {'model': model, 'created_at': now_iso()}
+                if event.get('error'):
+                    chunk['error'] = event['error']
+                    self.wfile.write((json.dumps(chunk) + '\n').encode())
+                    done(event.get('status', 500), t_first=t_first, outcome='error')
+                    break
+                finished = event.get('done', False)
+                if not finished and t_first is None:
+                    t_first = time.perf_counter()
+                chunk.update(payload('' if finished else event.get('response', '')))
+                chunk['done'] = finished
+                if finished:
+                    chunk['done_reason'] = done_reason(event, backend_request['max_tokens'])
+                    chunk.update(timing_fields(event))
+                self.wfile.write((json.dumps(chunk) + '\n').encode())
+                self.wfile.flush()
+                if finished:
+                    done(200, event, t_first)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away mid-stream
+            done(499, t_first=t_first, outcome='cancelled')
+
+    def handle_residency(self, data):
+        keep_alive = data.get('keep_alive')
+        # Any zero duration unloads ("0", "0s", "0h", 0.0); negative keeps it forever
+        unload = parse_keep_alive(keep_alive) == 0
+        try:
+            if unload:
+                r = requests.post(f'{BACKEND_URL}/unload', json={'model': data.get('model')}, timeout=60)
+            else:
+                r = requests.post(f'{BACKEND_URL}/load',
+                                  json={'model': data.get('model'), 'keep_alive': keep_alive}, timeout=3600)
+            r.raise_for_status()
+        except Exception as e:
+            self.send_response(500)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'error': str(e)}).encode())
+            return
+
+        response = {
+            'model': data.get('model', 'qwen3-ax650'),
+            'created_at': now_iso(),
+            'done': True,
+            'done_reason': 'unload' if unload else 'load'
+        }
+        if self.path == '/api/generate':
+            response['response'] = ''
+        else:
+            response['message'] = {'role': 'assistant', 'content': ''}
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(response).encode())
+
     def log_message(self, format, *args):
         print(f"[{self.address_string()}] {format % args}")
 
 if __name__ == '__main__':
-    server = HTTPServer(('0.0.0.0', OLLAMA_PORT), OllamaProxyHandler)
+    # Threaded so concurrent clients can share (coalesce into) one generation
+    server = ThreadingHTTPServer(('0.0.0.0', OLLAMA_PORT), OllamaProxyHandler)
     print(f'Ollama AX650 Proxy listening on port {OLLAMA_PORT}')
     print(f'Backend URL: {BACKEND_URL}')
     print('Ready to receive requests...')
@@ -1,143 +1,229 @@
-import pandas as pd
-import re
+#!/usr/bin/env python3
+"""Per-step NPU utilization and host overhead for every request of a run.
+
+Reads an npu_profile result directory and builds one row per engine step
+for every request, then attributes NPU samples to the steps they fall in.
+
+Steps come from `trace.json` (the engine's prefill_step/decode_step, layer
+and post spans; perf_counter clock) when present, otherwise from the step
+log lines (`backend_logs_filtered.txt` or --log) anchored at each request's
+`started_at` in generations.jsonl (wall clock). NPU samples come from
+npu_trace.csv on the matching clock, or from the "npu" counter samples in
+trace.json. Runs recorded before start times existed fall back to aligning
+the end of each request's steps with the end of NPU activity.
+
+Samples are assigned to step intervals with one sorted search over the
+sample times (cumulative sums give each interval's mean), so multi-hour
+traces take seconds rather than a scan per step.
+
+Writes to the result directory:
+- `analysis_report.csv`   one row per step (request_id, phase, duration,
+                          NPU time, host gap, NPU utilization)
+- `analysis_requests.csv` per request: prefill vs decode, NPU busy vs host gap
+- `analysis_summary.json` the same aggregated over all requests
+
+Usage:
+  python3 performance_evaluation/analyze_trace.py <result_dir> [--log /tmp/backend.log]
+"""
+import argparse
 import json
-import sys
 import os
+import re
+
+import numpy as np
+import pandas as pd
+
+# INFO:__main__:REQ <req_id>: step=0 elapsed=1.087803s step_layer_time=0.910048s npu_calls=37
+STEP_RE = re.compile(r"REQ (\S+): step=(\d+) elapsed=([\d.]+)s step_layer_time=([\d.]+)s npu_calls=(\d+)")
+# INFO:__main__:REQ <req_id>: Prefilling 27 tokens...
+PREFILL_RE = re.compile(r"REQ (\S+): Prefilling (\d+) tokens")
+# Samples above this count as NPU activity for the legacy end alignment
+ACTIVE_NPU_PCT = 5
+
+STEP_COLUMNS = ["request_id", "step", "phase", "start", "end", "npu_time"]
+
+
+def load_generations(path):
+    with open(path, encoding="utf-8") as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def steps_from_spans(events):
+    """Step table (perf_counter seconds) from Chrome trace events."""
+    spans = pd.DataFrame([(e["name"], e["args"].get("request_id"), e["args"].get("step"),
+                           e["ts"] / 1e6, e["dur"] / 1e6)
+                          for e in events if e.get("ph") == "X" and e.get("args")],
+                         columns=["name", "request_id", "step", "start", "dur"])
+    steps = spans[spans["name"].isin(["prefill_step", "decode_step"])].copy()
+    if steps.empty:
+        return pd.DataFrame(columns=STEP_COLUMNS)
+    steps["phase"] = np.where(steps["name"] == "prefill_step", "prefill", "decode")
+    steps["end"] = steps["start"] + steps["dur"]
+    steps["step"] = steps["step"].astype(int)
+    steps = steps.sort_values("start")
+
+    # Each layer/post span belongs to the latest step of its request started before it
+    calls = spans[spans["name"].isin(["layer", "post"])].sort_values("start")
+    calls = pd.merge_asof(calls, steps[["request_id", "step", "start"]].rename(columns={"start": "step_start"}),
+                          left_on="start", right_on="step_start", by="request_id", direction="backward",
+                          suffixes=("_call", ""))
+    npu = calls.groupby(["request_id", "step"])["dur"].sum().rename("npu_time")
+    steps = steps.join(npu, on=["request_id", "step"])
+    return steps[STEP_COLUMNS].reset_index(drop=True)
+
+
+def steps_from_logs(log_file, generations):
+    """Step table (wall-clock seconds when start times were recorded) from step log lines."""
+    with open(log_file, encoding="utf-8", errors="replace") as fh:
+        text = fh.read()
+    steps = pd.DataFrame(STEP_RE.findall(text), columns=["request_id", "step", "elapsed", "npu_time", "npu_calls"])
+    if steps.empty:
+        return pd.DataFrame(columns=STEP_COLUMNS), False
+    steps = steps.astype({"step": int, "elapsed": float, "npu_time": float, "npu_calls": int})
+    steps = steps.drop_duplicates(["request_id", "step"]).sort_values(["request_id", "step"])
+    prefill = dict((rid, int(n)) for rid, n in PREFILL_RE.findall(text))
+    steps["phase"] = np.where(steps["step"] < steps["request_id"].map(prefill).fillna(0), "prefill", "decode")
+
+    started = {g["request_id"]: g["started_at"] for g in generations if g.get("started_at")}
+    absolute = bool(started)
+    steps["base"] = steps["request_id"].map(started) if absolute else 0.0
+    steps["end"] = steps["base"] + steps["elapsed"]
+    steps["start"] = steps["end"] - steps.groupby("request_id")["elapsed"].diff().fillna(steps["elapsed"])
+    return steps[STEP_COLUMNS].reset_index(drop=True), absolute
+
+
+def load_samples(result_dir, events, clock):
+    """NPU samples as (t, npu_pct) on the given clock ("perf_counter" or "wall")."""
+    csv_path = os.path.join(result_dir, "npu_trace.csv")
+    if os.path.exists(csv_path):
+        trace = pd.read_csv(csv_path)
+        if clock == "perf_counter" and "perf_counter" in trace.columns:
+            return pd.DataFrame({"t": trace["perf_counter"], "npu_pct": trace["npu_pct"]}).dropna()
+        if clock == "wall":
+            t = (pd.to_datetime(trace["timestamp"], utc=True, format="ISO8601")
+                 - pd.Timestamp(0, tz="UTC")).dt.total_seconds()
+            return pd.DataFrame({"t": t, "npu_pct": trace["npu_pct"]}).dropna()
+    if clock == "perf_counter" and events:
+        rows = [(e["ts"] / 1e6, sum(e["args"].values()) / len(e["args"]))
+                for e in events if e.get("ph") == "C" and e.get("name") == "npu" and e.get("args")]
+        return pd.DataFrame(rows, columns=["t", "npu_pct"])
+    return pd.DataFrame(columns=["t", "npu_pct"])
+
+
+def align_to_activity(steps, samples):
+    """Legacy alignment: each request's last step ends with the last active sample."""
+    active = samples[samples["npu_pct"] > ACTIVE_NPU_PCT]
+    if active.empty:
+        print("No NPU activity found in trace; steps are not aligned.")
+        return steps
+    offset = active["t"].iloc[-1] - steps.groupby("request_id")["end"].transform("max")
+    print("Aligned by end of NPU activity (no recorded start times)")
+    return steps.assign(start=steps["start"] + offset, end=steps["end"] + offset)
+
+
+def attach_npu(steps, samples):
+    """Mean NPU utilization of the samples inside each step interval."""
+    samples = samples.sort_values("t")
+    t = samples["t"].to_numpy(dtype=float)
+    cumulative = np.concatenate(([0.0], np.cumsum(samples["npu_pct"].to_numpy(dtype=float))))
+    lo = np.searchsorted(t, steps["start"].to_numpy(dtype=float), side="left")
+    hi = np.searchsorted(t, steps["end"].to_numpy(dtype=float), side="right")
+    count = hi - lo
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (cumulative[hi] - cumulative[lo]) / count
+    return steps.assign(npu_samples=count, npu_avg_pct=np.where(count > 0, mean, np.nan))
+
+
+def breakdown(steps, keys):
+    """Prefill/decode and NPU busy/host gap totals grouped by `keys`."""
+    covered = steps["npu_samples"] > 0
+    steps = steps.assign(npu_weighted=steps["npu_avg_pct"].where(covered, 0) * steps["step_duration"],
+                         npu_covered_s=steps["step_duration"].where(covered, 0))
+    grouped = steps.groupby(keys + ["phase"]).agg(
+        steps=("step", "size"), duration_s=("step_duration", "sum"), npu_busy_s=("npu_time", "sum"),
+        host_gap_s=("python_overhead", "sum"), npu_weighted=("npu_weighted", "sum"),
+        npu_covered_s=("npu_covered_s", "sum"))
+    grouped["npu_avg_pct"] = grouped["npu_weighted"] / grouped["npu_covered_s"]
+    grouped["step_ms"] = 1000 * grouped["duration_s"] / grouped["steps"]
+    grouped["host_gap_ms_per_step"] = 1000 * grouped["host_gap_s"] / grouped["steps"]
+    grouped["npu_busy_fraction"] = grouped["npu_busy_s"] / grouped["duration_s"]
+    table = grouped.drop(columns=["npu_weighted", "npu_covered_s"]).unstack("phase")
+    table.columns = [f"{phase}_{name}" for name, phase in table.columns]
+    if "decode_steps" in table and "decode_duration_s" in table:
+        table["decode_tok_s"] = table["decode_steps"] / table["decode_duration_s"]
+    return table
+
+
+def analyze(result_dir, log_file=None):
+    generations = load_generations(os.path.join(result_dir, "generations.jsonl"))
+    events = []
+    trace_json = os.path.join(result_dir, "trace.json")
+    if os.path.exists(trace_json):
+        with open(trace_json, encoding="utf-8") as fh:
+            events = json.load(fh).get("traceEvents", [])
+
+    steps = steps_from_spans(events)
+    clock, absolute = "perf_counter", True
+    if steps.empty:
+        if log_file is None:
+            log_file = os.path.join(result_dir, "backend_logs_filtered.txt")
+            if not os.path.exists(log_file):
+                log_file = "/tmp/backend.log"
+        if not os.path.exists(log_file):
+            print(f"No step spans in trace.json and no log file at {log_file}")
+            return None
+        steps, absolute = steps_from_logs(log_file, generations)
+        clock = "wall"
+    if steps.empty:
+        print("No step records found.")
+        return None
+
+    # Keep only requests of this run
+    run_ids = {g.get("request_id") for g in generations}
+    steps = steps[steps["request_id"].isin(run_ids)] if run_ids & set(steps["request_id"]) else steps
+    steps = steps.sort_values(["request_id", "step"]).reset_index(drop=True)
+    print(f"Analyzing {steps['request_id'].nunique()} requests, {len(steps)} steps ({clock} clock)")
+
+    samples = load_samples(result_dir, events, clock)
+    if not absolute:
+        steps = align_to_activity(steps, samples)
+    steps = attach_npu(steps, samples)
+    steps["step_duration"] = steps["end"] - steps["start"]
+    steps["python_overhead"] = steps["step_duration"] - steps["npu_time"]
+
+    report = os.path.join(result_dir, "analysis_report.csv")
+    steps.to_csv(report, index=False)
+    per_request = breakdown(steps, ["request_id"])
+    per_request.to_csv(os.path.join(result_dir, "analysis_requests.csv"))
+    overall = breakdown(steps.assign(run="all"), ["run"]).iloc[0]
+    summary = {"requests": int(steps["request_id"].nunique()), "steps": int(len(steps)), "clock": clock,
+               "aligned_on_timestamps": absolute,
+               "npu_samples": int(len(samples)), "overall": {k: (None if pd.isna(v) else float(v))
+                                                            for k, v in overall.items()}}
+    with open(os.path.join(result_dir, "analysis_summary.json"), "w", encoding="utf-8") as fh:
+        json.dump(summary, fh, indent=2)
+    print(f"Report saved to {report}")
 
-def parse_backend_logs(log_file, request_id):
-    steps = []
-    # Regex for step timing
-    # INFO:__main__:REQ <req_id>: step=0 elapsed=1.087803s step_layer_time=0.910048s npu_calls=37
-    step_pattern = re.compile(r"REQ " + request_id + r": step=(\d+) elapsed=([\d\.]+)s step_layer_time=([\d\.]+)s npu_calls=(\d+)")
-    
-    # Regex for start time (approximate, based on "generate start")
-    # INFO:__main__:REQ <req_id>: generate start
-    # We don't have absolute timestamp in the log line format used in the grep output, 
-    # but we can infer relative timing.
-    
-    with open(log_file, 'r') as f:
-        for line in f:
-            m = step_pattern.search(line)
-            if m:
-                steps.append({
-                    'step': int(m.group(1)),
-                    'elapsed_backend': float(m.group(2)),
-                    'layer_time': float(m.group(3)),
-                    'npu_calls': int(m.group(4))
-                })
-    return pd.DataFrame(steps)
-
-def analyze(trace_csv, log_file, generations_jsonl, output_dir):
-    # 1. Get Request ID and Total Elapsed from generations
-    req_id = None
-    total_elapsed_gen = 0
-    with open(generations_jsonl, 'r') as f:
-        for line in f:
-            data = json.loads(line)
-            if 'request_id' in data:
-                req_id = data['request_id']
-                total_elapsed_gen = data['elapsed_s']
-                break
-    
-    if not req_id:
-        print("No request_id found in generations.jsonl")
-        return
-
-    print(f"Analyzing Request ID: {req_id}")
-    
-    # 2. Parse Backend Logs
-    df_steps = parse_backend_logs(log_file, req_id)
-    if df_steps.empty:
-        print("No step logs found for request.")
-        return
-
-    # 3. Load NPU Trace
-    df_trace = pd.read_csv(trace_csv)
-    
-    # 4. Align
-    # We assume the NPU trace 'active' window corresponds to the backend generation window.
-    # Find start of NPU activity (first non-zero or > 10%?)
-    # Let's use the first timestamp where npu_pct > 0 as the "start of generation" roughly.
-    # Or better: The backend logs are relative to "start of generate()".
-    # The trace has absolute elapsed_s.
-    # We need to find the offset `T_start` such that `trace_elapsed = T_start + backend_elapsed`.
-    
-    # Heuristic: The end of the backend generation (last step elapsed) should align with the end of NPU activity.
-    # Last step elapsed: df_steps.iloc[-1]['elapsed_backend']
-    # Find the last point in trace where npu_pct > 5 (arbitrary threshold for "active")
-    
-    active_trace = df_trace[df_trace['npu_pct'] > 5]
-    if active_trace.empty:
-        print("No NPU activity found in trace.")
-        offset = 0
-    else:
-        trace_end_s = active_trace.iloc[-1]['elapsed_s']
-        backend_end_s = df_steps.iloc[-1]['elapsed_backend']
-        offset = trace_end_s - backend_end_s
-        print(f"Estimated Offset (Trace End - Backend End): {offset:.4f}s")
-
-    # Add trace timestamp to steps
-    df_steps['estimated_trace_time'] = df_steps['elapsed_backend'] + offset
-    
-    # For each step, calculate the average NPU utilization in the window [prev_step_end, current_step_end]
-    # prev_step_end for step 0 is offset.
-    
-    npu_step_avgs = []
-    prev_time = offset
-    
-    for _, row in df_steps.iterrows():
-        curr_time = row['estimated_trace_time']
-        # Select trace samples in [prev_time, curr_time]
-        mask = (df_trace['elapsed_s'] >= prev_time) & (df_trace['elapsed_s'] <= curr_time)
-        samples = df_trace[mask]
-        if not samples.empty:
-            avg_npu = samples['npu_pct'].mean()
-            sample_count = len(samples)
-        else:
-            avg_npu = 0
-            sample_count = 0
-        
-        npu_step_avgs.append(avg_npu)
-        prev_time = curr_time
-        
-    df_steps['npu_avg_pct'] = npu_step_avgs
-    
-    # Calculate Python Overhead
-    # Step Duration = (Current Elapsed - Prev Elapsed)
-    # Layer Time = reported layer time
-    # Overhead = Duration - Layer Time
-    
-    df_steps['step_duration'] = df_steps['elapsed_backend'].diff().fillna(df_steps['elapsed_backend'].iloc[0])
-    df_steps['python_overhead'] = df_steps['step_duration'] - df_steps['layer_time']
-    
-    # Save Report
-    report_path = os.path.join(output_dir, 'analysis_report.csv')
-    df_steps.to_csv(report_path, index=False)
-    print(f"Report saved to {report_path}")
-    
-    # Summary Stats
     print("\n--- Analysis Summary ---")
-    print(f"Avg NPU Utilization: {df_steps['npu_avg_pct'].mean():.2f}%")
-    print(f"Avg Step Duration: {df_steps['step_duration'].mean():.4f}s")
-    print(f"Avg Layer Time: {df_steps['layer_time'].mean():.4f}s")
-    print(f"Avg Python Overhead: {df_steps['python_overhead'].mean():.4f}s")
-    print(f"Total NPU Calls: {df_steps.iloc[-1]['npu_calls']}")
+    for phase in ("prefill", "decode"):
+        if f"{phase}_steps" not in overall:
+            continue
+        print(f"{phase:>8}: {int(overall[f'{phase}_steps'])} steps, {overall[f'{phase}_step_ms']:.1f} ms/step, "
+              f"NPU busy {100 * overall[f'{phase}_npu_busy_fraction']:.1f}%, "
+              f"host gap {overall[f'{phase}_host_gap_ms_per_step']:.1f} ms/step, "
+              f"NPU utilization {overall[f'{phase}_npu_avg_pct']:.1f}%")
+    if "decode_tok_s" in overall:
+        print(f"Decode throughput: {overall['decode_tok_s']:.2f} tok/s")
+    return steps
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("result_dir")
+    p.add_argument("--log", help="Backend log with step lines (default: backend_logs_filtered.txt in the result dir)")
+    args = p.parse_args()
+    analyze(args.result_dir, args.log)
+
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python analyze_trace.py <result_dir>")
-        sys.exit(1)
-        
-    result_dir = sys.argv[1]
-    trace_csv = os.path.join(result_dir, "npu_trace.csv")
-    gen_jsonl = os.path.join(result_dir, "generations.jsonl")
-    # We need the log file. It's in /tmp/backend.log usually, or we might have saved a filtered one.
-    # Let's assume the user provides the log file path or we look for the filtered one we made.
-    
-    # Check for filtered log in result dir
-    log_file = os.path.join(result_dir, "backend_logs_filtered.txt")
-    if not os.path.exists(log_file):
-        # Fallback to /tmp/backend.log if not found (but we created it)
-        log_file = "/tmp/backend.log"
-        
-    analyze(trace_csv, log_file, gen_jsonl, result_dir)
+    main()
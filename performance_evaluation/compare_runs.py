@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""Compare npu_profile runs and flag regressions.
+
+Loads two or more `results/npu_profile/<timestamp>/` directories, aligns
+their requests by prompt (the n-th request for a prompt in one run with the
+n-th in the other) and compares each run against the first:
+  - ttft_s:           time to first token (metrics.prompt_eval_duration)
+  - tok_s:            decode tokens/second (eval_count / eval_duration)
+  - latency_s:        client-side request time
+  - npu_pct:          mean axcl-smi NPU utilization while the request ran
+  - python_overhead_ms: host time per step outside the layer/post NPU calls
+
+Deltas come with bootstrap confidence intervals (paired over aligned
+requests, or over each run's requests when there are too few pairs). A
+change is significant when the interval excludes zero, and a regression
+when it is significant in the bad direction.
+
+Older runs lack per-request metrics and start times: their NPU utilization
+falls back to the active part of the trace and their Python overhead to
+`analysis_report.csv` (written by analyze_trace.py), and TTFT and tok/s are
+left out.
+
+Writes report.md, comparison.csv and requests.csv to
+results/compare/<timestamp>/ and exits 1 if any regression is found.
+
+Usage:
+  python3 performance_evaluation/compare_runs.py results/npu_profile/20251125T154833Z results/npu_profile/20251125T164154Z
+  python3 performance_evaluation/compare_runs.py BASE NEW1 NEW2 --confidence 0.99 --min-effect 0.05
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# name -> (label, True when higher is better)
+METRICS = {
+    "ttft_s": ("TTFT (s)", False),
+    "tok_s": ("Decode tok/s", True),
+    "latency_s": ("Request latency (s)", False),
+    "npu_pct": ("NPU utilization (%)", True),
+    "python_overhead_ms": ("Python overhead (ms/step)", False),
+}
+# Samples above this count as NPU activity when a run has no start times
+ACTIVE_NPU_PCT = 5
+
+
+def load_trace(path):
+    if not os.path.exists(path):
+        return None
+    trace = pd.read_csv(path)
+    if trace.empty:
+        return None
+    trace["t"] = (pd.to_datetime(trace["timestamp"], utc=True, format="ISO8601")
+                  - pd.Timestamp(0, tz="UTC")).dt.total_seconds()
+    return trace
+
+
+def request_metrics(record, trace):
+    """Metric values for one generations.jsonl record."""
+    row = {"latency_s": record.get("elapsed_s")}
+    m = record.get("metrics") or {}
+    if m.get("prompt_eval_duration"):
+        row["ttft_s"] = m["prompt_eval_duration"] / 1e9
+    if m.get("eval_count") and m.get("eval_duration"):
+        row["tok_s"] = m["eval_count"] / (m["eval_duration"] / 1e9)
+    steps = m.get("prompt_eval_count", 0) + m.get("eval_count", 0)
+    if "layer_duration" in m and steps:
+        host_ns = m["prompt_eval_duration"] + m["eval_duration"] - m["layer_duration"] - m.get("post_duration", 0)
+        row["python_overhead_ms"] = host_ns / steps / 1e6
+    if trace is not None and record.get("started_at"):
+        start = record["started_at"]
+        window = trace[(trace["t"] >= start) & (trace["t"] <= start + record["elapsed_s"])]
+        if not window.empty:
+            row["npu_pct"] = window["npu_pct"].mean()
+    return row
+
+
+def load_run(path):
+    """DataFrame of one run's requests, keyed by (prompt, occurrence)."""
+    with open(os.path.join(path, "generations.jsonl"), encoding="utf-8") as fh:
+        records = [json.loads(line) for line in fh if line.strip()]
+    trace = load_trace(os.path.join(path, "npu_trace.csv"))
+    rows, seen = [], {}
+    for record in records:
+        if record.get("status_code") != 200:
+            continue
+        prompt = record["prompt"]
+        seen[prompt] = seen.get(prompt, 0) + 1
+        rows.append(dict(prompt=prompt, occurrence=seen[prompt], request_id=record.get("request_id"),
+                         **request_metrics(record, trace)))
+    df = pd.DataFrame(rows, columns=["prompt", "occurrence", "request_id"] + list(METRICS))
+
+    # Fallbacks for runs recorded before per-request metrics existed
+    if not df.empty and df["npu_pct"].isna().all() and trace is not None:
+        active = trace[trace["npu_pct"] > ACTIVE_NPU_PCT]
+        if not active.empty:
+            span = trace[(trace["t"] >= active["t"].iloc[0]) & (trace["t"] <= active["t"].iloc[-1])]
+            df["npu_pct"] = span["npu_pct"].mean() if len(df) == 1 else np.nan
+    report = os.path.join(path, "analysis_report.csv")
+    if not df.empty and df["python_overhead_ms"].isna().all() and os.path.exists(report):
+        steps = pd.read_csv(report)
+        if "request_id" in steps:
+            overhead = steps.groupby("request_id")["python_overhead"].mean() * 1000
+            df["python_overhead_ms"] = df["request_id"].map(overhead)
+        else:
+            # Older reports cover the run's first request only
+            df.loc[df.index[0], "python_overhead_ms"] = steps["python_overhead"].mean() * 1000
+    return df.set_index(["prompt", "occurrence"])
+
+
+def bootstrap_delta(base, new, paired, iterations, confidence, rng):
+    """Mean difference new - base with a percentile bootstrap interval."""
+    if paired:
+        diffs = new - base
+        idx = rng.integers(0, len(diffs), size=(iterations, len(diffs)))
+        samples = diffs[idx].mean(axis=1)
+        delta = diffs.mean()
+    else:
+        b_idx = rng.integers(0, len(base), size=(iterations, len(base)))
+        n_idx = rng.integers(0, len(new), size=(iterations, len(new)))
+        samples = new[n_idx].mean(axis=1) - base[b_idx].mean(axis=1)
+        delta = new.mean() - base.mean()
+    alpha = (1 - confidence) / 2
+    return delta, np.quantile(samples, alpha), np.quantile(samples, 1 - alpha)
+
+
+def compare(base, new, args, rng):
+    rows = []
+    joined = base.join(new, how="inner", lsuffix="_base", rsuffix="_new")
+    for name, (label, higher_better) in METRICS.items():
+        pairs = joined[[f"{name}_base", f"{name}_new"]].dropna()
+        paired = len(pairs) >= args.min_pairs
+        if paired:
+            b, n = pairs[f"{name}_base"].to_numpy(), pairs[f"{name}_new"].to_numpy()
+        else:
+            b, n = base[name].dropna().to_numpy(), new[name].dropna().to_numpy()
+        row = {"metric": name, "label": label, "paired": paired, "n_base": len(b), "n_new": len(n)}
+        if len(b) == 0 or len(n) == 0:
+            rows.append(dict(row, verdict="n/a"))
+            continue
+        base_mean, new_mean = float(b.mean()), float(n.mean())
+        if len(b) > 1 or len(n) > 1:
+            delta, lo, hi = bootstrap_delta(b, n, paired, args.iterations, args.confidence, rng)
+        else:
+            delta, lo, hi = new_mean - base_mean, float("nan"), float("nan")
+        significant = bool(lo > 0 or hi < 0)
+        worse = delta > 0 if not higher_better else delta < 0
+        relative = delta / base_mean if base_mean else float("nan")
+        if significant and abs(relative) >= args.min_effect:
+            verdict = "REGRESSION" if worse else "improvement"
+        elif significant:
+            verdict = "below min effect"
+        else:
+            verdict = "no significant change" if len(b) > 1 or len(n) > 1 else "single sample"
+        rows.append(dict(row, base_mean=base_mean, new_mean=new_mean, delta=float(delta),
+                         delta_pct=100 * relative, ci_low=float(lo), ci_high=float(hi),
+                         significant=significant, verdict=verdict))
+    return rows, joined
+
+
+def fmt(value, digits=3):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return "-"
+    return f"{value:.{digits}f}"
+
+
+def write_report(out_dir, runs, comparisons, args):
+    lines = ["# Benchmark run comparison", "",
+             f"Baseline: `{runs[0]}`  ",
+             f"Confidence: {args.confidence:.0%} bootstrap ({args.iterations} resamples); "
+             f"minimum effect {args.min_effect:.0%}", ""]
+    for run, rows in comparisons:
+        lines += [f"## `{os.path.basename(os.path.normpath(run))}` vs baseline", "",
+                  "| Metric | n (base/new) | Baseline | New | Delta | Delta % | CI | Verdict |",
+                  "|---|---|---|---|---|---|---|---|"]
+        for r in rows:
+            n = f"{r['n_base']}/{r['n_new']}" + (" paired" if r["paired"] else "")
+            ci = f"[{fmt(r.get('ci_low'))}, {fmt(r.get('ci_high'))}]"
+            verdict = f"**{r['verdict']}**" if r["verdict"] == "REGRESSION" else r["verdict"]
+            lines.append(f"| {r['label']} | {n} | {fmt(r.get('base_mean'))} | {fmt(r.get('new_mean'))} | "
+                         f"{fmt(r.get('delta'))} | {fmt(r.get('delta_pct'), 1)} | {ci} | {verdict} |")
+        lines.append("")
+    with open(os.path.join(out_dir, "report.md"), "w", encoding="utf-8") as fh:
+        fh.write("\n".join(lines))
+
+    fields = ["run", "metric", "paired", "n_base", "n_new", "base_mean", "new_mean", "delta", "delta_pct",
+              "ci_low", "ci_high", "significant", "verdict"]
+    with open(os.path.join(out_dir, "comparison.csv"), "w", newline="", encoding="utf-8") as fh:
+        writer = csv.DictWriter(fh, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        for run, rows in comparisons:
+            writer.writerows(dict(r, run=run) for r in rows)
+    return "\n".join(lines)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("runs", nargs="+", help="npu_profile result directories; the first is the baseline")
+    p.add_argument("--confidence", type=float, default=0.95)
+    p.add_argument("--iterations", type=int, default=10000, help="Bootstrap resamples")
+    p.add_argument("--min-pairs", type=int, default=3, help="Aligned requests needed for a paired comparison")
+    p.add_argument("--min-effect", type=float, default=0.02,
+                   help="Relative change below which significant deltas are not flagged")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out-dir", default="performance_evaluation/results/compare")
+    args = p.parse_args()
+    if len(args.runs) < 2:
+        p.error("need a baseline and at least one run to compare")
+
+    rng = np.random.default_rng(args.seed)
+    frames = [load_run(run) for run in args.runs]
+    out_dir = os.path.join(args.out_dir, datetime.utcnow().strftime("%Y%m%dT%H%M%SZ"))
+    os.makedirs(out_dir, exist_ok=True)
+
+    comparisons, aligned = [], []
+    for run, frame in zip(args.runs[1:], frames[1:]):
+        rows, joined = compare(frames[0], frame, args, rng)
+        comparisons.append((run, rows))
+        aligned.append(joined.reset_index().assign(run=run))
+    if aligned:
+        pd.concat(aligned).to_csv(os.path.join(out_dir, "requests.csv"), index=False)
+
+    print(write_report(out_dir, args.runs, comparisons, args))
+    print(f"Wrote comparison to {out_dir}")
+    regressions = [(run, r["metric"]) for run, rows in comparisons for r in rows if r["verdict"] == "REGRESSION"]
+    if regressions:
+        print("Regressions: " + ", ".join(f"{os.path.basename(os.path.normpath(run))}:{m}" for run, m in regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the host-side work of one Qwen3-4B decode step.
+
+Times each host operation of `AX650Backend._generate_qwen3_4b` in isolation,
+with the shapes the loop uses:
+  - embed:        embedding row gather + reshape + bfloat16 cast
+  - mask_indices: bf16 attention mask [1, 1, 1024] and uint32 indices
+  - kv_slice:     K/V cache views and the layer input dict (per layer)
+  - kv_update:    writing the layer's K/V output into the cache (per layer)
+  - post_convert: bf16 -> float32 conversion of the [1, 1, 151936] logits
+  - sample:       `_sample` for each --sample setting (top_k:top_p)
+  - encode/decode/decode_token: tokenizer calls (needs --model-path)
+
+Each op runs --warmup times, then --repeat batches of --number calls; ns/op
+is reported as the median (and min/mean/std) over batches. A separate pass
+under tracemalloc reports allocations per op: traced bytes at the peak of one
+call (transient) and still held after it (retained). numpy allocations are
+traced; torch's CPU allocator is not, so `sample` shows only its numpy part.
+
+The per-step estimate multiplies each op by its calls per decode step
+(--layers for the KV ops) to show how the host overhead per token adds up.
+
+Usage:
+  python3 performance_evaluation/hotpath_bench.py
+  python3 performance_evaluation/hotpath_bench.py --model-path ./models/qwen3 --save results/hotpath_before.json
+  python3 performance_evaluation/hotpath_bench.py --only sample,post_convert --baseline results/hotpath_before.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import ml_dtypes
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ollama_ax650_integration_mvp"))
+
+HIDDEN = 2560
+KV_DIM = 1024
+MAX_SEQ = 1024
+VOCAB = 151936
+NUM_LAYERS = 36
+
+
+class Bench:
+    """One benchmarked op: `fn(i)` is called with a running counter."""
+
+    def __init__(self, name, fn, per_step=1, params=None):
+        self.name = name
+        self.fn = fn
+        self.per_step = per_step
+        self.params = params or {}
+
+
+def build_benches(args, rng):
+    benches = []
+    # Distinct inputs per call, precomputed so the loop times only the op
+    tokens = rng.integers(0, args.embed_rows, size=4096)
+    positions = rng.integers(0, MAX_SEQ - 1, size=4096)
+
+    # A float32 table larger than the caches, like the 1.5 GB real one
+    embedding = rng.standard_normal((args.embed_rows, HIDDEN), dtype=np.float32)
+
+    def embed(i):
+        return embedding[tokens[i & 4095]].reshape(1, 1, HIDDEN).astype(ml_dtypes.bfloat16)
+
+    def mask_indices(i):
+        pos = positions[i & 4095]
+        mask = np.zeros((1, 1, MAX_SEQ), dtype=ml_dtypes.bfloat16)
+        mask[:, :, :pos + 1] = 1.0
+        indices = np.array([[pos]], dtype=np.uint32)
+        return mask, indices
+
+    k_caches = [np.zeros((1, MAX_SEQ, KV_DIM), dtype=ml_dtypes.bfloat16) for _ in range(args.layers)]
+    v_caches = [np.zeros((1, MAX_SEQ, KV_DIM), dtype=ml_dtypes.bfloat16) for _ in range(args.layers)]
+    hidden = np.zeros((1, 1, HIDDEN), dtype=ml_dtypes.bfloat16)
+    mask, indices = mask_indices(0)
+    k_out = rng.standard_normal((1, 1, KV_DIM)).astype(ml_dtypes.bfloat16)
+    v_out = rng.standard_normal((1, 1, KV_DIM)).astype(ml_dtypes.bfloat16)
+
+    def kv_slice(i):
+        layer = i % args.layers
+        return {"input": hidden, "K_cache": k_caches[layer][:, :1023, :],
+                "V_cache": v_caches[layer][:, :1023, :], "indices": indices, "mask": mask}
+
+    def kv_update(i):
+        layer, pos = i % args.layers, positions[i & 4095]
+        k_caches[layer][:, pos, :] = k_out.reshape(1, KV_DIM)
+        v_caches[layer][:, pos, :] = v_out.reshape(1, KV_DIM)
+
+    logits_bf16 = (rng.standard_normal((1, 1, VOCAB)) * 4).astype(ml_dtypes.bfloat16)
+
+    def post_convert(i):
+        return logits_bf16.astype(np.float32)
+
+    benches += [Bench("embed", embed, params={"rows": args.embed_rows}),
+                Bench("mask_indices", mask_indices),
+                Bench("kv_slice", kv_slice, per_step=args.layers),
+                Bench("kv_update", kv_update, per_step=args.layers),
+                Bench("post_convert", post_convert)]
+
+    from inference_engine import AX650Backend
+    for spec in args.sample.split(","):
+        top_k, top_p = spec.split(":")
+        top_k, top_p = int(top_k), float(top_p)
+        # _sample keeps no state; call it unbound on the bf16 logits as the loop does
+        fn = (lambda k, p: lambda i: AX650Backend._sample(None, logits_bf16, args.temperature, p, k))(top_k, top_p)
+        # Only the default setting counts toward the per-step estimate
+        per_step = 1 if (top_k, top_p) == (40, 0.9) else 0
+        benches.append(Bench(f"sample[k={top_k},p={top_p:g}]", fn, per_step=per_step,
+                             params={"top_k": top_k, "top_p": top_p, "temperature": args.temperature}))
+
+    if args.model_path:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+        with open(args.prompts_file, encoding="utf-8") as fh:
+            prompts = [line.strip() for line in fh if line.strip()]
+        encoded = [tokenizer.encode(p) for p in prompts]
+        generated = [ids[:64] for ids in encoded]
+        benches += [Bench("encode", lambda i: tokenizer.encode(prompts[i % len(prompts)]), per_step=0,
+                          params={"prompts": len(prompts)}),
+                    Bench("decode", lambda i: tokenizer.decode(generated[i % len(generated)],
+                                                               skip_special_tokens=True), per_step=0),
+                    Bench("decode_token", lambda i: tokenizer.decode([encoded[0][i % len(encoded[0])]]),
+                          per_step=1)]
+    return benches
+
+
+def time_bench(bench, warmup, repeat, number):
+    fn = bench.fn
+    for i in range(warmup):
+        fn(i)
+    per_op = []
+    i = warmup
+    for _ in range(repeat):
+        t0 = time.perf_counter_ns()
+        for _ in range(number):
+            fn(i)
+            i += 1
+        per_op.append((time.perf_counter_ns() - t0) / number)
+    return {"median_ns": statistics.median(per_op), "min_ns": min(per_op),
+            "mean_ns": statistics.fmean(per_op),
+            "std_ns": statistics.stdev(per_op) if len(per_op) > 1 else 0.0}
+
+
+def alloc_bench(bench, calls):
+    """Traced bytes per call: peak during it and retained after it."""
+    fn = bench.fn
+    fn(0)
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for i in range(1, calls + 1):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            result = fn(i)
+            after, peak = tracemalloc.get_traced_memory()
+            del result
+            peaks.append(peak - before)
+            retained.append(after - before)
+    finally:
+        tracemalloc.stop()
+    return {"alloc_peak_bytes": statistics.median(peaks), "alloc_retained_bytes": statistics.median(retained)}
+
+
+def print_results(rows):
+    print(f"{'op':<24} {'median ns':>12} {'min ns':>12} {'std ns':>10} {'peak B':>10} {'kept B':>8} {'/step':>5}")
+    for r in rows:
+        print(f"{r['name']:<24} {r['median_ns']:>12.0f} {r['min_ns']:>12.0f} {r['std_ns']:>10.0f} "
+              f"{r.get('alloc_peak_bytes', 0):>10.0f} {r.get('alloc_retained_bytes', 0):>8.0f} {r['per_step']:>5}")
+    step_ns = sum(r["median_ns"] * r["per_step"] for r in rows)
+    print(f"\nEstimated host time per decode step (ops above x calls per step): {step_ns / 1e6:.3f} ms")
+    return step_ns
+
+
+def print_comparison(rows, baseline, threshold):
+    base = {r["name"]: r for r in baseline["results"]}
+    print(f"\n{'op':<24} {'baseline ns':>12} {'current ns':>12} {'ratio':>7}")
+    for r in rows:
+        b = base.get(r["name"])
+        if b is None:
+            continue
+        ratio = r["median_ns"] / b["median_ns"] if b["median_ns"] else float("inf")
+        flag = "  SLOWER" if ratio > threshold else ("  faster" if ratio < 1 / threshold else "")
+        print(f"{r['name']:<24} {b['median_ns']:>12.0f} {r['median_ns']:>12.0f} {ratio:>7.3f}{flag}")
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--warmup", type=int, default=50, help="Untimed calls per op")
+    p.add_argument("--repeat", type=int, default=7, help="Timed batches per op")
+    p.add_argument("--number", type=int, default=200, help="Calls per batch")
+    p.add_argument("--alloc-calls", type=int, default=50, help="Calls traced for allocations (0 to skip)")
+    p.add_argument("--layers", type=int, default=NUM_LAYERS)
+    p.add_argument("--embed-rows", type=int, default=16384,
+                   help="Rows of the synthetic float32 embedding table")
+    p.add_argument("--sample", default="40:0.9,0:1.0,1:1.0,40:1.0,0:0.9",
+                   help="Comma-separated top_k:top_p settings for _sample")
+    p.add_argument("--temperature", type=float, default=0.8)
+    p.add_argument("--model-path", help="Tokenizer directory for the encode/decode benchmarks")
+    p.add_argument("--prompts-file", default=os.path.join(os.path.dirname(__file__), "prompts.txt"))
+    p.add_argument("--only", help="Comma-separated op name prefixes to run")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--save", help="JSON output path (default results/hotpath_bench/<timestamp>.json)")
+    p.add_argument("--baseline", help="Earlier JSON result to compare against")
+    p.add_argument("--threshold", type=float, default=1.10, help="Ratio flagged as slower in the comparison")
+    args = p.parse_args()
+
+    benches = build_benches(args, np.random.default_rng(args.seed))
+    if args.only:
+        prefixes = tuple(args.only.split(","))
+        benches = [b for b in benches if b.name.startswith(prefixes)]
+
+    rows = []
+    for bench in benches:
+        row = {"name": bench.name, "per_step": bench.per_step, "params": bench.params}
+        row.update(time_bench(bench, args.warmup, args.repeat, args.number))
+        if args.alloc_calls:
+            row.update(alloc_bench(bench, args.alloc_calls))
+        rows.append(row)
+    step_ns = print_results(rows)
+
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    out = args.save or os.path.join("performance_evaluation", "results", "hotpath_bench", f"{timestamp}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    result = {"timestamp": timestamp, "python": sys.version.split()[0], "numpy": np.__version__,
+              "config": {k: v for k, v in vars(args).items() if k not in ("save", "baseline")},
+              "step_host_ns": step_ns, "results": rows}
+    with open(out, "w") as fh:
+        json.dump(result, fh, indent=2)
+    print(f"Saved results to {out}")
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            print_comparison(rows, json.load(fh), args.threshold)
+
+
+if __name__ == "__main__":
+    main()
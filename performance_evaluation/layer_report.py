@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Report per-layer NPU latency from the backend's quantile sketches.
+
+Ranks the 36 layer models and the post model by median latency, shows how
+latency grows with context position, and compares against a saved snapshot
+to flag regressions (exit code 1 when any layer is slower than the baseline
+by more than --threshold).
+
+Usage:
+  python3 performance_evaluation/layer_report.py --save results/layers_before.json
+  python3 performance_evaluation/layer_report.py --baseline results/layers_before.json
+  python3 performance_evaluation/layer_report.py --snapshot results/layers_after.json --baseline results/layers_before.json
+"""
+import argparse
+import json
+import os
+import sys
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ollama_ax650_integration_mvp"))
+from layer_stats import LayerStats, compare  # noqa: E402
+
+
+def load_stats(args):
+    if args.snapshot:
+        with open(args.snapshot) as f:
+            return LayerStats.from_dict(json.load(f))
+    r = requests.get(args.url, params={"format": "raw"}, timeout=10)
+    r.raise_for_status()
+    return LayerStats.from_dict(r.json())
+
+
+def print_layers(report, top):
+    rows = report["layers"][:top] if top else report["layers"]
+    print(f"{'rank':>4} {'layer':>6} {'count':>8} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  (ms)")
+    for r in rows:
+        print(f"{r['rank']:>4} {str(r['layer']):>6} {r['count']:>8} {r['mean_ms']:>8.2f} {r['p50_ms']:>8.2f} "
+              f"{r['p90_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['max_ms']:>8.2f}")
+
+
+def print_positions(report):
+    print(f"\n{'positions':>10} {'count':>8} {'p50':>8} {'p90':>8} {'p99':>8}  (ms per layer call)")
+    for r in report["positions"]:
+        print(f"{r['positions']:>10} {r['count']:>8} {r['p50_ms']:>8.2f} {r['p90_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+
+def print_comparison(result, threshold):
+    print(f"\nComparison with baseline (regression when ratio > {threshold:.2f})")
+    print(f"{'layer':>6} {'baseline':>9} {'current':>9} {'ratio':>7}")
+    for r in result["layers"]:
+        flag = "  REGRESSION" if r["regression"] else ""
+        print(f"{str(r['layer']):>6} {r['baseline_ms']:>9.2f} {r['current_ms']:>9.2f} {r['ratio']:>7.3f}{flag}")
+    for c in result["regressed_cells"][:10]:
+        print(f"  layer {c['layer']} at positions {c['positions_from']}+: {c['ratio']:.2f}x")
+    if result["regressions"]:
+        print(f"\nRegressed layers: {', '.join(str(l) for l in result['regressions'])}")
+    else:
+        print("\nNo layer regressions")
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--url", default="http://localhost:5002/layer_stats")
+    p.add_argument("--snapshot", help="Read stats from a saved snapshot instead of --url")
+    p.add_argument("--save", help="Write the raw stats to this file for later comparison")
+    p.add_argument("--baseline", help="Snapshot to compare against")
+    p.add_argument("--threshold", type=float, default=1.10, help="Latency ratio counted as a regression")
+    p.add_argument("--quantile", type=float, default=0.5)
+    p.add_argument("--min-count", type=int, default=20, help="Ignore layers with fewer samples")
+    p.add_argument("--top", type=int, default=0, help="Only print the N slowest layers")
+    p.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = p.parse_args()
+
+    stats = load_stats(args)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(stats.to_dict(), f)
+        print(f"Saved snapshot to {args.save}")
+
+    report = stats.report()
+    result = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = LayerStats.from_dict(json.load(f))
+        result = compare(baseline, stats, args.threshold, args.quantile, args.min_count)
+
+    if args.json:
+        print(json.dumps({"report": report, "comparison": result}, indent=2))
+    else:
+        if not report["layers"]:
+            print("No layer samples recorded yet")
+        print_layers(report, args.top)
+        print_positions(report)
+        if result is not None:
+            print_comparison(result, args.threshold)
+    return 1 if result and result["regressions"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
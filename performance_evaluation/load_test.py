@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""Load generator for the proxy, the Ollama-compatible port or a runtime.
+
+Streams every response to measure time to first token (TTFT), the gaps
+between streamed chunks and time per output token (TPOT), under either
+  - closed-loop load: N concurrent clients each sending back-to-back
+    requests (--concurrency 1,2,4), or
+  - open-loop load: Poisson arrivals at R requests/second (--rate 0.05,0.1),
+    independent of how fast responses come back.
+
+Prompts are drawn from a prompts.txt-style corpus (one prompt per line; an
+optional tab-separated number sets that prompt's output length). Output
+lengths otherwise come from --max-tokens: "64", "uniform:16:128" or
+"lognormal:64:0.5" (median, sigma).
+
+Creates results/load_test/<timestamp>/ with:
+- `requests.jsonl` (one record per request: level, timings, tokens, error)
+- `summary.json` / `summary.csv` (per level: p50/p95/p99 of TTFT, TPOT,
+  chunk gap and latency, throughput and error rate)
+
+Usage:
+  python3 performance_evaluation/load_test.py --target proxy --concurrency 1,2 --requests 20
+  python3 performance_evaluation/load_test.py --target ollama --rate 0.05,0.1 --duration 600
+  python3 performance_evaluation/load_test.py --target runtime --url http://localhost:8000 --concurrency 1
+
+Runtimes serve one generation at a time and are polled, so with --target
+runtime concurrent requests show up as "llm is running" errors and a chunk
+may carry several tokens.
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import requests
+
+DEFAULT_URLS = {"proxy": "http://localhost:5002", "ollama": "http://localhost:11434",
+                "runtime": "http://localhost:8000"}
+
+
+def load_corpus(path):
+    """[(prompt, max_tokens or None)] from a prompts.txt-style file."""
+    corpus = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.rstrip("\n")
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            prompt, _, length = line.partition("\t")
+            corpus.append((prompt.strip(), int(length) if length.strip().isdigit() else None))
+    if not corpus:
+        raise SystemExit(f"No prompts in {path}")
+    return corpus
+
+
+def length_sampler(spec, rng):
+    """Callable returning an output length from "N", "uniform:a:b" or "lognormal:median:sigma"."""
+    kind, *params = spec.split(":")
+    if kind == "uniform":
+        lo, hi = int(params[0]), int(params[1])
+        return lambda: rng.randint(lo, hi)
+    if kind == "lognormal":
+        median, sigma = float(params[0]), float(params[1])
+        return lambda: max(1, int(round(rng.lognormvariate(math.log(median), sigma))))
+    fixed = int(kind)
+    return lambda: fixed
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+# -- one request per target ----------------------------------------------
+
+def _stream_ndjson(response, on_chunk):
+    """Feed NDJSON events to on_chunk; return the final (done) event."""
+    final = {}
+    for line in response.iter_lines():
+        if not line:
+            continue
+        event = json.loads(line)
+        if event.get("error"):
+            raise RuntimeError(event["error"])
+        if event.get("done"):
+            final = event
+            break
+        text = event.get("response")
+        if text is None:
+            text = (event.get("message") or {}).get("content", "")
+        if text:
+            on_chunk(text)
+    return final
+
+
+def request_proxy(url, prompt, max_tokens, args, on_chunk):
+    payload = {"prompt": prompt, "max_tokens": max_tokens, "temperature": args.temperature,
+               "stream": True, "request_id": str(uuid.uuid4()), "cache": args.allow_cache}
+    if args.model:
+        payload["model"] = args.model
+    with requests.post(f"{url}/generate", json=payload, stream=True, timeout=args.timeout) as r:
+        r.raise_for_status()
+        final = _stream_ndjson(r, on_chunk)
+    return (final.get("metrics") or {}).get("eval_count")
+
+
+def request_ollama(url, prompt, max_tokens, args, on_chunk):
+    payload = {"model": args.model or "qwen3-ax650:latest", "prompt": prompt, "stream": True,
+               "options": {"num_predict": max_tokens, "temperature": args.temperature}}
+    with requests.post(f"{url}/api/generate", json=payload, stream=True, timeout=args.timeout) as r:
+        r.raise_for_status()
+        final = _stream_ndjson(r, on_chunk)
+    return final.get("eval_count")
+
+
+def request_runtime(url, prompt, max_tokens, args, on_chunk):
+    if args.runtime_reset:
+        requests.post(f"{url}/api/reset", json={"system_prompt": ""}, timeout=30).raise_for_status()
+    r = requests.post(f"{url}/api/generate", timeout=30,
+                      json={"prompt": prompt, "max_tokens": max_tokens, "temperature": args.temperature})
+    if r.status_code != 200:
+        raise RuntimeError(r.json().get("error", f"HTTP {r.status_code}"))
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        result = requests.get(f"{url}/api/generate_provider", timeout=10).json()
+        if result.get("response"):
+            on_chunk(result["response"])
+        if result.get("done"):
+            return (result.get("metrics") or {}).get("eval_count")
+        time.sleep(args.poll_interval)
+    requests.get(f"{url}/api/stop", timeout=5)
+    raise TimeoutError("generation did not finish")
+
+
+TARGETS = {"proxy": request_proxy, "ollama": request_ollama, "runtime": request_runtime}
+
+
+def run_one(level, prompt, max_tokens, args, run_start):
+    chunk_times = []
+    t0 = time.perf_counter()
+    record = {"level": level, "start_s": t0 - run_start, "prompt_chars": len(prompt), "max_tokens": max_tokens}
+    try:
+        tokens = TARGETS[args.target](args.url, prompt, max_tokens, args,
+                                      lambda text: chunk_times.append(time.perf_counter()))
+        record["ok"] = True
+    except Exception as e:
+        tokens = None
+        record.update(ok=False, error=str(e))
+    end = time.perf_counter()
+    record["latency_s"] = end - t0
+    record["chunks"] = len(chunk_times)
+    record["tokens"] = tokens if tokens is not None else len(chunk_times)
+    if chunk_times:
+        record["ttft_s"] = chunk_times[0] - t0
+        record["gaps_s"] = [b - a for a, b in zip(chunk_times, chunk_times[1:])]
+        if record["tokens"] > 1:
+            record["tpot_s"] = (chunk_times[-1] - chunk_times[0]) / (record["tokens"] - 1)
+    return record
+
+
+# -- load shapes -----------------------------------------------------------
+
+def closed_loop(concurrency, next_request, args, run_start, records):
+    """`concurrency` clients, each sending its next request when the last ends."""
+    stop_at = time.perf_counter() + args.duration if args.duration else None
+    budget = [args.requests]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if budget[0] is not None:
+                    if budget[0] <= 0:
+                        return
+                    budget[0] -= 1
+            if stop_at and time.perf_counter() >= stop_at:
+                return
+            prompt, max_tokens = next_request()
+            record = run_one(f"c{concurrency}", prompt, max_tokens, args, run_start)
+            with lock:
+                records.append(record)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def open_loop(rate, next_request, args, run_start, records, rng):
+    """Poisson arrivals at `rate`/s until --duration or --requests is reached."""
+    stop_at = time.perf_counter() + args.duration if args.duration else None
+    lock = threading.Lock()
+    threads = []
+    sent = 0
+    next_at = time.perf_counter()
+    while (args.requests is None or sent < args.requests) and (stop_at is None or next_at < stop_at):
+        time.sleep(max(0.0, next_at - time.perf_counter()))
+        prompt, max_tokens = next_request()
+
+        def fire(prompt=prompt, max_tokens=max_tokens):
+            record = run_one(f"r{rate:g}", prompt, max_tokens, args, run_start)
+            with lock:
+                records.append(record)
+
+        t = threading.Thread(target=fire, daemon=True)
+        t.start()
+        threads.append(t)
+        sent += 1
+        next_at += rng.expovariate(rate)
+    for t in threads:
+        t.join(args.timeout)
+
+
+def summarize(level, records, wall_s):
+    ok = [r for r in records if r["ok"]]
+    row = {"level": level, "requests": len(records), "errors": len(records) - len(ok),
+           "error_rate": (len(records) - len(ok)) / len(records) if records else 0.0,
+           "wall_s": wall_s,
+           "throughput_rps": len(ok) / wall_s if wall_s else 0.0,
+           "throughput_tok_s": sum(r["tokens"] for r in ok) / wall_s if wall_s else 0.0}
+    series = {"ttft_s": [r["ttft_s"] for r in ok if "ttft_s" in r],
+              "tpot_s": [r["tpot_s"] for r in ok if "tpot_s" in r],
+              "gap_s": [g for r in ok for g in r.get("gaps_s", [])],
+              "latency_s": [r["latency_s"] for r in ok]}
+    for name, values in series.items():
+        for q in (0.5, 0.95, 0.99):
+            row[f"{name}_p{int(q * 100)}"] = percentile(values, q)
+    errors = {}
+    for r in records:
+        if not r["ok"]:
+            errors[r["error"][:80]] = errors.get(r["error"][:80], 0) + 1
+    row["error_kinds"] = errors
+    return row
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--target", choices=sorted(TARGETS), default="proxy")
+    p.add_argument("--url", help="Base URL (default depends on --target)")
+    p.add_argument("--model", help="Model name to request")
+    p.add_argument("--prompts-file", default=os.path.join(os.path.dirname(__file__), "prompts.txt"))
+    p.add_argument("--max-tokens", default="64", help='"N", "uniform:a:b" or "lognormal:median:sigma"')
+    p.add_argument("--temperature", type=float, default=0.8)
+    p.add_argument("--concurrency", help="Closed-loop levels, e.g. 1,2,4")
+    p.add_argument("--rate", help="Open-loop Poisson arrival rates (req/s), e.g. 0.05,0.1")
+    p.add_argument("--requests", type=int, help="Requests per level")
+    p.add_argument("--duration", type=float, help="Seconds per level")
+    p.add_argument("--warmup", type=int, default=1, help="Unmeasured requests before the first level")
+    p.add_argument("--timeout", type=float, default=600.0)
+    p.add_argument("--poll-interval", type=float, default=0.05, help="Runtime provider poll interval")
+    p.add_argument("--no-runtime-reset", dest="runtime_reset", action="store_false",
+                   help="Continue the runtime's conversation instead of resetting per request")
+    p.add_argument("--allow-cache", action="store_true",
+                   help="Let the proxy serve cached/coalesced responses (off: every request generates)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out-dir", default="performance_evaluation/results/load_test")
+    args = p.parse_args()
+
+    args.url = (args.url or DEFAULT_URLS[args.target]).rstrip("/")
+    if not args.concurrency and not args.rate:
+        args.concurrency = "1"
+    if args.requests is None and args.duration is None:
+        args.requests = 10
+
+    rng = random.Random(args.seed)
+    corpus = load_corpus(args.prompts_file)
+    sample_length = length_sampler(args.max_tokens, rng)
+
+    def next_request():
+        prompt, length = rng.choice(corpus)
+        return prompt, length or sample_length()
+
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    outdir = os.path.join(args.out_dir, timestamp)
+    os.makedirs(outdir, exist_ok=True)
+
+    run_start = time.perf_counter()
+    for _ in range(args.warmup):
+        record = run_one("warmup", *next_request(), args, run_start)
+        print(f"warmup: ok={record['ok']} latency={record['latency_s']:.2f}s {record.get('error', '')}")
+
+    levels = [("concurrency", int(c)) for c in (args.concurrency or "").split(",") if c] + \
+             [("rate", float(r)) for r in (args.rate or "").split(",") if r]
+    rows = []
+    with open(os.path.join(outdir, "requests.jsonl"), "w", encoding="utf-8") as fh:
+        for kind, value in levels:
+            records = []
+            t0 = time.perf_counter()
+            if kind == "concurrency":
+                closed_loop(value, next_request, args, run_start, records)
+                level = f"c{value}"
+            else:
+                open_loop(value, next_request, args, run_start, records, rng)
+                level = f"r{value:g}"
+            wall = time.perf_counter() - t0
+            for record in records:
+                fh.write(json.dumps(record) + "\n")
+            fh.flush()
+            row = summarize(level, records, wall)
+            rows.append(row)
+            fmt = lambda v: "-" if v is None else f"{v:.3f}"
+            print(f"{level}: {row['requests']} requests, {row['errors']} errors, "
+                  f"{row['throughput_rps']:.3f} req/s, {row['throughput_tok_s']:.2f} tok/s | "
+                  f"TTFT p50/p95/p99 {fmt(row['ttft_s_p50'])}/{fmt(row['ttft_s_p95'])}/{fmt(row['ttft_s_p99'])}s | "
+                  f"TPOT p50/p95/p99 {fmt(row['tpot_s_p50'])}/{fmt(row['tpot_s_p95'])}/{fmt(row['tpot_s_p99'])}s")
+
+    summary = {"timestamp": timestamp, "target": args.target, "url": args.url, "model": args.model,
+               "prompts_file": args.prompts_file, "max_tokens": args.max_tokens,
+               "temperature": args.temperature, "requests_per_level": args.requests,
+               "duration_per_level": args.duration, "seed": args.seed, "levels": rows}
+    with open(os.path.join(outdir, "summary.json"), "w", encoding="utf-8") as fh:
+        json.dump(summary, fh, indent=2)
+    with open(os.path.join(outdir, "summary.csv"), "w", newline="", encoding="utf-8") as fh:
+        fields = [k for k in rows[0] if k != "error_kinds"] if rows else []
+        writer = csv.DictWriter(fh, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Wrote load test results to {outdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,236 @@
 #!/usr/bin/env python3
 """Profile NPU utilization while running generation requests against the backend.
 
+Requests are submitted sequentially (the default), by N concurrent clients
+(--concurrency), or as open-loop Poisson arrivals (--rate, requests/second),
+and are streamed so each token's arrival time is captured. The NPU tracer
+runs for the whole workload.
+
 Creates a result directory with:
-- `npu_trace.csv` (timestamp, usage)
-- `generations.jsonl` (one JSON per prompt with timing and text)
+- `npu_trace.csv` (wall-clock and perf_counter timestamps, usage)
+- `generations.jsonl` (one JSON per request with timing, token times and text)
+- `timeline.csv` (per --bucket seconds: requests in flight and waiting for
+  their first token, tokens/s, completions, mean NPU utilization)
+- `summary.json` (run settings, latency/throughput summary and the
+  correlation of queue depth, throughput and NPU utilization)
+- `trace.json` (proxy/engine spans and NPU samples; open in Perfetto)
 
 Usage:
   python3 performance_evaluation/npu_profile.py --prompts-file performance_evaluation/prompts.txt
+  python3 performance_evaluation/npu_profile.py --prompts-file performance_evaluation/prompts.txt --concurrency 4 --repeat 3
+  python3 performance_evaluation/npu_profile.py --prompts-file performance_evaluation/prompts.txt --rate 0.05 --repeat 10
 
-Requires `axcl-smi` in PATH for NPU sampling; falls back to reading via `axcl` APIs if available.
+Requires `axcl-smi` in PATH for NPU sampling (or AX650_AXCL_SMI_FIXTURE
+pointing at recorded output).
 """
 import argparse
 import os
+import sys
 import time
+import random
 import threading
-import subprocess
 import csv
 import json
 from datetime import datetime
 import requests
 import uuid
 
+import numpy as np
 
-def get_npu_usage_axcl_smi():
-    try:
-        r = subprocess.run(["axcl-smi"], capture_output=True, text=True, timeout=2)
-        out = r.stdout
-        # Attempt to extract the NPU percentage (second percentage group)
-        # Example line fragments: "| 2%        27% |"
-        import re
-        m = re.search(r"\|\s+\d+%\s+(\d+)%\s+\|", out)
-        if m:
-            return int(m.group(1))
-    except Exception:
-        pass
-    return None
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ollama_ax650_integration_mvp"))
+from telemetry import default_source  # noqa: E402
 
 
 class NPUTracer(threading.Thread):
-    def __init__(self, out_csv, interval=0.1, duration=20.0):
-        super().__init__()
+    """Samples NPU utilization until stopped (or for at most `duration` seconds)."""
+
+    def __init__(self, out_csv, interval=0.05, duration=None):
+        super().__init__(daemon=True)
         self.out_csv = out_csv
         self.interval = interval
         self.duration = duration
+        self.source = default_source(interval)
+        self.samples = []  # (perf_counter, npu_pct)
         self._stop_event = threading.Event()
 
+    def read(self):
+        try:
+            cards = self.source.read() if self.source is not None else []
+        except Exception:
+            cards = []
+        if not cards:
+            return None
+        return sum(c["npu_pct"] for c in cards) / len(cards)
+
     def run(self):
         start = time.time()
         with open(self.out_csv, "w", newline='') as fh:
             writer = csv.writer(fh)
-            writer.writerow(["timestamp", "elapsed_s", "npu_pct"])
-            while not self._stop_event.is_set() and (time.time() - start) < self.duration:
-                t = time.time()
-                usage = get_npu_usage_axcl_smi()
-                writer.writerow([datetime.utcnow().isoformat() + "Z", f"{t-start:.6f}", usage if usage is not None else ""])
-                fh.flush()
-                time.sleep(self.interval)
+            # perf_counter is CLOCK_MONOTONIC, the clock of the engine's spans
+            writer.writerow(["timestamp", "elapsed_s", "perf_counter", "npu_pct"])
+            next_at = time.perf_counter()
+            while not self._stop_event.is_set() and (self.duration is None or time.time() - start < self.duration):
+                usage = self.read()
+                t, mono = time.time(), time.perf_counter()
+                writer.writerow([datetime.utcnow().isoformat() + "Z", f"{t-start:.6f}", f"{mono:.6f}",
+                                 usage if usage is not None else ""])
+                if usage is not None:
+                    self.samples.append((mono, usage))
+                # Fixed cadence: the read time is not added to the interval
+                next_at += self.interval
+                self._stop_event.wait(max(0.0, next_at - time.perf_counter()))
 
     def stop(self):
         self._stop_event.set()
+        close = getattr(self.source, "close", None)
+        if close is not None:
+            close()
 
 
-def run_generations(prompts, backend_url, out_jsonl, timeout=120):
+def run_one(prompt, backend_url, max_tokens, timeout):
+    """Stream one generation; returns its record with token arrival times."""
+    # Generate a per-request UUID to correlate with backend logs
+    request_id = str(uuid.uuid4())
+    # Per-step engine trace lines are what analyze_trace.py aligns against;
+    # the response cache is bypassed so repeated runs measure real generations
+    payload = {"prompt": prompt, "max_tokens": max_tokens, "request_id": request_id, "trace": "step",
+               "cache": False, "stream": True}
+    started_at = time.time()
+    t0 = time.perf_counter()
+    token_times = []
+    record = {"prompt": prompt, "started_at": started_at, "submitted_perf": t0, "request_id": request_id}
+    try:
+        with requests.post(backend_url, json=payload, timeout=timeout, stream=True) as r:
+            record["status_code"] = r.status_code
+            final = {}
+            if r.ok:
+                for line in r.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if event.get("done"):
+                        final = event
+                        break
+                    if event.get("response"):
+                        token_times.append(time.perf_counter() - t0)
+            if final.get("error"):
+                record.update(status_code=final.get("status", 500), error=final["error"])
+            # Backend should echo request_id; if not, keep our generated id
+            record.update(text=final.get("text"), metrics=final.get("metrics"),
+                          request_id=final.get("request_id") or request_id)
+    except Exception as e:
+        record.update(status_code=None, error=str(e))
+    record["elapsed_s"] = time.perf_counter() - t0
+    record["ttft_s"] = token_times[0] if token_times else None
+    record["token_times_s"] = [round(t, 6) for t in token_times]
+    return record
+
+
+def run_generations(prompts, backend_url, out_jsonl, timeout=120, concurrency=1, rate=None,
+                    max_tokens=64, seed=0):
+    """Submit `prompts` closed-loop with `concurrency` clients, or open-loop at `rate` req/s."""
     results = []
+    lock = threading.Lock()
+    pending = list(prompts)
+
     with open(out_jsonl, "w", encoding="utf-8") as fh:
-        for p in prompts:
-            # Generate a per-request UUID to correlate with backend logs
-            request_id = str(uuid.uuid4())
-            payload = {"prompt": p, "max_tokens": 64, "request_id": request_id}
-            t0 = time.perf_counter()
-            try:
-                r = requests.post(backend_url, json=payload, timeout=timeout)
-                elapsed = time.perf_counter() - t0
-                resp_json = r.json() if r.ok else {}
-                text = resp_json.get("text")
-                # Backend should echo request_id; if not, fall back to our generated id
-                resp_request_id = resp_json.get("request_id") or request_id
-                record = {"prompt": p, "status_code": r.status_code, "elapsed_s": elapsed, "text": text, "request_id": resp_request_id}
-            except Exception as e:
-                elapsed = time.perf_counter() - t0
-                record = {"prompt": p, "status_code": None, "elapsed_s": elapsed, "error": str(e), "request_id": request_id}
-            fh.write(json.dumps(record, ensure_ascii=False) + "\n")
-            fh.flush()
-            results.append(record)
+        def finish(record):
+            with lock:
+                fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+                fh.flush()
+                results.append(record)
+
+        if rate:
+            rng = random.Random(seed)
+            threads = []
+            next_at = time.perf_counter()
+            for prompt in pending:
+                time.sleep(max(0.0, next_at - time.perf_counter()))
+                t = threading.Thread(target=lambda p=prompt: finish(run_one(p, backend_url, max_tokens, timeout)),
+                                     daemon=True)
+                t.start()
+                threads.append(t)
+                next_at += rng.expovariate(rate)
+            for t in threads:
+                t.join()
+        else:
+            def client():
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        prompt = pending.pop(0)
+                    finish(run_one(prompt, backend_url, max_tokens, timeout))
+
+            threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
     return results
 
 
+def build_timeline(results, samples, start, end, bucket):
+    """Per-bucket queue depth, throughput and NPU utilization (perf_counter clock)."""
+    edges = np.arange(start, end + bucket, bucket)
+    mids = edges[:-1] + bucket / 2
+    submitted = np.sort([r["submitted_perf"] for r in results])
+    first = np.sort([r["submitted_perf"] + (r["ttft_s"] if r["ttft_s"] is not None else r["elapsed_s"])
+                     for r in results])
+    done = np.array([r["submitted_perf"] + r["elapsed_s"] for r in results])
+    # Requests in flight / waiting for a first token at each bucket's midpoint
+    arrived = np.searchsorted(submitted, mids, side="right")
+    in_flight = arrived - np.searchsorted(np.sort(done), mids, side="right")
+    waiting = arrived - np.searchsorted(first, mids, side="right")
+    token_times = np.array([r["submitted_perf"] + t for r in results for t in r["token_times_s"]])
+    tokens = np.histogram(token_times, edges)[0]
+    completed = np.histogram(done, edges)[0]
+    npu = np.full(len(mids), np.nan)
+    if samples:
+        t, pct = np.array(samples).T
+        sums = np.histogram(t, edges, weights=pct)[0]
+        counts = np.histogram(t, edges)[0]
+        npu = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    return [{"t_s": round(float(edges[i] - start), 3), "in_flight": int(in_flight[i]), "waiting": int(waiting[i]),
+             "tokens_per_s": tokens[i] / bucket, "completed": int(completed[i]),
+             "npu_pct": None if np.isnan(npu[i]) else round(float(npu[i]), 2)} for i in range(len(mids))]
+
+
+def correlations(timeline):
+    """Pearson correlation between the timeline series (buckets with an NPU sample)."""
+    rows = [r for r in timeline if r["npu_pct"] is not None]
+    names = ("in_flight", "waiting", "tokens_per_s", "npu_pct")
+    out = {}
+    if len(rows) < 3:
+        return out
+    columns = {n: np.array([r[n] for r in rows], dtype=float) for n in names}
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            if columns[a].std() > 0 and columns[b].std() > 0:
+                out[f"{a}~{b}"] = round(float(np.corrcoef(columns[a], columns[b])[0, 1]), 3)
+    return out
+
+
+def percentiles(values):
+    if not values:
+        return None
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def save_chrome_trace(backend_url, window_s, out_path):
+    """Fetch the proxy's Chrome/Perfetto trace of the last `window_s` seconds."""
+    trace_url = backend_url.rsplit("/", 1)[0] + "/trace"
+    try:
+        r = requests.get(trace_url, params={"window": window_s}, timeout=30)
+        r.raise_for_status()
+        with open(out_path, "w", encoding="utf-8") as fh:
+            json.dump(r.json(), fh)
+        return out_path
+    except Exception as e:
+        print(f"Could not fetch span trace from {trace_url}: {e}")
+        return None
+
+
 def ensure_dir(path):
     os.makedirs(path, exist_ok=True)
     return path
@@ -96,12 +241,24 @@ def main():
     p.add_argument("--prompts-file", required=True)
     p.add_argument("--backend-url", default="http://localhost:5002/generate")
     p.add_argument("--out-dir", default="performance_evaluation/results/npu_profile")
-    p.add_argument("--interval", type=float, default=0.1)
-    p.add_argument("--duration", type=float, default=20.0)
+    p.add_argument("--interval", type=float, default=0.05, help="NPU sampling interval (s)")
+    p.add_argument("--duration", type=float, default=None,
+                   help="Maximum tracer duration (default: until the workload finishes)")
+    p.add_argument("--concurrency", type=int, default=1, help="Concurrent closed-loop clients")
+    p.add_argument("--rate", type=float, help="Open-loop Poisson arrival rate (requests/s)")
+    p.add_argument("--repeat", type=int, default=1, help="Times to submit each prompt")
+    p.add_argument("--shuffle", action="store_true", help="Shuffle the submission order")
+    p.add_argument("--max-tokens", type=int, default=64)
+    p.add_argument("--timeout", type=float, default=600.0)
+    p.add_argument("--bucket", type=float, default=1.0, help="Timeline bucket width (s)")
+    p.add_argument("--seed", type=int, default=0)
     args = p.parse_args()
 
     with open(args.prompts_file, "r", encoding="utf-8") as fh:
         prompts = [ln.strip() for ln in fh if ln.strip()]
+    workload = prompts * args.repeat
+    if args.shuffle:
+        random.Random(args.seed).shuffle(workload)
 
     timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
     outdir = ensure_dir(os.path.join(args.out_dir, timestamp))
@@ -109,30 +266,67 @@ def main():
     gens_jsonl = os.path.join(outdir, "generations.jsonl")
 
     tracer = NPUTracer(trace_csv, interval=args.interval, duration=args.duration)
+    if tracer.source is None:
+        print("axcl-smi not found: NPU utilization will not be recorded")
     tracer.start()
 
     # Give tracer a moment to warm up
     time.sleep(0.5)
+    run_start = time.perf_counter()
 
-    results = run_generations(prompts, args.backend_url, gens_jsonl, timeout=120)
+    results = run_generations(workload, args.backend_url, gens_jsonl, timeout=args.timeout,
+                              concurrency=args.concurrency, rate=args.rate, max_tokens=args.max_tokens,
+                              seed=args.seed)
+    run_end = time.perf_counter()
 
     # Ensure we sampled a little after generation
     time.sleep(0.5)
     tracer.stop()
     tracer.join()
+    chrome_trace = save_chrome_trace(args.backend_url, time.perf_counter() - run_start + 1.0,
+                                     os.path.join(outdir, "trace.json"))
+
+    timeline = build_timeline(results, tracer.samples, run_start, run_end, args.bucket)
+    timeline_csv = os.path.join(outdir, "timeline.csv")
+    with open(timeline_csv, "w", newline="", encoding="utf-8") as fh:
+        writer = csv.DictWriter(fh, fieldnames=list(timeline[0]) if timeline else ["t_s"])
+        writer.writeheader()
+        writer.writerows(timeline)
 
+    ok = [r for r in results if r.get("status_code") == 200 and not r.get("error")]
+    wall = run_end - run_start
+    tokens = sum(len(r["token_times_s"]) for r in ok)
+    busy = [pct for t, pct in tracer.samples if run_start <= t <= run_end]
     summary = {
         "timestamp": timestamp,
         "backend_url": args.backend_url,
         "num_prompts": len(prompts),
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "mode": f"rate={args.rate}" if args.rate else f"concurrency={args.concurrency}",
+        "max_tokens": args.max_tokens,
+        "wall_s": wall,
+        "throughput_rps": len(ok) / wall if wall else 0.0,
+        "throughput_tok_s": tokens / wall if wall else 0.0,
+        "ttft_s": percentiles([r["ttft_s"] for r in ok if r["ttft_s"] is not None]),
+        "latency_s": percentiles([r["elapsed_s"] for r in ok]),
+        "npu_pct_mean": float(np.mean(busy)) if busy else None,
+        "npu_samples": len(tracer.samples),
+        "sample_interval_s": args.interval,
+        "correlation": correlations(timeline),
         "results_file": gens_jsonl,
         "trace_file": trace_csv,
+        "timeline_file": timeline_csv,
+        "chrome_trace_file": chrome_trace,
         "prompts_file": args.prompts_file
     }
 
     with open(os.path.join(outdir, "summary.json"), "w", encoding="utf-8") as fh:
         json.dump(summary, fh, indent=2)
 
+    npu = f"{summary['npu_pct_mean']:.1f}%" if summary["npu_pct_mean"] is not None else "n/a"
+    print(f"{summary['requests']} requests ({summary['errors']} errors) in {wall:.1f}s: "
+          f"{summary['throughput_tok_s']:.2f} tok/s, mean NPU {npu}, correlation {summary['correlation']}")
     print(f"Wrote profile results to {outdir}")
 
 
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Replay a captured request stream with its original (or scaled) timing.
+
+Reads a capture written by backend.py (AX650_CAPTURE_FILE) or
+ollama_proxy.sh (OLLAMA_CAPTURE_FILE), rotated files included, and reissues
+every request at its original offset from the first arrival divided by
+--speed (2 = twice as fast; 0 = back to back, one at a time). Requests keep
+their sampling parameters and chat depth. Captures stored with prompts=text
+replay the original messages; hashed or length-only captures get filler text
+of the recorded length per message. Filler follows each message's own hash,
+so repeated prompts repeat (for the response cache and coalescing) and the
+turns of one conversation keep their shared prefix (for the runtime's
+resident context).
+
+Targets:
+  proxy    POST /generate (streamed)
+  ollama   POST /api/generate or /api/chat, as captured (streamed)
+  runtime  /api/reset + /api/generate + /api/generate_provider polling on a
+           runtime or mock_main_api.py (one generation at a time)
+
+Creates results/replay/<timestamp>/ with `requests.jsonl` and `summary.json`
+(latency and TTFT percentiles next to the captured ones, errors, achieved
+vs. scheduled timing).
+
+Usage:
+  python3 performance_evaluation/replay_capture.py /var/log/ax650/capture.jsonl
+  python3 performance_evaluation/replay_capture.py capture.jsonl --speed 4 --target ollama
+  python3 performance_evaluation/replay_capture.py capture.jsonl --speed 0 --target runtime --url http://localhost:8000
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ollama_ax650_integration_mvp"))
+from request_capture import read_capture  # noqa: E402
+from load_test import DEFAULT_URLS, _stream_ndjson  # noqa: E402
+
+FILLER_WORDS = ("the quick brown fox jumps over a lazy dog while an edge device runs a small "
+                "language model layer by layer on its neural processing unit").split()
+
+
+def filler(chars, salt):
+    """Deterministic English-like text of about `chars` characters."""
+    words, n, i = [], 0, salt
+    while n < chars:
+        word = FILLER_WORDS[i % len(FILLER_WORDS)]
+        words.append(word)
+        n += len(word) + 1
+        i += 7
+    return " ".join(words)[:max(chars, 1)]
+
+
+def rebuild_messages(record):
+    if record.get("messages"):
+        return record["messages"]
+    roles = record.get("roles") or ["user"] * record.get("n_messages", 1)
+    lengths = record.get("message_chars") or [record.get("prompt_chars", 0)]
+    hashes = record.get("message_sha256")
+    if not hashes:
+        # Captures from before per-message hashes: repeats only
+        salt = int(record.get("prompt_sha256", "0")[:8] or "0", 16)
+        hashes = [f"{salt + i:x}" for i in range(len(lengths))]
+    return [{"role": role, "content": filler(chars, int(h[:8], 16))}
+            for role, chars, h in zip(roles, lengths, hashes)]
+
+
+def render(messages):
+    """Same flattening as the proxies use for chat histories."""
+    if len(messages) == 1 and messages[0]["role"] == "user":
+        return messages[0]["content"]
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+
+def send_proxy(url, record, messages, params, args, on_chunk):
+    payload = dict(params, prompt=render(messages), stream=True, request_id=str(uuid.uuid4()))
+    if record.get("chat"):
+        payload["messages"] = messages
+    if record.get("model"):
+        payload["model"] = record["model"]
+    if record.get("keep_alive") is not None:
+        payload["keep_alive"] = record["keep_alive"]
+    with requests.post(f"{url}/generate", json=payload, stream=True, timeout=args.timeout) as r:
+        r.raise_for_status()
+        return (_stream_ndjson(r, on_chunk).get("metrics") or {}).get("eval_count")
+
+
+def send_ollama(url, record, messages, params, args, on_chunk):
+    options = {"num_predict": params["max_tokens"], "temperature": params["temperature"],
+               "top_p": params["top_p"], "top_k": params["top_k"], "seed": params.get("seed")}
+    payload = {"model": record.get("model") or "qwen3-ax650:latest", "stream": True, "options": options}
+    if record.get("chat"):
+        endpoint, payload["messages"] = "/api/chat", messages
+    else:
+        endpoint, payload["prompt"] = "/api/generate", render(messages)
+    with requests.post(f"{url}{endpoint}", json=payload, stream=True, timeout=args.timeout) as r:
+        r.raise_for_status()
+        return _stream_ndjson(r, on_chunk).get("eval_count")
+
+
+def send_runtime(url, record, messages, params, args, on_chunk):
+    system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+    turns = messages[1:] if system else messages
+    requests.post(f"{url}/api/reset", json={"system_prompt": system}, timeout=30).raise_for_status()
+    # The runtime's parameter names, as backend.py sends them
+    payload = {"prompt": render(turns), "max_tokens": params["max_tokens"], "temperature": params["temperature"],
+               "top-p": params["top_p"], "top-k": params["top_k"]}
+    if params.get("seed") is not None:
+        payload["seed"] = params["seed"]
+    r = requests.post(f"{url}/api/generate", timeout=30, json=payload)
+    if r.status_code != 200:
+        raise RuntimeError(r.json().get("error", f"HTTP {r.status_code}"))
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        result = requests.get(f"{url}/api/generate_provider", timeout=10).json()
+        if result.get("response"):
+            on_chunk(result["response"])
+        if result.get("done"):
+            return (result.get("metrics") or {}).get("eval_count")
+        time.sleep(0.05)
+    requests.get(f"{url}/api/stop", timeout=5)
+    raise TimeoutError("generation did not finish")
+
+
+TARGETS = {"proxy": send_proxy, "ollama": send_ollama, "runtime": send_runtime}
+
+
+def replay_one(record, scheduled, run_start, args):
+    messages = rebuild_messages(record)
+    captured = record.get("params") or {}
+    params = {"max_tokens": captured.get("max_tokens", 128), "temperature": captured.get("temperature", 0.8),
+              "top_p": captured.get("top_p", 0.9), "top_k": captured.get("top_k", 40), "seed": captured.get("seed")}
+    first = []
+    t0 = time.perf_counter()
+    out = {"request_id": record.get("request_id"), "scheduled_s": scheduled, "sent_s": t0 - run_start,
+           "captured_outcome": record.get("outcome"), "captured_duration_s": record.get("duration_s"),
+           "captured_ttft_s": record.get("ttft_s"), "n_messages": len(messages)}
+    try:
+        tokens = TARGETS[args.target](args.url, record, messages, params, args,
+                                      lambda text: first or first.append(time.perf_counter()))
+        out.update(ok=True, eval_tokens=tokens)
+    except Exception as e:
+        out.update(ok=False, error=str(e))
+    out["duration_s"] = time.perf_counter() - t0
+    out["ttft_s"] = first[0] - t0 if first else None
+    return out
+
+
+def percentiles(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("capture", help="Capture file (rotated .1, .2, ... files are read too)")
+    p.add_argument("--target", choices=sorted(TARGETS), default="proxy")
+    p.add_argument("--url", help="Base URL (default depends on --target)")
+    p.add_argument("--speed", type=float, default=1.0,
+                   help="Timing scale: 2 replays twice as fast; 0 sends one request at a time")
+    p.add_argument("--include", default="ok,cached,coalesced,error,cancelled",
+                   help="Captured outcomes to replay")
+    p.add_argument("--limit", type=int, help="Replay only the first N requests")
+    p.add_argument("--timeout", type=float, default=600.0)
+    p.add_argument("--out-dir", default="performance_evaluation/results/replay")
+    args = p.parse_args()
+    args.url = (args.url or DEFAULT_URLS[args.target]).rstrip("/")
+
+    include = set(args.include.split(","))
+    records = [r for r in read_capture(args.capture) if r.get("outcome", "ok") in include]
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit(f"No requests to replay in {args.capture}")
+    origin = records[0]["arrival"]
+    span = records[-1]["arrival"] - origin
+    print(f"Replaying {len(records)} requests captured over {span:.1f}s at speed {args.speed:g} "
+          f"against {args.target} {args.url}")
+
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    outdir = os.path.join(args.out_dir, timestamp)
+    os.makedirs(outdir, exist_ok=True)
+    results, lock, threads = [], threading.Lock(), []
+    run_start = time.perf_counter()
+    with open(os.path.join(outdir, "requests.jsonl"), "w", encoding="utf-8") as fh:
+        def run(record, scheduled):
+            out = replay_one(record, scheduled, run_start, args)
+            with lock:
+                fh.write(json.dumps(out) + "\n")
+                fh.flush()
+                results.append(out)
+
+        for record in records:
+            if args.speed <= 0:
+                run(record, time.perf_counter() - run_start)
+                continue
+            scheduled = (record["arrival"] - origin) / args.speed
+            time.sleep(max(0.0, run_start + scheduled - time.perf_counter()))
+            t = threading.Thread(target=run, args=(record, scheduled), daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+    wall = time.perf_counter() - run_start
+
+    ok = [r for r in results if r["ok"]]
+    lateness = [r["sent_s"] - r["scheduled_s"] for r in results]
+    summary = {"timestamp": timestamp, "capture": args.capture, "target": args.target, "url": args.url,
+               "speed": args.speed, "requests": len(results), "errors": len(results) - len(ok),
+               "error_rate": (len(results) - len(ok)) / len(results),
+               "captured_span_s": span, "wall_s": wall,
+               "throughput_rps": len(ok) / wall if wall else 0.0,
+               "latency_s": percentiles([r["duration_s"] for r in ok]),
+               "ttft_s": percentiles([r["ttft_s"] for r in ok]),
+               "captured_latency_s": percentiles([r["captured_duration_s"] for r in results]),
+               "captured_ttft_s": percentiles([r["captured_ttft_s"] for r in results]),
+               "send_lateness_max_s": max(lateness) if lateness else 0.0}
+    with open(os.path.join(outdir, "summary.json"), "w", encoding="utf-8") as fh:
+        json.dump(summary, fh, indent=2)
+
+    fmt = lambda d: "-" if not d else f"{d['p50']:.3f}/{d['p95']:.3f}/{d['p99']:.3f}s"
+    print(f"{len(results)} requests, {summary['errors']} errors in {wall:.1f}s")
+    print(f"latency p50/p95/p99 {fmt(summary['latency_s'])} (captured {fmt(summary['captured_latency_s'])})")
+    print(f"TTFT    p50/p95/p99 {fmt(summary['ttft_s'])} (captured {fmt(summary['captured_ttft_s'])})")
+    print(f"Wrote replay results to {outdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,71 @@
 #!/usr/bin/env python3
 """Compare tokenizer performance and token IDs between HF and model-local tokenizers.
 
+Two modes:
+
+compare (default): one encode/decode per prompt and repetition, written to
+`performance_evaluation/results/tokenizer_compare_<tokenizer>_<timestamp>.csv`
+(one row per repetition). With --model-path, every row also says whether the
+token ids match the model's own tokenizer.
+
+--bench: throughput and latency of the tokenizer work around a generation,
+written to `performance_evaluation/results/tokenizer_bench/<timestamp>/`
+(`results.csv`, `summary.json`). Parts (--parts, default all):
+  batch    batch encode at each --batch-sizes, fast vs slow tokenizer
+  threads  single-text encodes from a pool of each --threads size
+  long     one document of each --long-tokens length (scaling per token)
+  chat     apply_chat_template for histories of each --turns depth,
+           rendering only and rendering + encoding
+  stream   per-token detokenization of a --stream-tokens sequence, by
+           re-decoding the whole prefix ("full") and by decoding only a
+           window since the last emitted text ("incremental")
+Every case reports tokens/sec and p50/p95/p99 latency. Token ids are checked
+against the model's own (fast) tokenizer from --model-path, and streamed
+text against a one-shot decode; mismatches are flagged and exit with 1.
+
+A model tokenizer that fails to load is an error; --fallback gpt2 switches
+to gpt2 instead (with a warning), which never matches Qwen3 token ids.
+
 Usage examples:
   python3 performance_evaluation/tokenizer_compare.py --prompt "Hello world" --tokenizer hf
   python3 performance_evaluation/tokenizer_compare.py --prompts-file prompts.txt --model-path ./models/qwen3 --tokenizer model
-
-Outputs a CSV into `performance_evaluation/results/` with timings and token lists.
+  python3 performance_evaluation/tokenizer_compare.py --bench --prompts-file performance_evaluation/prompts.txt --model-path ./models/qwen3 --tokenizer model
+  python3 performance_evaluation/tokenizer_compare.py --bench --parts stream,long --prompts-file performance_evaluation/prompts.txt --model-path ./models/qwen3 --tokenizer model
 """
 import argparse
 import time
 import csv
+import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+
+import numpy as np
+import transformers
 from transformers import AutoTokenizer
 
+PARTS = ("batch", "threads", "long", "chat", "stream")
+RESULT_FIELDS = ["part", "variant", "case", "calls", "tokens", "tokens_per_s", "p50_ms", "p95_ms", "p99_ms",
+                 "us_per_token", "errors", "mismatches"]
 
-def load_tokenizer(mode, model_path=None):
+
+def load_tokenizer(mode, model_path=None, use_fast=True, fallback=None):
     if mode == "hf":
         # Default small tokenizer to ensure availability if no model path given
-        return AutoTokenizer.from_pretrained("gpt2")
+        return AutoTokenizer.from_pretrained("gpt2", use_fast=use_fast)
     elif mode == "model":
         if not model_path:
             raise ValueError("--model-path is required when --tokenizer model is selected")
         # Try to load tokenizer from model path (may require trust_remote_code)
         try:
-            return AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-        except Exception:
-            # Fallback to HF gpt2 if model-local tokenizer fails
-            return AutoTokenizer.from_pretrained("gpt2")
+            return AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, use_fast=use_fast)
+        except Exception as e:
+            if not fallback:
+                raise RuntimeError(f"Could not load the tokenizer from {model_path}: {e}") from e
+            print(f"WARNING: could not load the tokenizer from {model_path} ({e}); using {fallback}. "
+                  f"Token ids will not match the model.", file=sys.stderr)
+            return AutoTokenizer.from_pretrained(fallback, use_fast=use_fast)
     else:
         raise ValueError("Unsupported tokenizer mode: %s" % mode)
 
@@ -56,22 +94,309 @@ def run_once(tokenizer, text):
     return token_ids, t_encode, t_decode, decoded
 
 
+def encode(tokenizer, texts):
+    """Token ids of each text, without special tokens (one call for the whole list)."""
+    return tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+
+def decode(tokenizer, ids):
+    return tokenizer.decode(ids, skip_special_tokens=False, clean_up_tokenization_spaces=False)
+
+
+def result(part, variant, case, latencies, tokens, wall=None, errors=0, mismatches=0):
+    """One results row; `wall` defaults to the summed latencies (sequential cases)."""
+    wall = sum(latencies) if wall is None else wall
+    lat = np.array(latencies) * 1000 if latencies else np.array([np.nan])
+    return {"part": part, "variant": variant, "case": case, "calls": len(latencies), "tokens": tokens,
+            "tokens_per_s": round(tokens / wall, 1) if wall else None,
+            "p50_ms": round(float(np.percentile(lat, 50)), 4), "p95_ms": round(float(np.percentile(lat, 95)), 4),
+            "p99_ms": round(float(np.percentile(lat, 99)), 4),
+            "us_per_token": round(1e6 * wall / tokens, 3) if tokens else None,
+            "errors": errors, "mismatches": mismatches}
+
+
+class Bench:
+    """Runs the --bench parts over a set of tokenizer variants."""
+
+    def __init__(self, variants, reference, prompts, repeat):
+        self.variants = variants
+        self.reference = reference
+        self.prompts = prompts
+        self.repeat = max(1, repeat)
+        self.mismatches = []
+        base = reference or next(iter(variants.values()))
+        self.prompt_ids = encode(base, prompts)
+
+    def check(self, part, variant, case, got, expected, text):
+        """Record a token-id mismatch against the reference tokenizer; returns 1 if there was one."""
+        if self.reference is None or got == expected:
+            return 0
+        first = next((i for i, (a, b) in enumerate(zip(got, expected)) if a != b), min(len(got), len(expected)))
+        self.mismatches.append({"part": part, "variant": variant, "case": case, "text": text[:120],
+                                "tokens": len(got), "reference_tokens": len(expected), "first_difference": first})
+        return 1
+
+    def batch(self, batch_sizes):
+        rows = []
+        n = len(self.prompts)
+        for variant, tok in self.variants.items():
+            for size in batch_sizes:
+                latencies, tokens, bad = [], 0, set()
+                for r in range(self.repeat):
+                    idx = [(r * size + j) % n for j in range(size)]
+                    texts = [self.prompts[i] for i in idx]
+                    t0 = time.perf_counter()
+                    ids = encode(tok, texts)
+                    latencies.append(time.perf_counter() - t0)
+                    tokens += sum(len(x) for x in ids)
+                    for i, got in zip(idx, ids):
+                        if i not in bad and self.check("batch", variant, f"batch={size}", got,
+                                                       self.prompt_ids[i], self.prompts[i]):
+                            bad.add(i)
+                rows.append(result("batch", variant, f"batch={size}", latencies, tokens, mismatches=len(bad)))
+        return rows
+
+    def threads(self, pool_sizes, calls):
+        rows = []
+        n = len(self.prompts)
+        for variant, tok in self.variants.items():
+            for workers in pool_sizes:
+                def one(i):
+                    t0 = time.perf_counter()
+                    try:
+                        ids = encode(tok, [self.prompts[i % n]])[0]
+                    except Exception:
+                        # Fast tokenizers can refuse concurrent use ("Already borrowed")
+                        return i, None, time.perf_counter() - t0
+                    return i, ids, time.perf_counter() - t0
+
+                t0 = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    done = list(pool.map(one, range(calls)))
+                wall = time.perf_counter() - t0
+                ok = [(i, ids, dt) for i, ids, dt in done if ids is not None]
+                bad = set()
+                for i, ids, _ in ok:
+                    if i % n not in bad and self.check("threads", variant, f"threads={workers}", ids,
+                                                       self.prompt_ids[i % n], self.prompts[i % n]):
+                        bad.add(i % n)
+                rows.append(result("threads", variant, f"threads={workers}", [dt for _, _, dt in ok],
+                                   sum(len(ids) for _, ids, _ in ok), wall=wall,
+                                   errors=len(done) - len(ok), mismatches=len(bad)))
+        return rows
+
+    def document(self, tokens):
+        """Text of about `tokens` tokens built by repeating the prompts, and its reference ids."""
+        base = self.reference or next(iter(self.variants.values()))
+        text = "\n".join(self.prompts)
+        per_copy = max(1, len(encode(base, [text + "\n"])[0]))
+        text = "\n".join([text] * (tokens // per_copy + 1))
+        text = decode(base, encode(base, [text])[0][:tokens])
+        return text, encode(base, [text])[0]
+
+    def long(self, lengths):
+        rows = []
+        for length in lengths:
+            text, expected = self.document(length)
+            for variant, tok in self.variants.items():
+                latencies, ids = [], []
+                for _ in range(self.repeat):
+                    t0 = time.perf_counter()
+                    ids = encode(tok, [text])[0]
+                    latencies.append(time.perf_counter() - t0)
+                bad = self.check("long", variant, f"tokens={length}", ids, expected, text)
+                rows.append(result("long", variant, f"tokens={length}", latencies, len(ids) * self.repeat,
+                                   mismatches=bad))
+        return rows
+
+    def conversation(self, turns):
+        messages = [{"role": "system", "content": "You are a helpful assistant."}]
+        for t in range(turns):
+            messages.append({"role": "user", "content": self.prompts[t % len(self.prompts)]})
+            if t < turns - 1:
+                messages.append({"role": "assistant", "content": self.prompts[(t + 1) % len(self.prompts)]})
+        return messages
+
+    def chat(self, depths):
+        rows = []
+        for variant, tok in self.variants.items():
+            if not getattr(tok, "chat_template", None):
+                print(f"  chat: {variant} tokenizer has no chat template; skipped")
+                continue
+            for turns in depths:
+                messages = self.conversation(turns)
+                render, full, ids = [], [], []
+                for _ in range(self.repeat):
+                    t0 = time.perf_counter()
+                    text = tok.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                    render.append(time.perf_counter() - t0)
+                    t0 = time.perf_counter()
+                    out = tok.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)
+                    full.append(time.perf_counter() - t0)
+                    ids = list(out["input_ids"] if hasattr(out, "keys") else out)
+                bad = 0
+                if self.reference is not None and getattr(self.reference, "chat_template", None):
+                    expected = self.reference.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)
+                    expected = list(expected["input_ids"] if hasattr(expected, "keys") else expected)
+                    bad = self.check("chat", variant, f"turns={turns}", ids, expected, text)
+                rows.append(result("chat", variant, f"turns={turns} render", render, len(ids) * self.repeat))
+                rows.append(result("chat", variant, f"turns={turns} render+encode", full, len(ids) * self.repeat,
+                                   mismatches=bad))
+        return rows
+
+    @staticmethod
+    def stream_full(tok, ids):
+        """Re-decode the whole prefix for every token; emit what is new."""
+        pieces, latencies, emitted = [], [], ""
+        for i in range(len(ids)):
+            t0 = time.perf_counter()
+            text = decode(tok, ids[:i + 1])
+            if len(text) > len(emitted) and not text.endswith("�"):
+                pieces.append(text[len(emitted):])
+                emitted = text
+            latencies.append(time.perf_counter() - t0)
+        return pieces, latencies
+
+    @staticmethod
+    def stream_incremental(tok, ids):
+        """Decode only the tokens since the last emitted text (plus one window for context)."""
+        pieces, latencies = [], []
+        prefix_offset = read_offset = 0
+        for i in range(len(ids)):
+            t0 = time.perf_counter()
+            prefix = decode(tok, ids[prefix_offset:read_offset])
+            text = decode(tok, ids[prefix_offset:i + 1])
+            # Hold back partial UTF-8 sequences until the next token completes them
+            if len(text) > len(prefix) and not text.endswith("�"):
+                pieces.append(text[len(prefix):])
+                prefix_offset, read_offset = read_offset, i + 1
+            latencies.append(time.perf_counter() - t0)
+        if read_offset < len(ids):
+            pieces.append(decode(tok, ids[prefix_offset:])[len(decode(tok, ids[prefix_offset:read_offset])):])
+        return pieces, latencies
+
+    def stream(self, length):
+        rows = []
+        for variant, tok in self.variants.items():
+            _, ids = self.document(length)
+            ids = encode(tok, [decode(tok, ids)])[0][:length] if self.reference is None else ids
+            expected = decode(tok, ids)
+            for name, fn in (("full", self.stream_full), ("incremental", self.stream_incremental)):
+                pieces, latencies = fn(tok, ids)
+                text = "".join(pieces)
+                bad = 0
+                if text != expected:
+                    first = next((i for i, (a, b) in enumerate(zip(text, expected)) if a != b),
+                                 min(len(text), len(expected)))
+                    self.mismatches.append({"part": "stream", "variant": variant, "case": name,
+                                            "text": expected[max(0, first - 40):first + 40], "chars": len(text),
+                                            "reference_chars": len(expected), "first_difference": first})
+                    bad = 1
+                rows.append(result("stream", variant, f"{name} tokens={len(ids)}", latencies, len(ids),
+                                   mismatches=bad))
+        return rows
+
+
+def parse_ints(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def run_bench(args, prompts):
+    tokenizer_name = args.model_path if args.tokenizer == "model" else "gpt2"
+    variants = {"fast": load_tokenizer(args.tokenizer, args.model_path, use_fast=True, fallback=args.fallback)}
+    try:
+        slow = load_tokenizer(args.tokenizer, args.model_path, use_fast=False, fallback=args.fallback)
+        if getattr(slow, "is_fast", False):
+            print(f"No slow tokenizer for {tokenizer_name} (loaded a fast one again); slow variant skipped")
+        else:
+            variants["slow"] = slow
+    except Exception as e:
+        print(f"No slow tokenizer for {tokenizer_name} ({e}); slow variant skipped")
+
+    reference = None
+    if args.model_path:
+        reference = variants["fast"] if args.tokenizer == "model" else load_tokenizer("model", args.model_path)
+    else:
+        print("No --model-path: token ids are not checked against the model tokenizer")
+
+    bench = Bench(variants, reference, prompts, args.repeat)
+    parts = [p for p in args.parts.split(",") if p]
+    unknown = set(parts) - set(PARTS)
+    if unknown:
+        raise SystemExit(f"Unknown --parts {sorted(unknown)}; choose from {', '.join(PARTS)}")
+
+    rows = []
+    for part in parts:
+        print(f"Running {part} ...")
+        if part == "batch":
+            rows += bench.batch(parse_ints(args.batch_sizes))
+        elif part == "threads":
+            rows += bench.threads(parse_ints(args.threads), args.calls)
+        elif part == "long":
+            rows += bench.long(parse_ints(args.long_tokens))
+        elif part == "chat":
+            rows += bench.chat(parse_ints(args.turns))
+        elif part == "stream":
+            rows += bench.stream(args.stream_tokens)
+
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    out_dir = ensure_out_dir(os.path.join(args.out_dir, "tokenizer_bench", timestamp))
+    with open(os.path.join(out_dir, "results.csv"), "w", newline="", encoding="utf-8") as fh:
+        writer = csv.DictWriter(fh, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    summary = {"timestamp": timestamp, "tokenizer": tokenizer_name, "variants": sorted(variants),
+               "reference": args.model_path if reference is not None else None,
+               "transformers": transformers.__version__, "prompts": len(prompts), "repeat": bench.repeat,
+               "results": rows, "mismatches": bench.mismatches}
+    with open(os.path.join(out_dir, "summary.json"), "w", encoding="utf-8") as fh:
+        json.dump(summary, fh, indent=2)
+
+    print(f"\n{'part':<8} {'variant':<8} {'case':<28} {'tok/s':>12} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  flags")
+    for r in rows:
+        flags = []
+        if r["errors"]:
+            flags.append(f"{r['errors']} errors")
+        if r["mismatches"]:
+            flags.append(f"MISMATCH x{r['mismatches']}")
+        tps = f"{r['tokens_per_s']:,.0f}" if r["tokens_per_s"] is not None else "-"
+        print(f"{r['part']:<8} {r['variant']:<8} {r['case']:<28} {tps:>12} {r['p50_ms']:>9.3f} "
+              f"{r['p95_ms']:>9.3f} {r['p99_ms']:>9.3f}  {' '.join(flags)}")
+    print(f"Wrote benchmark results to {out_dir}")
+    if bench.mismatches:
+        print(f"\n{len(bench.mismatches)} mismatches against the reference (details in summary.json):")
+        for m in bench.mismatches[:10]:
+            print(f"  {m['part']}/{m['variant']}/{m['case']}: first difference at {m['first_difference']}")
+        return 1
+    return 0
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument("--tokenizer", choices=["hf", "model"], default="hf",
                    help="Which tokenizer to use: 'hf' (HF hub gpt2) or 'model' (load from --model-path)")
     p.add_argument("--model-path", help="Path or repo id to load model-local tokenizer")
+    p.add_argument("--fallback", help="Tokenizer to use if the model tokenizer fails to load (e.g. gpt2); "
+                                      "default is to fail")
     p.add_argument("--prompt", help="Single prompt to test")
     p.add_argument("--prompts-file", help="File with one prompt per line")
-    p.add_argument("--repeat", type=int, default=1, help="Repeat tokenization N times and record the first run time")
+    p.add_argument("--repeat", type=int, default=1,
+                   help="Repetitions per prompt (compare) or per case (--bench, default 20 there)")
     p.add_argument("--out-dir", default="performance_evaluation/results", help="Output directory for CSV results")
+    bench = p.add_argument_group("benchmark mode")
+    bench.add_argument("--bench", action="store_true", help="Run the throughput/latency benchmark instead")
+    bench.add_argument("--parts", default=",".join(PARTS), help="Comma-separated parts to run")
+    bench.add_argument("--batch-sizes", default="1,8,32")
+    bench.add_argument("--threads", default="1,2,4,8", help="Thread pool sizes for concurrent encodes")
+    bench.add_argument("--calls", type=int, default=512, help="Encodes per thread pool size")
+    bench.add_argument("--long-tokens", default="1024,4096,16384", help="Document lengths in tokens")
+    bench.add_argument("--turns", default="1,4,16", help="Conversation depths for the chat template")
+    bench.add_argument("--stream-tokens", type=int, default=1024, help="Tokens to detokenize one at a time")
     args = p.parse_args()
 
     if not args.prompt and not args.prompts_file:
         p.error("Either --prompt or --prompts-file must be provided")
 
-    tokenizer = load_tokenizer(args.tokenizer, args.model_path)
-
     prompts = []
     if args.prompt:
         prompts.append(args.prompt)
@@ -82,33 +407,49 @@ def main():
                 if ln:
                     prompts.append(ln)
 
+    if args.bench:
+        # Long documents exceed model_max_length on purpose
+        transformers.logging.set_verbosity_error()
+        if args.repeat == 1 and "--repeat" not in sys.argv:
+            args.repeat = 20
+        sys.exit(run_bench(args, prompts))
+
+    tokenizer = load_tokenizer(args.tokenizer, args.model_path, fallback=args.fallback)
+    reference = None
+    if args.model_path:
+        reference = tokenizer if args.tokenizer == "model" else load_tokenizer("model", args.model_path)
+
     out_dir = ensure_out_dir(args.out_dir)
     fname = os.path.join(out_dir, f"tokenizer_compare_{args.tokenizer}_{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.csv")
 
+    mismatches = 0
     with open(fname, "w", newline='', encoding='utf-8') as csvf:
-        writer = csv.DictWriter(csvf, fieldnames=["prompt", "tokenizer", "encode_time_s", "num_tokens", "tokens", "decode_time_s", "decoded_preview"])
+        writer = csv.DictWriter(csvf, fieldnames=["prompt", "tokenizer", "repetition", "encode_time_s", "num_tokens",
+                                                  "tokens", "decode_time_s", "decoded_preview", "matches_model"])
         writer.writeheader()
 
         for prompt in prompts:
-            # Optionally repeat to warm caches; only record the last measurement
-            token_ids = None
-            t_enc = None
-            t_dec = None
-            decoded = None
+            expected = reference.encode(prompt) if reference is not None else None
+            # Record every repetition; the first one includes cold caches
             for i in range(max(1, args.repeat)):
                 token_ids, t_enc, t_dec, decoded = run_once(tokenizer, prompt)
-
-            writer.writerow({
-                "prompt": prompt,
-                "tokenizer": args.tokenizer,
-                "encode_time_s": f"{t_enc:.6f}",
-                "num_tokens": len(token_ids),
-                "tokens": " ".join(str(x) for x in token_ids[:200]),
-                "decode_time_s": f"{t_dec:.6f}",
-                "decoded_preview": decoded[:200]
-            })
+                matches = "" if expected is None else list(token_ids) == list(expected)
+                mismatches += matches is False
+                writer.writerow({
+                    "prompt": prompt,
+                    "tokenizer": args.tokenizer,
+                    "repetition": i,
+                    "encode_time_s": f"{t_enc:.6f}",
+                    "num_tokens": len(token_ids),
+                    "tokens": " ".join(str(x) for x in token_ids[:200]),
+                    "decode_time_s": f"{t_dec:.6f}",
+                    "decoded_preview": decoded[:200],
+                    "matches_model": matches,
+                })
 
     print(f"Wrote results to {fname}")
+    if mismatches:
+        print(f"WARNING: {mismatches} encodings differ from the model tokenizer at {args.model_path}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""Latency benchmark for the runtime's tokenizer service.
+
+Plays the calls main_api_ax650 makes against --url_tokenizer_model: per
+conversation /get_uid, /bos_id, /eos_id and /reset, then per turn one
+/encode (with the previous reply as last_reply) and one /decode per reply
+token, the way the runtime streams. Runs each --clients level with that
+many concurrent conversations, over keep-alive connections or, with
+--no-keepalive, a new connection per call.
+
+Works against ollama_ax650_integration_mvp/tokenizer_service.py and the
+manufacturer's qwen3_tokenizer_uid.py alike. With --compare, the same
+conversations go to a second service and any difference in token ids,
+diffs or decoded text is flagged (exit status 1).
+
+Creates results/tokenizer_service/<timestamp>/ with `calls.csv` (one row
+per call) and `summary.json` (p50/p95/p99 per endpoint, calls/s, and the
+tokenizer time per turn the runtime waits for).
+
+Usage:
+  python3 performance_evaluation/tokenizer_service_bench.py --url http://127.0.0.1:12345
+  python3 performance_evaluation/tokenizer_service_bench.py --model-path ./models/qwen3 --clients 1,4,16
+  python3 performance_evaluation/tokenizer_service_bench.py --model-path ./models/qwen3 --compare http://127.0.0.1:12345
+"""
+import argparse
+import csv
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode, urlparse
+
+import numpy as np
+
+SERVICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ollama_ax650_integration_mvp",
+                       "tokenizer_service.py")
+SYSTEM_PROMPT = "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."
+
+
+def start_service(model_path, timeout=120):
+    """Run tokenizer_service.py on a free port; returns (process, url)."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    proc = subprocess.Popen([sys.executable, SERVICE, "--model-path", model_path, "--host", "127.0.0.1",
+                             "--port", str(port)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    deadline = time.time() + timeout
+    for line in proc.stdout:
+        if "Server running at" in line:
+            # Keep draining so the service never blocks on a full pipe
+            threading.Thread(target=lambda: proc.stdout.read(), daemon=True).start()
+            return proc, f"http://127.0.0.1:{port}"
+        if time.time() > deadline:
+            break
+    proc.kill()
+    raise SystemExit(f"tokenizer service did not start (exit code {proc.poll()})")
+
+
+class Client:
+    """One conversation's worth of runtime calls, timing each.
+
+    Uses http.client directly: requests adds about a millisecond per call,
+    which is more than the service itself takes.
+    """
+
+    def __init__(self, url, keepalive, timeout):
+        parsed = urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.conn = None
+        self.calls = []
+
+    def call(self, method, endpoint, params=None, json_body=None):
+        path = endpoint + (f"?{urlencode(params)}" if params else "")
+        body = json.dumps(json_body) if json_body is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        if not self.keepalive:
+            headers["Connection"] = "close"
+        t0 = time.perf_counter()
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            self.conn = None
+            raise
+        if not self.keepalive or response.will_close:
+            self.conn.close()
+            self.conn = None
+        self.calls.append((endpoint, time.perf_counter() - t0))
+        result = json.loads(data)
+        if "error" in result:
+            raise RuntimeError(f"{endpoint}: {result['error']}")
+        return result
+
+
+def conversation(client, prompts, turns, reply_tokens, offset):
+    """Returns the responses (for --compare) and the tokenizer seconds of each turn."""
+    responses, per_turn = [], []
+    uid = client.call("GET", "/get_uid")["uid"]
+    client.call("GET", "/bos_id", params={"uid": uid})
+    client.call("GET", "/eos_id", params={"uid": uid})
+    reset = client.call("POST", "/reset", json_body={"uid": uid, "system_prompt": SYSTEM_PROMPT})
+    responses.append(reset["token_ids"])
+    last_reply = None
+    for t in range(turns):
+        n = len(client.calls)
+        text = prompts[(offset + t) % len(prompts)]
+        enc = client.call("POST", "/encode", json_body={"uid": uid, "text": text, "last_reply": last_reply})
+        # Stand-in reply: stream the turn's own tokens back through /decode one at a time
+        reply = []
+        for token in (enc["diff"] * (reply_tokens // max(1, len(enc["diff"])) + 1))[:reply_tokens]:
+            reply.append(client.call("POST", "/decode", json_body={"uid": uid, "token_ids": [token]})["text"])
+        last_reply = "".join(reply)
+        responses += [enc["token_ids"], enc["diff"], last_reply]
+        per_turn.append(sum(dt for _, dt in client.calls[n:]))
+    return responses, per_turn
+
+
+def run_level(url, clients, args, prompts):
+    """`clients` concurrent clients, each running --conversations conversations."""
+    results = [None] * clients
+
+    def worker(i):
+        client = Client(url, not args.no_keepalive, args.timeout)
+        responses, per_turn, errors = [], [], 0
+        for c in range(args.conversations):
+            try:
+                r, t = conversation(client, prompts, args.turns, args.reply_tokens, i * args.conversations + c)
+                responses.append(r)
+                per_turn += t
+            except Exception as e:
+                errors += 1
+                responses.append(str(e))
+        results[i] = (client.calls, responses, per_turn, errors)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - t0
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ms = np.array(values) * 1000
+    return {f"p{q}_ms": round(float(np.percentile(ms, q)), 3) for q in (50, 95, 99)}
+
+
+def summarize(results, wall, clients):
+    calls = [c for r in results for c in r[0]]
+    by_endpoint = {}
+    for endpoint, dt in calls:
+        by_endpoint.setdefault(endpoint, []).append(dt)
+    return {"clients": clients, "calls": len(calls), "wall_s": round(wall, 3),
+            "calls_per_s": round(len(calls) / wall, 1) if wall else None,
+            "errors": sum(r[3] for r in results),
+            "turn_tokenizer_s": percentiles([t for r in results for t in r[2]]),
+            "endpoints": {e: dict(calls=len(v), **percentiles(v)) for e, v in sorted(by_endpoint.items())}}
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--url", default="http://127.0.0.1:12345", help="Tokenizer service to benchmark")
+    p.add_argument("--model-path", help="Start tokenizer_service.py with this tokenizer instead of using --url")
+    p.add_argument("--compare", help="Second service to run the same conversations against and check")
+    p.add_argument("--prompts-file", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts.txt"))
+    p.add_argument("--clients", default="1,4,16", help="Concurrent conversation levels")
+    p.add_argument("--conversations", type=int, default=5, help="Conversations per client per level")
+    p.add_argument("--turns", type=int, default=4)
+    p.add_argument("--reply-tokens", type=int, default=64, help="/decode calls per turn")
+    p.add_argument("--no-keepalive", action="store_true", help="Open a new connection for every call")
+    p.add_argument("--timeout", type=float, default=30.0)
+    p.add_argument("--out-dir", default="performance_evaluation/results/tokenizer_service")
+    args = p.parse_args()
+
+    with open(args.prompts_file, encoding="utf-8") as fh:
+        prompts = [ln.strip() for ln in fh if ln.strip()]
+    proc = None
+    if args.model_path:
+        proc, args.url = start_service(args.model_path)
+        print(f"Started tokenizer_service.py at {args.url}")
+    targets = [("service", args.url)] + ([("compare", args.compare)] if args.compare else [])
+
+    timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    outdir = os.path.join(args.out_dir, timestamp)
+    os.makedirs(outdir, exist_ok=True)
+    levels, mismatches = [], []
+    try:
+        with open(os.path.join(outdir, "calls.csv"), "w", newline="", encoding="utf-8") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(["target", "clients", "client", "endpoint", "latency_ms"])
+            for clients in [int(c) for c in args.clients.split(",")]:
+                responses = {}
+                for name, url in targets:
+                    results, wall = run_level(url, clients, args, prompts)
+                    for i, r in enumerate(results):
+                        writer.writerows((name, clients, i, e, round(dt * 1000, 4)) for e, dt in r[0])
+                    responses[name] = [r[1] for r in results]
+                    levels.append(dict(summarize(results, wall, clients), target=name, url=url))
+                    s = levels[-1]
+                    turn = s["turn_tokenizer_s"] or {}
+                    print(f"{name:<8} clients={clients:<3} {s['calls']:>6} calls {s['calls_per_s']:>9,.0f}/s  "
+                          f"errors={s['errors']}  turn p50/p95/p99 {turn.get('p50_ms', 0):.2f}/"
+                          f"{turn.get('p95_ms', 0):.2f}/{turn.get('p99_ms', 0):.2f} ms")
+                    for e, v in s["endpoints"].items():
+                        print(f"    {e:<8} p50 {v['p50_ms']:8.3f}  p95 {v['p95_ms']:8.3f}  p99 {v['p99_ms']:8.3f} ms")
+                if args.compare and responses["service"] != responses["compare"]:
+                    mismatches.append(clients)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=10)
+
+    summary = {"timestamp": timestamp, "url": args.url, "compare": args.compare, "keepalive": not args.no_keepalive,
+               "turns": args.turns, "reply_tokens": args.reply_tokens, "conversations": args.conversations,
+               "levels": levels, "mismatched_levels": mismatches}
+    with open(os.path.join(outdir, "summary.json"), "w", encoding="utf-8") as fh:
+        json.dump(summary, fh, indent=2)
+    print(f"Wrote results to {outdir}")
+    if mismatches:
+        print(f"MISMATCH: {args.compare} returned different token ids or text at clients={mismatches}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()